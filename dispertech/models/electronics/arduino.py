@@ -29,8 +29,8 @@ class ArduinoModel(ModelDevice):
         super().__init__()
         self._threads = []
         self._stop_temperature = Event()
-        self.temp_electronics = 0
-        self.temp_sample = 0
+        self.temp_electronics = None  # None until the first reading, not a temperature of 0
+        self.temp_sample = None
         self.query_lock = RLock()
         self.driver = None
         self.port = port
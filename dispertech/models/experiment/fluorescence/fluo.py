@@ -5,6 +5,7 @@
 #  See LICENSE.md.MD for more information.                                        #
 # ##############################################################################
 
+import json
 import os
 from datetime import datetime
 from multiprocessing import Event
@@ -14,6 +15,7 @@ import numpy as np
 from calibration.models.movie_saver import MovieSaver
 
 from dispertech.models.electronics.arduino import ArduinoModel
+from dispertech.models.experiment.nanoparticle_tracking.raw_stream import RawVideoSaver
 from experimentor import Q_
 from experimentor.core.signal import Signal
 from experimentor.lib.fitgaussian import fitgaussian
@@ -381,6 +383,16 @@ class Fluorescence(Experiment):
         base_filename = self.config['info']['filename_movie']
         file = self.get_filename(base_filename)
         self.saving_event.clear()
+        if self.config['saving'].get('mode', 'hdf5') == 'raw':
+            self.saving_process = RawVideoSaver(
+                file,
+                json.dumps(self.camera_microscope.config.all(), default=str),
+                'new_image',
+                port=self.camera_microscope.new_image.url,
+                preallocate=self.config['saving'].get('raw_preallocate', 2000),
+            )
+            self.saving_process.start()
+            return
         self.saving_process = MovieSaver(
             file,
             self.config['saving']['max_memory'],
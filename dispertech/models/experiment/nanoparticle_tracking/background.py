@@ -0,0 +1,154 @@
+"""
+    Background Correction
+    =====================
+    Subtracts the background from the frames of the free run before they are located and displayed. The method is one
+    of the :data:`~dispertech.models.experiment.nanoparticle_tracking.BACKGROUND_MODES`:
+
+        * ``NO_CORRECTION``: frames are used as they are.
+        * ``SNAP``: a single frame, taken with :meth:`BackgroundCorrection.snap`, is subtracted from every frame.
+        * ``ROLLING``: the mean or the median of the last ``window`` frames is subtracted.
+
+    The rolling background is kept up to date incrementally: the last frames are stored in a preallocated ring, the
+    mean keeps a running sum to which the new frame is added and from which the oldest one is subtracted, and the
+    median keeps the values of every pixel sorted, removing the oldest value and inserting the new one. Updating the
+    background and subtracting it is a single compiled pass over the frame, that writes the result directly where it
+    is needed, e.g. in a slot of a shared buffer. Negative values are clipped to zero.
+"""
+import numba
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking import BACKGROUND_MODES, NO_CORRECTION, SNAP
+
+MEAN = 'mean'
+MEDIAN = 'median'
+
+
+@numba.njit(cache=True, nogil=True)
+def _subtract(frame, background, out):
+    for p in range(frame.shape[0]):
+        value = frame[p] - background[p]
+        out[p] = value if value > 0 else 0
+
+
+@numba.njit(cache=True, nogil=True)
+def _rolling_mean(frame, ring, slot, count, sums, out):
+    window = ring.shape[0]
+    n = min(count + 1, window)
+    for p in range(frame.shape[0]):
+        new = frame[p]
+        if count >= window:
+            sums[p] -= ring[slot, p]
+        sums[p] += new
+        ring[slot, p] = new
+        value = new - sums[p] / n
+        out[p] = value if value > 0 else 0
+
+
+@numba.njit(cache=True, nogil=True)
+def _rolling_median(frame, ring, slot, count, ordered, out):
+    window = ring.shape[0]
+    n = min(count + 1, window)
+    for p in range(frame.shape[0]):
+        new = frame[p]
+        values = ordered[p]
+        if count >= window:  # The new value takes the place of the oldest one and is moved until sorted
+            old = ring[slot, p]
+            i = 0
+            while values[i] != old:
+                i += 1
+            if new > old:
+                while i + 1 < window and values[i + 1] < new:
+                    values[i] = values[i + 1]
+                    i += 1
+            else:
+                while i > 0 and values[i - 1] > new:
+                    values[i] = values[i - 1]
+                    i -= 1
+        else:
+            i = count
+            while i > 0 and values[i - 1] > new:
+                values[i] = values[i - 1]
+                i -= 1
+        values[i] = new
+        ring[slot, p] = new
+        if n % 2:
+            median = float(values[n // 2])
+        else:
+            median = (float(values[n // 2 - 1]) + float(values[n // 2])) / 2
+        value = new - median
+        out[p] = value if value > 0 else 0
+
+
+class BackgroundCorrection:
+    """ Subtracts the background from the frames of a camera.
+
+    :param int method: ``NO_CORRECTION``, ``SNAP`` or ``ROLLING``
+    :param int window: Frames in the rolling background
+    :param str statistic: :data:`MEAN` or :data:`MEDIAN` of the rolling background. The median ignores particles that
+        stay a few frames on the same pixels, but every frame costs about ``window`` times more
+    """
+    def __init__(self, method=NO_CORRECTION, window=10, statistic=MEAN):
+        if method not in BACKGROUND_MODES:
+            raise ValueError('Unknown background correction {}'.format(method))
+        if statistic not in (MEAN, MEDIAN):
+            raise ValueError('The rolling background is either the {} or the {}'.format(MEAN, MEDIAN))
+        self.method = method
+        self.window = max(int(window), 1)
+        self.statistic = statistic
+        self.background = None  # Frame subtracted with SNAP
+        self._snap_next = False
+        self._ring = None
+        self._state = None  # Running sums, or the sorted values of every pixel
+        self.count = 0  # Frames added to the rolling background
+
+    def reset(self):
+        """ Forgets the background, e.g. after changing the ROI or the exposure. """
+        self.background = None
+        self._ring = self._state = None
+        self.count = 0
+
+    def snap(self):
+        """ The next frame is taken as the background subtracted with ``SNAP``. """
+        self._snap_next = True
+
+    def apply(self, frame, out=None):
+        """ Updates the background with ``frame`` and subtracts it.
+
+        :param frame: The new frame
+        :param out: Array with the shape and type of ``frame`` in which the result is written, e.g. the slot of a
+            shared buffer. A new array is allocated if not given
+        :return: The corrected frame. ``frame`` itself with ``NO_CORRECTION``, or with ``SNAP`` until a background
+            was taken
+        """
+        if self.method == NO_CORRECTION:
+            return frame
+        if self.method == SNAP:
+            if self._snap_next or self.background is None or self.background.shape != frame.shape:
+                self.background = np.array(frame, dtype=np.float64)
+                self._snap_next = False
+            background = self.background
+        elif self._ring is None or self._ring.shape[1:] != frame.shape:
+            self._allocate(frame)
+        frame = np.ascontiguousarray(frame)
+        if out is None:
+            out = np.empty_like(frame)
+        flat_out = out.reshape(-1)
+        if self.method == SNAP:
+            _subtract(frame.reshape(-1), background.reshape(-1), flat_out)
+            return out
+        ring = self._ring.reshape(self.window, -1)
+        slot = self.count % self.window
+        if self.statistic == MEAN:
+            _rolling_mean(frame.reshape(-1), ring, slot, self.count, self._state, flat_out)
+        else:
+            _rolling_median(frame.reshape(-1), ring, slot, self.count, self._state, flat_out)
+        self.count += 1
+        return out
+
+    def _allocate(self, frame):
+        self._ring = np.zeros((self.window, *frame.shape), dtype=frame.dtype)
+        if self.statistic == MEAN:
+            self._state = np.zeros(frame.size, dtype=np.float64)
+        else:
+            self._state = np.zeros((frame.size, self.window), dtype=frame.dtype)
+        self.count = 0
@@ -0,0 +1,227 @@
+"""
+    Chunk Compression
+    =================
+    h5py compresses the chunks of a dataset one after the other, holding its global lock, which limits the rate at
+    which a recording can be written to what a single core can compress. The codecs defined here compress the chunks
+    of a ``timelapse`` in Python, on a pool of threads (zlib, zstd, lz4 and blosc release the GIL while they work), and
+    the :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.TimelapseWriter` stores the result with
+    ``write_direct_chunk``. The datasets are created with the matching HDF5 filter, so any program that can read the
+    filter can read the recording.
+
+    Available codecs:
+
+        * ``none``: chunks are stored as they are
+        * ``gzip``: the standard HDF5 deflate filter, always available
+        * ``zstd``, ``lz4`` and ``blosc``: need ``hdf5plugin`` to register the filter and, respectively, the
+          ``zstandard``, ``lz4`` or ``blosc`` packages to compress
+
+    Which codec is best depends on the processor and the disk of each machine, :func:`throughput_report` measures the
+    speed and compression ratio of every available codec on real frames.
+"""
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+
+import numpy as np
+
+from experimentor.lib.log import get_logger
+
+try:
+    import hdf5plugin
+except ModuleNotFoundError:
+    hdf5plugin = None
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+try:
+    import lz4.block as lz4_block
+except ModuleNotFoundError:
+    lz4_block = None
+
+try:
+    import blosc
+except ModuleNotFoundError:
+    blosc = None
+
+
+CODECS = ('none', 'gzip', 'lz4', 'zstd', 'blosc')
+
+
+class Codec:
+    """ Compresses chunks in the format expected by an HDF5 filter. The base class stores them uncompressed.
+
+    :param int level: Compression level
+    """
+    name = 'none'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def dataset_options(self):
+        """ Keyword arguments for ``create_dataset`` that set the filter able to decompress the chunks. """
+        return {}
+
+    def compress(self, chunk):
+        """ Compresses a C-contiguous array and returns the bytes to pass to ``write_direct_chunk``. """
+        return chunk.tobytes()
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+
+    def dataset_options(self):
+        return {'compression': 'gzip', 'compression_opts': self.level}
+
+    def compress(self, chunk):
+        return zlib.compress(chunk, self.level)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+
+    def __init__(self, level=1):
+        super().__init__(level)
+        self._local = local()  # Compressors can't be shared between threads
+
+    def dataset_options(self):
+        return dict(hdf5plugin.Zstd(clevel=self.level))
+
+    def compress(self, chunk):
+        if not hasattr(self._local, 'compressor'):
+            self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return self._local.compressor.compress(chunk)
+
+
+class LZ4Codec(Codec):
+    """ Writes the framing of the HDF5 LZ4 filter: the original size (8 bytes) and the block size (4 bytes), followed
+    by a single block made of its compressed size (4 bytes) and the data. All integers are big-endian. Blocks that do
+    not shrink are stored uncompressed.
+    """
+    name = 'lz4'
+
+    def dataset_options(self):
+        return dict(hdf5plugin.LZ4())
+
+    def compress(self, chunk):
+        data = chunk.tobytes()
+        compressed = lz4_block.compress(data, store_size=False)
+        if len(compressed) >= len(data):
+            compressed = data
+        return struct.pack('>qi', len(data), len(data)) + struct.pack('>i', len(compressed)) + compressed
+
+
+class BloscCodec(Codec):
+    name = 'blosc'
+
+    def __init__(self, level=1):
+        super().__init__(level)
+        blosc.set_releasegil(True)
+
+    def dataset_options(self):
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=self.level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+    def compress(self, chunk):
+        return blosc.compress(chunk.tobytes(), typesize=chunk.dtype.itemsize, clevel=self.level,
+                              shuffle=blosc.SHUFFLE, cname='lz4')
+
+
+def available_codecs():
+    """ Names of the codecs that can be used on this machine. """
+    codecs = ['none', 'gzip']
+    if hdf5plugin is not None:
+        if lz4_block is not None:
+            codecs.append('lz4')
+        if zstandard is not None:
+            codecs.append('zstd')
+        if blosc is not None:
+            codecs.append('blosc')
+    return codecs
+
+
+def get_codec(name='gzip', level=1):
+    """ Returns the codec with the given name. If it is not available on this machine, falls back to gzip.
+
+    :param str name: One of :data:`CODECS`
+    :param int level: Compression level, its meaning depends on the codec
+    """
+    if name is None or name is False:
+        name = 'none'
+    if name not in CODECS:
+        raise ValueError('Compression must be one of {}, not {}'.format(CODECS, name))
+    if name not in available_codecs():
+        logger = get_logger(name=__name__)
+        logger.warning('Codec {} is not available, install hdf5plugin and its library. Using gzip'.format(name))
+        name = 'gzip'
+    codec_class = {
+        'none': Codec,
+        'gzip': GzipCodec,
+        'lz4': LZ4Codec,
+        'zstd': ZstdCodec,
+        'blosc': BloscCodec,
+    }[name]
+    return codec_class(level)
+
+
+class ChunkCompressor:
+    """ Compresses the chunks of a frame-major block on a pool of threads.
+
+    :param codec: The :class:`Codec` to use
+    :param int threads: Number of threads, ``None`` lets the executor decide based on the number of cores
+    """
+    def __init__(self, codec, threads=None):
+        self.codec = codec
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='ChunkCompressor')
+
+    def compress(self, block, chunk_frames):
+        """ Yields the compressed chunks of ``block`` in order. The last chunk is padded with zeros if the number of
+        frames is not a multiple of ``chunk_frames``, HDF5 always stores complete chunks.
+        """
+        chunks = []
+        for start in range(0, block.shape[0], chunk_frames):
+            chunk = block[start:start + chunk_frames]
+            if chunk.shape[0] < chunk_frames:
+                padded = np.zeros((chunk_frames, *block.shape[1:]), dtype=block.dtype)
+                padded[:chunk.shape[0]] = chunk
+                chunk = padded
+            chunks.append(np.ascontiguousarray(chunk))
+        return self.executor.map(self.codec.compress, chunks)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def throughput_report(frames, codecs=None, level=1, threads=None, chunk_frames=1):
+    """ Measures how fast each codec compresses the given frames and how much it shrinks them.
+
+    :param np.ndarray frames: Frames stacked on the first axis, ideally taken from a real recording
+    :param codecs: Names of the codecs to test, by default every available codec
+    :return: A list of dictionaries with the codec, the throughput in MB/s and the compression ratio
+    """
+    frames = np.ascontiguousarray(frames)
+    size = frames.nbytes / 1024 / 1024
+    report = []
+    for name in codecs or available_codecs():
+        compressor = ChunkCompressor(get_codec(name, level), threads)
+        t0 = time.perf_counter()
+        compressed = sum(len(c) for c in compressor.compress(frames, chunk_frames))
+        elapsed = time.perf_counter() - t0
+        compressor.shutdown()
+        report.append({
+            'codec': name,
+            'throughput': size / elapsed if elapsed else float('inf'),
+            'ratio': frames.nbytes / compressed,
+        })
+    return report
+
+
+def format_report(report):
+    """ Formats the output of :func:`throughput_report` as a table. """
+    lines = ['{:<8}{:>16}{:>10}'.format('Codec', 'Speed (MB/s)', 'Ratio')]
+    for row in report:
+        lines.append('{:<8}{:>16.1f}{:>10.2f}'.format(row['codec'], row['throughput'], row['ratio']))
+    return '\n'.join(lines)
@@ -0,0 +1,71 @@
+"""
+    Drift Estimation
+    ================
+    Estimates the drift of the sample, e.g. of the stage or of a flow in the fiber, while the measurement runs, from
+    the particles linked between consecutive frames by the
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.linking.LinkingProcess`. The Brownian displacements of
+    many particles average out, what is left is the motion common to all of them.
+
+    The velocity of the drift is the mean displacement of the particles found in two consecutive frames, averaged
+    over the last ``window`` frames, and the drift is its sum since the first frame. Only the displacements in the
+    window are kept, therefore the memory does not grow with the length of the measurement. Frames without particles
+    count in the window, particles seen again after them are compared with their last position. Unlike
+    ``trackpy.compute_drift``, which averages over past and future frames, the estimate lags about ``window / 2``
+    frames behind a change of the velocity.
+"""
+from collections import deque
+
+import numpy as np
+
+
+class DriftEstimator:
+    """ Drift of the sample, updated frame by frame.
+
+    :param int window: Frames over which the displacement of the particles is averaged
+    """
+    def __init__(self, window=100):
+        self.window = max(int(window), 1)
+        self.steps = deque()  # Sum of the displacements and particle-frames of every frame in the window
+        self.displacement = np.zeros(2)  # Sum of the displacements in the window
+        self.weight = 0  # Particle-frames in the window
+        self.drift = np.zeros(2)  # (y, x) since the first frame
+        self.frame = None  # Last frame added
+        self.located = None  # Last frame with particles, in which they had the following positions
+        self.particles = np.zeros(0, dtype=np.int64)
+        self.positions = np.zeros((0, 2))
+
+    @property
+    def velocity(self):
+        """ Drift (y, x) per frame, averaged over the window. """
+        return self.displacement / self.weight if self.weight else np.zeros(2)
+
+    def add(self, frame, particles, positions):
+        """ Updates the drift with the particles linked in a new frame.
+
+        :param int frame: Number of the frame
+        :param particles: Particle of every location, as assigned by the linking
+        :param positions: Array with the ``(y, x)`` of every location
+        :return: The drift ``(y, x)`` at ``frame``
+        """
+        particles = np.asarray(particles)
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        if self.frame is not None and frame > self.frame:
+            _, current, previous = np.intersect1d(particles, self.particles, assume_unique=True, return_indices=True)
+            gap = frame - self.located if len(current) else 0
+            self._add_step((positions[current] - self.positions[previous]).sum(axis=0), len(current) * gap)
+            self.drift += self.velocity * (frame - self.frame)
+        self.frame = frame
+        if len(particles):
+            self.located = frame
+            self.particles = particles
+            self.positions = positions
+        return self.drift.copy()
+
+    def _add_step(self, displacement, weight):
+        self.steps.append((displacement, weight))
+        self.displacement += displacement
+        self.weight += weight
+        if len(self.steps) > self.window:
+            displacement, weight = self.steps.popleft()
+            self.displacement -= displacement
+            self.weight -= weight
@@ -21,4 +21,7 @@ class DiameterNotDefined(NanoCETException):
     pass
 
 class LinkException(NanoCETException):
-    pass
\ No newline at end of file
+    pass
+
+class FrameOverwritten(NanoCETException):
+    pass
@@ -0,0 +1,112 @@
+"""
+    Frame Information
+    =================
+    Besides the pixels, every recorded frame carries a few numbers describing the conditions in which it was acquired.
+    They are broadcast in the header of each frame (see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.transport`) and stored by the savers as 1-D datasets
+    next to the ``timelapse``, one value per frame::
+
+        <session>/timelapse
+        <session>/frame_id
+        <session>/timestamp
+        <session>/exposure
+        ...
+
+    Finding dropped frames or the frames recorded between two moments only requires reading these datasets, not the
+    timelapse. Values that were not available when the frame was acquired are stored as ``NaN``.
+"""
+import time
+
+import numpy as np
+
+FRAME_INFO_DTYPE = np.dtype([
+    ('frame_id', np.int64),  # Consecutive number given by the acquisition, gaps are dropped frames
+    ('timestamp', np.float64),  # Seconds since the epoch
+    ('exposure', np.float32),  # In milliseconds
+    ('gain', np.float32),
+    ('laser_power', np.float32),  # Percentage of the scattering laser
+    ('temperature_sample', np.float32),
+    ('temperature_electronics', np.float32),
+])
+
+
+def info_value(value, units=None):
+    """ Converts a value to a float that can be stored, quantities are expressed in ``units``. Missing values become
+    ``NaN``.
+    """
+    if value is None:
+        return float('nan')
+    if units is not None and hasattr(value, 'm_as'):
+        return float(value.m_as(units))
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def info_record(header):
+    """ Builds the record of a frame from the header with which it was received. """
+    record = np.zeros((), dtype=FRAME_INFO_DTYPE)
+    info = header.get('info') or {}
+    for name in FRAME_INFO_DTYPE.names:
+        if name == 'frame_id':
+            record[name] = header.get('frame_id', 0)
+        elif name == 'timestamp':
+            record[name] = header.get('timestamp', float('nan'))
+        else:
+            record[name] = info_value(info.get(name))
+    return record
+
+
+class FrameInfoWriter:
+    """ Appends the information of every frame to the 1-D datasets of a session. Records are kept in memory and written
+    in batches, so that the saver only touches these datasets once every ``batch`` frames.
+
+    :param group: HDF5 group of the session, usually the one holding the ``timelapse``
+    :param int batch: Number of frames kept in memory before writing
+    :param float flush_interval: Seconds after which the records in memory are written even if the batch is not
+        complete, so that readers following the recording see them. ``None`` to only write complete batches
+    """
+    def __init__(self, group, batch=1000, flush_interval=None):
+        self.group = group
+        self.batch = max(batch, 1)
+        self.flush_interval = flush_interval
+        self._last_flush = time.time()
+        self.records = np.zeros(self.batch, dtype=FRAME_INFO_DTYPE)
+        self.i = 0  # Records in memory
+        self.j = 0  # Records already written
+        self.dsets = {
+            name: group.create_dataset(name, (0,), maxshape=(None,), chunks=(self.batch,),
+                                       dtype=FRAME_INFO_DTYPE[name])
+            for name in FRAME_INFO_DTYPE.names
+        }
+
+    def append(self, header):
+        """ Adds the information of a frame, taken from its header. """
+        self.append_record(info_record(header))
+
+    def append_record(self, record):
+        """ Adds a record that already has the fields of :data:`FRAME_INFO_DTYPE`, e.g. from the index of a raw
+        stream.
+        """
+        for name in FRAME_INFO_DTYPE.names:
+            self.records[self.i][name] = record[name]
+        self.i += 1
+        if self.i == self.batch:
+            self.flush()
+        elif self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self.i:
+            return
+        for name, dset in self.dsets.items():
+            dset.resize((self.j + self.i,))
+            dset[self.j:self.j + self.i] = self.records[name][:self.i]
+            dset.flush()
+        self.j += self.i
+        self.i = 0
+
+    def close(self):
+        self.flush()
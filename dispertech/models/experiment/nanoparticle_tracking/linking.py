@@ -0,0 +1,238 @@
+"""
+    Streaming Linking
+    =================
+    Links the locations published by the
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.localization.LocalizationProcess` into trajectories
+    while the measurement runs, instead of linking a DataFrame with every location once it is over.
+
+    The locations of each frame are fed to the ``Linker`` of trackpy, the one behind ``trackpy.link_df_iter``, which
+    only keeps the last ``memory`` frames. The :class:`TrackAccumulator` collects the linked locations of the particles
+    that are still being followed. A particle that was not seen for more than ``memory`` frames can not be linked
+    again, its trajectory is complete and is published on the ``tracks`` topic and removed from memory. Therefore the
+    memory used depends on the number of particles in view and not on the length of the measurement. Trajectories are
+    published as raw records with :data:`~dispertech.models.experiment.nanoparticle_tracking.records.TRACK_DTYPE`,
+    see :func:`~dispertech.models.experiment.nanoparticle_tracking.records.to_wire`.
+
+    The ``memory`` is counted in camera frames. Frames without particles are linked as empty frames, and so are the
+    frames whose locations never arrived (e.g. overwritten before being located), found by the gaps in the frame
+    numbers.
+
+    The linker has to receive every frame, see the ``EVERY_FRAME`` mode of the localization. With skipped frames the
+    particles move further between consecutive locations and the trajectories break.
+
+    The ``search_range``, the ``memory`` and the ``min_length`` can be changed while the linking runs, with a control
+    message for ``'linking'`` sent by the frame publisher, see
+    :func:`~dispertech.models.experiment.nanoparticle_tracking.transport.send_control`. They are applied before the
+    next frame, the trajectories being followed are kept.
+
+    With a ``drift_window``, the drift of the sample is estimated from the linked particles, see
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.drift.DriftEstimator`. It is published on the ``drift``
+    topic for every frame and subtracted from the locations of the trajectories, therefore the diameters calculated
+    from them are not biased by the drift. The ``locations`` topic keeps the positions as they were located.
+
+    When the linking stops, the trajectories still active are published, followed by an end of stream on the
+    ``tracks`` and ``drift`` topics, see
+    :data:`~dispertech.models.experiment.nanoparticle_tracking.transport.END_OF_STREAM`.
+"""
+from multiprocessing import Process
+
+import numpy as np
+import pandas as pd
+import trackpy as tp
+import zmq
+
+from dispertech.models.experiment.nanoparticle_tracking.drift import DriftEstimator
+from dispertech.models.experiment.nanoparticle_tracking.records import DRIFT_DTYPE, TRACK_DTYPE, as_records, \
+    empty_records, to_track_records, to_wire
+from dispertech.models.experiment.nanoparticle_tracking.transport import CONTROL_TOPIC, END_OF_STREAM, \
+    close_pusher, control_requested, recv_frame, recv_object, subscribe
+from experimentor.config import settings
+from experimentor.core.pusher import Pusher
+from experimentor.lib.log import get_logger
+
+
+class TrackAccumulator:
+    """ Collects the locations linked by trackpy, frame by frame, and hands out the trajectories once they are
+    complete.
+
+    :param int memory: Frames a particle can vanish and still be linked, the same value given to trackpy
+    :param int min_length: Trajectories with fewer locations are discarded when they are complete
+    """
+    def __init__(self, memory=3, min_length=1):
+        self.memory = memory
+        self.min_length = min_length
+        self.step = 0  # Last frame linked
+        self.tracks = {}  # Locations of every active particle, as a list of record arrays
+        self.last_seen = {}  # Frame in which every active particle was last located
+        self.completed = 0
+        self.discarded = 0
+
+    def add(self, linked, frame=None):
+        """ Adds the locations of a frame, as returned by ``trackpy.link_df_iter``, or as records with
+        :data:`~dispertech.models.experiment.nanoparticle_tracking.records.TRACK_DTYPE`.
+
+        :param int frame: Number of the frame, by default the one after the previous frame. Particles are complete
+            when they were not located in the last ``memory`` frames, including frames without particles
+        :return: List with the trajectories completed with this frame, as records with ``TRACK_DTYPE``
+        """
+        self.step = self.step + 1 if frame is None else frame
+        if len(linked):
+            records = to_track_records(linked) if isinstance(linked, pd.DataFrame) else linked
+            records = records[np.argsort(records['particle'], kind='stable')]
+            particles, starts = np.unique(records['particle'], return_index=True)
+            for particle, locations in zip(particles, np.split(records, starts[1:])):
+                self.tracks.setdefault(particle, []).append(locations)
+                self.last_seen[particle] = self.step
+        lost = [p for p, step in self.last_seen.items() if self.step - step > self.memory]
+        return self._pop(lost)
+
+    def flush(self):
+        """ Hands out every trajectory still active, e.g. when the measurement ends. """
+        return self._pop(list(self.last_seen))
+
+    def _pop(self, particles):
+        tracks = []
+        for particle in particles:
+            del self.last_seen[particle]
+            records = np.concatenate(self.tracks.pop(particle))
+            if len(records) < self.min_length:
+                self.discarded += 1
+                continue
+            self.completed += 1
+            tracks.append(records)
+        return tracks
+
+
+class LinkingProcess(Process):
+    """ Process that subscribes to the locations published on ``topic``, links them into trajectories and publishes
+    every complete trajectory, as raw :data:`TRACK_DTYPE` records, on ``publish_topic``.
+
+    :param str topic: Topic on which the locations are published
+    :param str publish_topic: Topic on which to publish the trajectories
+    :param int port: Port of the publisher, defaults to the port of the experimentor publisher
+    :param float search_range: Maximum distance (in pixels) a particle moves between frames
+    :param int memory: Frames a particle can vanish and still be linked
+    :param int min_length: Shorter trajectories are not published
+    :param stop_event: ``multiprocessing.Event`` that stops the linking. The active trajectories are published before
+        stopping
+    :param control_port: Port of the frame publisher, on which the new parameters are sent. ``None`` to keep the
+        parameters fixed
+    :param int drift_window: Frames over which the drift is averaged, ``None`` to not correct the drift
+    :param str drift_topic: Topic on which to publish the drift of every frame, as a :data:`DRIFT_DTYPE` record
+    """
+    def __init__(self, topic='locations', publish_topic='tracks', port=None, search_range=5, memory=3, min_length=1,
+                 stop_event=None, control_port=None, drift_window=None, drift_topic='drift'):
+        super().__init__()
+        self.topic = topic
+        self.publish_topic = publish_topic
+        self.port = port or settings.PUBLISHER_PUBLISH_PORT
+        self.search_range = search_range
+        self.memory = memory
+        self.min_length = min_length
+        self.stop_event = stop_event
+        self.control_port = control_port
+        self.drift_window = drift_window
+        self.drift_topic = drift_topic
+
+    def locations(self, socket, control=None):
+        """ Yields the locations of every frame, as records, until the linking is stopped. Frames without particles
+        yield empty records. The control messages received in the meantime are applied.
+        """
+        while self.stop_event is None or not self.stop_event.is_set():
+            if not socket.poll(100):
+                continue
+            topic, locations = recv_object(socket)
+            if isinstance(locations, str):
+                if locations == settings.SUBSCRIBER_EXIT_KEYWORD:
+                    return
+                continue
+            while control is not None and control.poll(0):
+                topic, header, _ = recv_frame(control)
+                if control_requested(header, 'linking'):
+                    self.update_parameters(**header['params'])
+            yield as_records(locations)
+
+    def update_parameters(self, search_range=None, memory=None, min_length=None):
+        """ Changes the parameters of the linking, from the next frame on. """
+        if search_range is not None:
+            self.search_range = search_range
+        if memory is not None:
+            self.memory = memory
+        if min_length is not None:
+            self.min_length = min_length
+        get_logger(name=__name__).info('Linking with a search range of {}, a memory of {} and a minimum length of {}'
+                                       .format(self.search_range, self.memory, self.min_length))
+
+    def configure(self, linker, tracks):
+        """ Applies the current parameters to the linker and to the trajectories. When the memory is shortened, the
+        particles that vanished longer ago are forgotten.
+        """
+        linker.search_range = float(self.search_range)
+        if linker.memory != self.memory:
+            history = linker.mem_history
+            while len(history) < self.memory:
+                history.insert(0, set())
+            while len(history) > self.memory:
+                linker.mem_set -= history.pop(0)
+            linker.memory = self.memory
+        tracks.memory = self.memory
+        tracks.min_length = self.min_length
+
+    def link(self, linker, tracks, drift, pusher, records, frame):
+        """ Links the locations of a frame, publishing its drift and the trajectories completed with it. """
+        coords = np.column_stack((records['y'], records['x'])).astype(np.float64)
+        linker.next_level(coords, frame)
+        linked = np.zeros(len(records), dtype=TRACK_DTYPE)
+        for field in records.dtype.names:
+            linked[field] = records[field]
+        linked['particle'] = linker.particle_ids
+        if drift is not None:
+            offset = drift.add(frame, linked['particle'], coords)
+            linked['y'] -= offset[0]
+            linked['x'] -= offset[1]
+            pusher.publish(to_wire(np.array([(frame, *offset)], dtype=DRIFT_DTYPE)), self.drift_topic)
+        for track in tracks.add(linked, frame):
+            pusher.publish(to_wire(track), self.publish_topic)
+
+    def run(self):
+        logger = get_logger(name=__name__)
+        logger.info('Linking the locations published on {}'.format(self.topic))
+        context = zmq.Context()
+        socket = subscribe(context, self.topic, self.port)
+        control = None
+        if self.control_port is not None:
+            control = subscribe(context, CONTROL_TOPIC, self.control_port)
+        pusher = Pusher()
+        tracks = TrackAccumulator(self.memory, self.min_length)
+        linker = None
+        drift = DriftEstimator(self.drift_window) if self.drift_window else None
+        last_frame = None
+        for records in self.locations(socket, control):
+            if len(records):
+                frame = int(records['frame'][0])
+            elif last_frame is None:
+                continue  # The number of the frame is not known, and there is nothing to link yet
+            else:
+                frame = last_frame + 1  # Corrected by the next frame with particles if frames are missing
+            if linker is None:
+                linker = tp.linking.Linker(self.search_range, memory=self.memory)
+                linker.init_level(np.zeros((0, 2)), frame - 1)
+            else:
+                self.configure(linker, tracks)
+                # Frames that did not arrive are linked as empty. After memory + 1 of them every particle is lost,
+                # further frames would change nothing
+                for missing in range(max(last_frame + 1, frame - self.memory - 1), frame):
+                    self.link(linker, tracks, drift, pusher, empty_records(), missing)
+            self.link(linker, tracks, drift, pusher, records, frame)
+            last_frame = frame
+        for track in tracks.flush():
+            pusher.publish(to_wire(track), self.publish_topic)
+        pusher.publish(END_OF_STREAM, self.publish_topic)
+        if drift is not None:
+            pusher.publish(END_OF_STREAM, self.drift_topic)
+        close_pusher(pusher)
+        logger.info('Linking stopped, {} trajectories published and {} shorter than {} frames discarded'.format(
+            tracks.completed, tracks.discarded, self.min_length))
+        socket.close()
+        if control is not None:
+            control.close()
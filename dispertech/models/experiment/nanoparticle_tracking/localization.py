@@ -18,15 +18,95 @@ with the Publisher.
 :copyright:  Aquiles Carattino <aquiles@uetke.com>
 :license: GPLv3, see LICENSE.md for more details
 """
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing import Process
+
+import numpy as np
 import trackpy as tp
+import zmq
 
-from dispertech.models.experiment.nanoparticle_tracking.exceptions import DiameterNotDefined
+from dispertech.models.experiment.nanoparticle_tracking import numba_locate
+from dispertech.models.experiment.nanoparticle_tracking.exceptions import DiameterNotDefined, FrameOverwritten
+from dispertech.models.experiment.nanoparticle_tracking.records import LOCATION_FIELDS, to_dataframe, to_records, \
+    to_wire
+from dispertech.models.experiment.nanoparticle_tracking.ring_buffer import attach
+from dispertech.models.experiment.nanoparticle_tracking.transport import CONTROL_TOPIC, GapDetector, \
+    control_requested, count_dropped, frame_valid, read_frame, recv_header, stop_requested, subscribe
+from experimentor.core.pusher import Pusher
 from experimentor.lib.log import get_logger
 
+EVERY_FRAME = 'every_frame'  # Locate every frame, in order, e.g. to record the tracks
+LATEST_FRAME = 'latest_frame'  # Locate only the newest frame available, for the live view
+MODES = (EVERY_FRAME, LATEST_FRAME)
+
+LOCATORS = {
+    'trackpy': tp.locate,
+    'numba': numba_locate.locate_array,
+}
+
+
+def _add(counter, value):
+    if counter is not None:
+        with counter.get_lock():
+            counter.value += value
+
+
+def detect_core_band(image, fraction=0.5, margin=0):
+    """ Finds the rows illuminated by the fiber core, which spans a horizontal band of the image. The intensity of
+    every row is compared with the brightest one, and the band is the run of contiguous rows around it that are
+    brighter than ``fraction`` of the way between the background and the peak.
+
+    :param image: The frame, or the average of a few frames
+    :param float fraction: Threshold between the background (``0``) and the brightest row (``1``)
+    :param int margin: Rows added at both sides of the band
+    :return: ``(first, last)`` rows of the band, ``last`` not included, or ``None`` if the profile is flat
+    """
+    profile = np.asarray(image).sum(axis=1, dtype=np.float64)
+    peak = int(np.argmax(profile))
+    background = np.percentile(profile, 10)
+    if profile[peak] <= background:
+        return None
+    dark = np.flatnonzero(profile <= background + fraction * (profile[peak] - background))
+    first = dark[dark < peak].max() + 1 if np.any(dark < peak) else 0
+    last = dark[dark > peak].min() if np.any(dark > peak) else len(profile)
+    return int(max(first - margin, 0)), int(min(last + margin, len(profile)))
+
+
+@lru_cache(maxsize=4)
+def load_mask(file_path):
+    """ Reads a boolean mask stored with ``numpy.save``. It is cached, workers read it only once. """
+    return np.load(file_path).astype(bool)
+
 
 def calculate_locations_image(image, **kwargs):
     """ Calculates the positions of the particles on an image. It used the trackpy package, which may not be
-    installed by default.
+    installed by default. It accepts the arguments of :func:`locate_records`.
+
+    :return: DataFrame with the locations
+    """
+    return to_dataframe(locate_records(image, **kwargs), LOCATION_FIELDS)
+
+
+def locate_records(image, frame=0, locator='trackpy', rows=None, mask=None, margin=0, **kwargs):
+    """ Calculates the positions of the particles on an image, as compact records (see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.records`). No DataFrame is built with the numba locator.
+
+    Particles are only found inside the fiber core, therefore the localization can be restricted to a band of rows
+    or to a mask. Only the rows of the band, padded to leave room for the filters of the locator, are processed and
+    the locations outside of it are dropped. Note that the threshold of the locator is calculated on the band only.
+
+    :param int frame: Number of the frame, stored in the ``frame`` field of the records
+    :param str locator: ``'trackpy'`` for ``trackpy.locate`` or ``'numba'`` for
+        :func:`~dispertech.models.experiment.nanoparticle_tracking.numba_locate.locate`, which accepts the same
+        arguments and is faster
+    :param rows: ``(first, last)`` rows in which particles are located, ``last`` not included, or ``'auto'`` to find
+        them on every frame with :func:`detect_core_band`. ``None`` uses the whole image
+    :param mask: Boolean array with the shape of the image, or a ``.npy`` file holding it, ``True`` where particles
+        are located. It can be combined with ``rows``
+    :param int margin: Rows added at both sides of the band found with ``rows='auto'``
     """
     if not 'diameter' in kwargs:
         raise DiameterNotDefined('A diameter is mandatory for locating particles')
@@ -34,6 +114,194 @@ def calculate_locations_image(image, **kwargs):
     diameter = kwargs['diameter']
     del kwargs['diameter']
     logger = get_logger(name=__name__)
-    locations = tp.locate(image, diameter, **kwargs)
-    logger.debug('Got {} locations'.format(len(locations)))
-    return locations
+    if isinstance(mask, str):
+        mask = load_mask(mask)
+    if rows == 'auto':
+        rows = detect_core_band(image, margin=margin)
+    if mask is not None:
+        masked_rows = np.flatnonzero(mask.any(axis=1))
+        first, last = (masked_rows[0], masked_rows[-1] + 1) if len(masked_rows) else (0, 0)
+        rows = (max(first, rows[0]), min(last, rows[1])) if rows else (first, last)
+    if rows is None:
+        records = to_records(LOCATORS[locator](image, diameter, **kwargs), frame)
+    else:
+        first, last = int(rows[0]), int(rows[1])
+        padding = 2 * max(np.max(diameter), kwargs.get('separation') or 0, kwargs.get('smoothing_size') or 0)
+        offset = max(first - padding, 0)
+        records = to_records(LOCATORS[locator](image[offset:max(last + padding, offset)], diameter, **kwargs), frame)
+        records['y'] += offset
+        inside = (records['y'] >= first - 0.5) & (records['y'] < last - 0.5)
+        if mask is not None and len(records):
+            y = np.clip(np.rint(records['y']).astype(int), 0, mask.shape[0] - 1)
+            x = np.clip(np.rint(records['x']).astype(int), 0, mask.shape[1] - 1)
+            inside &= mask[y, x]
+        records = records[inside]
+    logger.debug('Got {} locations'.format(len(records)))
+    return records
+
+
+def locate_frame(header, frame, locate_kwargs):
+    """ Calculates the locations of a frame received with
+    :func:`~dispertech.models.experiment.nanoparticle_tracking.transport.recv_frame`. It runs on the workers of
+    :class:`LocalizationProcess`, therefore frames that are in a shared buffer can be passed as ``None``: the worker
+    reads them from the buffer and only the header has to be sent to it. Overwritten frames are not counted as dropped
+    here but by the :class:`LocalizationProcess`, the only one that increments the counter of the localization.
+
+    :return: ``(header, records)``. ``records`` is ``None`` if the frame was overwritten before being located
+    """
+    if frame is None:
+        try:
+            frame = attach(header['shared_memory']).read(header['seq'])
+        except (FrameOverwritten, FileNotFoundError):
+            return header, None
+    records = locate_records(frame, header['frame_id'], **locate_kwargs)
+    if not frame_valid(header):
+        return header, None
+    return header, records
+
+
+class LocalizationProcess(Process):
+    """ Process that subscribes to the frames broadcast on ``topic``, calculates the positions of the particles on
+    each one of them with :func:`locate_records` and publishes the locations on ``publish_topic``.
+
+    Frames arrive as raw buffers or as views on the shared buffer of the acquisition (see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.transport`), and the locations are published as raw
+    records (see :mod:`~dispertech.models.experiment.nanoparticle_tracking.records`), therefore nothing is pickled.
+
+    When ``workers`` is larger than one, frames are handed out to a pool of processes and up to ``max_pending``
+    of them are located at the same time. The locations are published in the order of the frames, a frame that is
+    located faster than the previous ones waits for them. Frames in a shared buffer are read directly by the workers,
+    the buffer needs more ``slots`` than ``max_pending`` or the frames will be overwritten before they are located.
+
+    With ``mode=EVERY_FRAME`` every frame received is located, as needed when the tracks are recorded. With
+    ``mode=LATEST_FRAME``, meant for the live view, frames that arrived while the previous ones were being located
+    are skipped and only the newest one is located, so the locations never fall behind the camera.
+
+    The arguments of the localization can be changed while it runs, with a control message for ``'localization'``
+    (see :func:`~dispertech.models.experiment.nanoparticle_tracking.transport.send_control`) holding the new
+    ``locate_kwargs``. They are used from the next frame on.
+
+    :param str topic: Topic on which the frames are broadcast
+    :param str publish_topic: Topic on which to publish the locations
+    :param int port: Port on which the frames are published, defaults to the port of the experimentor publisher
+    :param dict locate_kwargs: Arguments passed to :func:`locate_records`, must include the diameter
+    :param int hwm: High-water mark of the subscriber socket
+    :param missed_frames: ``multiprocessing.Value`` to which the frames that never arrived are added
+    :param int workers: Processes locating frames in parallel, ``None`` for one per core. With ``1`` the frames are
+        located by this process
+    :param int max_pending: Frames being located at the same time. By default twice the number of workers, or the
+        number of workers with ``LATEST_FRAME``
+    :param str mode: :data:`EVERY_FRAME` or :data:`LATEST_FRAME`
+    :param processed: ``multiprocessing.Value`` to which the frames whose locations were published are added
+    :param skipped: ``multiprocessing.Value`` to which the frames skipped with ``LATEST_FRAME`` are added
+    """
+    def __init__(self, topic, publish_topic='locations', port=None, locate_kwargs=None, hwm=None, missed_frames=None,
+                 workers=1, max_pending=None, mode=EVERY_FRAME, processed=None, skipped=None):
+        if mode not in MODES:
+            raise ValueError('Mode must be one of {}, not {}'.format(MODES, mode))
+        super().__init__()
+        self.topic = topic
+        self.publish_topic = publish_topic
+        self.port = port
+        self.locate_kwargs = locate_kwargs or {}
+        self.hwm = hwm
+        self.missed_frames = missed_frames
+        self.workers = workers
+        self.max_pending = max_pending
+        self.mode = mode
+        self.processed = processed
+        self.skipped = skipped
+
+    def run(self):
+        logger = get_logger(name=__name__)
+        logger.info('Starting localization of frames on topic {}'.format(self.topic))
+        context = zmq.Context()
+        socket = subscribe(context, self.topic, self.port, self.hwm)
+        socket.setsockopt(zmq.SUBSCRIBE, CONTROL_TOPIC.encode('ascii'))
+        gaps = GapDetector(self.missed_frames, 'localization')
+        pusher = Pusher()
+        executor = None
+        if self.workers != 1:
+            workers = self.workers or os.cpu_count()
+            executor = ProcessPoolExecutor(max_workers=workers)
+            max_pending = self.max_pending or (workers if self.mode == LATEST_FRAME else 2 * workers)
+            logger.info('Locating frames on {} processes'.format(workers))
+        pending = deque()  # Futures of the frames being located, in the order of the frames
+        while True:
+            if executor is not None:
+                self.publish_located(pusher, pending, max_pending)
+                if not socket.poll(50):
+                    continue
+            message = recv_header(socket)
+            gaps.update(*message[:2])
+            if control_requested(message[1], 'localization'):
+                self.update_parameters(message[1]['params'])
+                continue
+            if self.mode == LATEST_FRAME and not stop_requested(message[1], 'localization'):
+                message = self.skip_to_latest(socket, gaps, message)
+            topic, header, frame = read_frame(*message, consumer='localization')
+            if frame is None:
+                if not stop_requested(header, 'localization'):
+                    continue
+                logger.info('Got the signal to stop the localization')
+                break
+            if executor is None:
+                self.publish_locations(pusher, *locate_frame(header, frame, self.locate_kwargs))
+                continue
+            if 'shared_memory' in header:
+                frame = None  # The worker reads it from the shared buffer
+            pending.append(executor.submit(locate_frame, header, frame, self.locate_kwargs))
+        if executor is not None:
+            self.publish_located(pusher, pending, 0)
+            executor.shutdown()
+        socket.close()
+
+    def skip_to_latest(self, socket, gaps, message):
+        """ Receives every message already queued on ``socket`` and keeps the newest frame, or the first stop signal
+        for the localization. Only the headers are received, the frames left behind are never read from the shared
+        buffer: they are added to the ``skipped`` counter and not to the dropped frames, even if the acquisition
+        already overwrote them. The control messages found on the way are applied.
+
+        :param message: The last message received, as returned by ``recv_header``
+        """
+        skipped = 0
+        while socket.poll(0):
+            latest = recv_header(socket)
+            gaps.update(*latest[:2])
+            if control_requested(latest[1], 'localization'):
+                self.update_parameters(latest[1]['params'])
+                continue
+            stop = stop_requested(latest[1], 'localization')
+            if latest[1].get('stop', False) and not stop:
+                continue  # A stop for other consumers
+            if not message[1].get('stop', False):
+                skipped += 1
+            message = latest
+            if stop:
+                break
+        if skipped:
+            _add(self.skipped, skipped)
+        return message
+
+    def update_parameters(self, locate_kwargs):
+        """ Replaces the arguments of the localization. Frames already handed out to the workers are located with
+        the previous ones.
+        """
+        self.locate_kwargs = locate_kwargs
+        get_logger(name=__name__).info('Locating with {}'.format(locate_kwargs))
+
+    def publish_located(self, pusher, pending, max_pending):
+        """ Publishes the frames at the front of ``pending`` that were already located. While ``max_pending`` or more
+        frames are waiting, it waits for the oldest one.
+        """
+        while pending and (pending[0].done() or len(pending) >= max_pending):
+            self.publish_locations(pusher, *pending.popleft().result())
+
+    def publish_locations(self, pusher, header, locations):
+        if locations is None:
+            get_logger(name=__name__).debug('Frame {} was overwritten during the localization'.format(
+                header['frame_id']))
+            count_dropped(header, 'localization')
+            return
+        pusher.publish(to_wire(locations), self.publish_topic)
+        _add(self.processed, 1)
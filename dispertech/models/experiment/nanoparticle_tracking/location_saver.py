@@ -0,0 +1,185 @@
+"""
+    Location Saver
+    ==============
+    Stores the locations published by the
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.localization.LocalizationProcess` and the trajectories
+    published by the :class:`~dispertech.models.experiment.nanoparticle_tracking.linking.LinkingProcess` in an HDF5
+    file. Every session is a group named after the moment it started::
+
+        <session>/metadata     the configuration of the experiment, as a JSON string
+        <session>/locations    one record per location, see records.LOCATION_DTYPE
+        <session>/tracks       one record per location of a complete trajectory, see records.TRACK_DTYPE
+        <session>/drift        the drift of the sample subtracted from the trajectories, see records.DRIFT_DTYPE
+
+    The :class:`LocationSaver` is one more subscriber of the publisher, therefore it does not slow down the
+    localization: if it falls behind, its messages are queued by ZMQ and not by the localization. Records are kept in
+    memory and appended in batches of ``batch`` records, or every ``flush_interval`` seconds so that the file is never
+    far behind the measurement.
+
+    Messages published before the saving is stopped may still be on their way. Once the ``stop_event`` is set, the
+    saver keeps storing until an end of stream arrives on each of its topics, see
+    :data:`~dispertech.models.experiment.nanoparticle_tracking.transport.END_OF_STREAM`. The process that publishes
+    a topic sends it after its last message, e.g. the linking when it stops, therefore no trajectory is lost. If an
+    end of stream does not arrive within ``stop_timeout`` seconds, the saver stops anyway.
+"""
+import time
+from datetime import datetime
+from multiprocessing import Process
+
+import h5py
+import numpy as np
+import zmq
+
+from dispertech.models.experiment.nanoparticle_tracking.records import DRIFT_DTYPE, LOCATION_DTYPE, TRACK_DTYPE, \
+    as_records
+from dispertech.models.experiment.nanoparticle_tracking.transport import END_OF_STREAM, recv_object, subscribe
+from experimentor.config import settings
+from experimentor.lib.log import get_logger
+
+
+class RecordWriter:
+    """ Appends batches of records to an extendable 1-D dataset.
+
+    :param group: HDF5 group of the session
+    :param str name: Name of the dataset
+    :param dtype: Structured type of the records
+    :param int batch: Records kept in memory before writing, also the size of the chunks of the dataset
+    :param float flush_interval: Seconds after which the records in memory are written even if the batch is not
+        complete. ``None`` to only write complete batches
+    """
+    def __init__(self, group, name, dtype, batch=10000, flush_interval=None):
+        self.batch = max(batch, 1)
+        self.flush_interval = flush_interval
+        self.dset = group.create_dataset(name, (0,), maxshape=(None,), chunks=(self.batch,), dtype=dtype)
+        self.pending = []
+        self.length = 0  # Records in memory
+        self._last_flush = time.time()
+
+    def append(self, records):
+        if len(records):
+            self.pending.append(records)
+            self.length += len(records)
+        if self.length >= self.batch:
+            self.flush()
+
+    def flush_if_due(self):
+        """ Writes the records in memory if more than ``flush_interval`` seconds passed since the last write. """
+        if self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self.length:
+            return
+        start = self.dset.shape[0]
+        self.dset.resize((start + self.length,))
+        self.dset[start:] = np.concatenate(self.pending)
+        self.dset.flush()
+        self.pending = []
+        self.length = 0
+
+    def close(self):
+        self.flush()
+
+
+class LocationSaver(Process):
+    """ Process that subscribes to the locations and to the trajectories and appends them to a new session of
+    ``file_path``.
+
+    :param str file_path: HDF5 file, created if it does not exist
+    :param str meta: Configuration of the experiment, stored with the session
+    :param str topic: Topic on which the locations are published
+    :param str tracks_topic: Topic on which the trajectories are published, ``None`` to store only the locations
+    :param str drift_topic: Topic on which the drift is published, ``None`` to not store it
+    :param int port: Port of the publisher, defaults to the port of the experimentor publisher
+    :param int batch: Records kept in memory before writing to disk
+    :param float flush_interval: Seconds after which the records in memory are written anyway
+    :param stop_event: ``multiprocessing.Event`` that stops the saving, once the end of stream of every topic arrived
+    :param float stop_timeout: Seconds to wait for the end of stream of every topic once ``stop_event`` is set
+    """
+    def __init__(self, file_path, meta, topic='locations', tracks_topic='tracks', port=None, batch=10000,
+                 flush_interval=5, stop_event=None, drift_topic=None, stop_timeout=10):
+        super().__init__()
+        self.file_path = file_path
+        self.meta = meta
+        self.topic = topic
+        self.tracks_topic = tracks_topic
+        self.drift_topic = drift_topic
+        self.port = port or settings.PUBLISHER_PUBLISH_PORT
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.stop_event = stop_event
+        self.stop_timeout = stop_timeout
+
+    def run(self):
+        logger = get_logger(name=__name__)
+        logger.info('Saving the locations published on {} to {}'.format(self.topic, self.file_path))
+        context = zmq.Context()
+        socket = subscribe(context, self.topic, self.port)
+        if self.tracks_topic is not None:
+            socket.setsockopt(zmq.SUBSCRIBE, self.tracks_topic.encode('ascii'))
+        if self.drift_topic is not None:
+            socket.setsockopt(zmq.SUBSCRIBE, self.drift_topic.encode('ascii'))
+        with h5py.File(self.file_path, 'a') as f:
+            g = f.create_group(str(datetime.now()))
+            g.create_dataset('metadata', data=self.meta.encode('ascii', 'ignore'))
+            f.flush()
+            writers = {self.topic: RecordWriter(g, 'locations', LOCATION_DTYPE, self.batch, self.flush_interval)}
+            if self.tracks_topic is not None:
+                writers[self.tracks_topic] = RecordWriter(g, 'tracks', TRACK_DTYPE, self.batch, self.flush_interval)
+            if self.drift_topic is not None:
+                writers[self.drift_topic] = RecordWriter(g, 'drift', DRIFT_DTYPE, self.batch, self.flush_interval)
+            ended = set()  # Topics whose end of stream arrived after stopping
+            deadline = None
+            while len(ended) < len(writers):
+                if deadline is None and self.stop_event is not None and self.stop_event.is_set():
+                    deadline = time.time() + self.stop_timeout
+                if deadline is not None and time.time() > deadline:
+                    logger.warning('The end of {} did not arrive, the last records may be missing'.format(
+                        ', '.join(sorted(set(writers) - ended))))
+                    break
+                if socket.poll(100) and not self.store(socket, writers, ended):
+                    break
+                for writer in writers.values():
+                    writer.flush_if_due()
+            for writer in writers.values():
+                writer.close()
+            f.flush()
+            logger.info('Saved {} locations'.format(g['locations'].shape[0]))
+        socket.close()
+
+    def store(self, socket, writers, ended):
+        """ Receives a message and hands it to the writer of its topic. An end of stream received once the saving
+        is stopping is added to ``ended``, and what arrives later on that topic is not stored. Before stopping it is
+        ignored, the topic may be published again, e.g. by a new linking.
+
+        :return: ``False`` if the message was the signal to stop
+        """
+        topic, data = recv_object(socket)
+        if isinstance(data, str):
+            if data == END_OF_STREAM and self.stop_event is not None and self.stop_event.is_set():
+                ended.add(topic)
+            return data != settings.SUBSCRIBER_EXIT_KEYWORD
+        if topic in ended:
+            return True
+        if topic == self.topic:
+            writers[topic].append(as_records(data))
+        elif topic == self.drift_topic:
+            writers[topic].append(as_records(data, DRIFT_DTYPE))
+        elif topic in writers:
+            writers[topic].append(as_records(data, TRACK_DTYPE))
+        return True
+
+
+def read_locations(file_path, session=None, name='locations'):
+    """ Reads the records stored by a :class:`LocationSaver`.
+
+    :param str session: Name of the session group, by default the last one
+    :param str name: ``'locations'``, ``'tracks'`` or ``'drift'``
+    :return: Structured array, see :func:`~dispertech.models.experiment.nanoparticle_tracking.records.to_dataframe`
+        to convert it
+    """
+    with h5py.File(file_path, 'r') as f:
+        if session is None:
+            session = sorted(key for key in f if name in f[key])[-1]
+        return f[session][name][()]
@@ -1,22 +1,34 @@
 import importlib
 import json
 import os
-from multiprocessing import Queue, Event, Process
+from multiprocessing import Queue, Event, Process, Value
+from threading import Lock
 
-import h5py
 import numpy as np
 import time
-from datetime import datetime
 
 from dispertech.models.electronics.arduino import ArduinoModel
-from dispertech.models.experiment.nanoparticle_tracking import NO_CORRECTION
+from dispertech.models.experiment.nanoparticle_tracking import BACKGROUND_MODES, NO_CORRECTION
+from dispertech.models.experiment.nanoparticle_tracking.background import BackgroundCorrection
 from dispertech.models.experiment.nanoparticle_tracking.exceptions import StreamSavingRunning
-from dispertech.models.experiment.nanoparticle_tracking.localization import calculate_locations_image
-from dispertech.models.experiment.nanoparticle_tracking.saver import VideoSaver, worker_listener
+from dispertech.models.experiment.nanoparticle_tracking.frame_info import info_value
+from dispertech.models.experiment.nanoparticle_tracking.linking import LinkingProcess
+from dispertech.models.experiment.nanoparticle_tracking.localization import LocalizationProcess, EVERY_FRAME, \
+    LATEST_FRAME, MODES
+from dispertech.models.experiment.nanoparticle_tracking.location_saver import LocationSaver
+from dispertech.models.experiment.nanoparticle_tracking.preflight import check_saving, measure_write_speed
+from dispertech.models.experiment.nanoparticle_tracking.raw_stream import RawVideoSaver
+from dispertech.models.experiment.nanoparticle_tracking.records import DRIFT_DTYPE, as_records
+from dispertech.models.experiment.nanoparticle_tracking.ring_buffer import CONSUMERS, SharedFrameBuffer
+from dispertech.models.experiment.nanoparticle_tracking.saver import VideoSaver, check_writer_options, \
+    worker_listener, FRAME_MAJOR
+from dispertech.models.experiment.nanoparticle_tracking.sizing import SizeDistributionProcess
+from dispertech.models.experiment.nanoparticle_tracking.snapshots import write_snapshots
+from dispertech.models.experiment.nanoparticle_tracking.transport import END_OF_STREAM, FramePublisher, \
+    close_pusher
 from experimentor import general_stop_event
-from experimentor.config import settings
+from experimentor.core.pusher import Pusher
 from experimentor.core.signal import Signal
-from experimentor.core.subscriber import Subscriber
 from experimentor.models.decorators import make_async_thread
 from experimentor.models.experiments import Experiment
 
@@ -64,11 +76,38 @@ class NPTracking(Experiment):
         self._threads = []
         self._processes = []
         self._stop_free_run = [Event(), Event()]
+        self._stop_linking = Event()
+        self._stop_size_distribution = Event()
+        self._stop_saving_location = Event()
+        self.location_saver = None  # Stores the locations and trajectories, see start_saving_location
+        self._location_saving_started = None  # What start_saving_location started, undone when saving stops
+        self.sample_temperature = Value('d', float('nan'))  # Used by the size distribution, see broadcast_frames
+        self.size_distribution = None  # Last histogram of diameters, see start_size_distribution
+        self.drift = None  # Last drift of the sample, as a records.DRIFT_DTYPE record, see start_linking
 
         self.temp_locations = None
 
         self.fps = 0  # Calculates frames per second based on the number of frames received in a period of time
         self.saver = None
+        self.frame_publisher = None  # Broadcasts the frames of the free runs, see start_frame_publisher
+        self._publisher_lock = Lock()  # Both cameras may start the publisher at the same time
+        self.frame_ids = [0, 0]  # Consecutive number of the last frame broadcast by each camera
+        self.frame_buffers = [None, None]  # Shared memory in which the frames of each camera are written once
+        self._retired_buffers = [None, None]  # Buffers replaced after a change of shape, see get_frame_buffer
+        self.corrected_buffers = [None, None]  # Same as frame_buffers, for the frames without background
+        self._retired_corrected = [None, None]
+        self.background_corrections = [None, None]  # See get_background_correction
+        self.corrected_image = [None, None]  # Last frame without background, while the correction is enabled
+        self.localize_topic = None  # Topic of the frames being located, see tracking_topic
+        self._dropped_before = dict.fromkeys(CONSUMERS, 0)  # Frames dropped in buffers that were already released
+        # Frames that never reached each kind of consumer, counted by the consumers themselves
+        self.missed_frames = {consumer: Value('q', 0) for consumer in CONSUMERS}
+        self.tracking_mode = None  # EVERY_FRAME or LATEST_FRAME while tracking, see start_tracking
+        self.located_frames = Value('q', 0)  # Frames whose locations were published by the localization
+        self.skipped_frames = Value('q', 0)  # Frames the live localization skipped to catch up with the camera
+        self.disk_speeds = {}  # Write speed (MB/s) measured for every saving directory
+        self.saver_starting = False  # The preflight of start_saving is running, see start_saver
+        self._cancel_saving = Event()  # Set by stop_saving to not start a saver still in its preflight
 
     def configure_database(self):
         pass
@@ -112,6 +151,7 @@ class NPTracking(Experiment):
         self.load_cameras()
         self.load_electronics()
         self.electronics.monitor_temperature()
+        self.set_background_correction(self.config['tracking'].get('background', {}).get('method', NO_CORRECTION))
 
     def initialize_camera(self, cam_module, config: dict):
         """ Initializes the camera to be used to acquire data. The information on the camera should be provided in the
@@ -188,9 +228,12 @@ class NPTracking(Experiment):
         pass
 
     def save_data(self, cam: int):
-        """ Saves the last acquired image. The file to which it is going to be saved is defined in the config.
+        """ Saves the last acquired image. The file to which it is going to be saved is defined in the config. Images
+        are appended to the snapshots of the file, see
+        :mod:`~dispertech.models.experiment.nanoparticle_tracking.snapshots`. If ``saving.packed_12bit`` is enabled,
+        the image is stored with two pixels in three bytes.
         """
-        if self.temp_image[cam]:
+        if self.temp_image[cam] is not None:
             self.logger.info(f'Saving last acquired image of BaslerCamera {cam}')
             # Data will be appended to existing file
             file_name = self.config['saving']['filename_photo'] + '.hdf5'
@@ -199,12 +242,8 @@ class NPTracking(Experiment):
                 os.makedirs(file_dir)
                 self.logger.debug('Created directory {}'.format(file_dir))
 
-            with h5py.File(os.path.join(file_dir, file_name), "a") as f:
-                now = str(datetime.now())
-                g = f.create_group(now)
-                g.create_dataset('image', data=self.temp_image)
-                g.create_dataset('metadata', data=json.dumps(self.config))
-                f.flush()
+            write_snapshots(os.path.join(file_dir, file_name), self.temp_image[cam], self.config, cam,
+                            packed_12bit=self.config['saving'].get('packed_12bit', False))
             self.logger.debug('Saved image to {}'.format(os.path.join(file_dir, file_name)))
         else:
             self.logger.warning('Tried to save an image, but no image was acquired yet.')
@@ -252,6 +291,218 @@ class NPTracking(Experiment):
         camera._stop_free_run.set()
         camera.start_free_run()
         self.logger.debug(f'Started free run of camera {camera}')
+        if not self.free_run_running[cam]:
+            self._stop_free_run[cam].clear()
+            self.broadcast_frames(cam)
+
+    def start_frame_publisher(self):
+        """ Starts the publisher on which the frames of the free runs are broadcast as raw buffers. The port and the
+        high-water mark are taken from ``streaming.port`` and ``streaming.hwm`` in the config. It is safe to call from
+        several threads, only the first call binds the port.
+        """
+        with self._publisher_lock:
+            if self.frame_publisher is None:
+                port = self.config.get('streaming', {}).get('port', 5560)
+                self.frame_publisher = FramePublisher(port, self.config.get('streaming', {}).get('hwm', None))
+        return self.frame_publisher
+
+    def get_frame_buffer(self, cam: int, frame, corrected=False):
+        """ Returns the shared buffer in which the frames of the camera are written, creating it when the first frame
+        arrives or when the shape of the frames changes (e.g. after setting a new ROI). Consumers attach to it by name,
+        so adding one does not add a copy of every frame.
+
+        Returns ``None`` if ``streaming.shared_memory`` is disabled in the config, in which case the frames are sent
+        as raw buffers.
+
+        :param bool corrected: The buffer of the frames without background instead of the one of the raw frames
+        """
+        streaming = self.config.get('streaming', {})
+        if not streaming.get('shared_memory', True):
+            return None
+        buffers, retired = (self.corrected_buffers, self._retired_corrected) if corrected else \
+            (self.frame_buffers, self._retired_buffers)
+        buffer = buffers[cam]
+        if buffer is not None and buffer.fits(frame):
+            return buffer
+        if buffer is not None:
+            # Frames of the old shape may still be on their way to the consumers, the buffer is only released when
+            # the shape changes again
+            if retired[cam] is not None:
+                for consumer in CONSUMERS:
+                    self._dropped_before[consumer] += retired[cam].dropped_by(consumer)
+                retired[cam].close()
+            retired[cam] = buffer
+        buffers[cam] = SharedFrameBuffer(frame.shape, frame.dtype, streaming.get('ring_slots', 32))
+        return buffers[cam]
+
+    def dropped_by_consumer(self):
+        """ Frames lost by every kind of consumer, either because the acquisition overwrote them before they were
+        read, or because ZMQ discarded them when the queue of the consumer was full.
+
+        :return: Dictionary with the frames lost by each of ``ring_buffer.CONSUMERS``
+        """
+        buffers = [b for b in self.shared_buffers() if b is not None]
+        return {
+            consumer: self._dropped_before[consumer] + sum(b.dropped_by(consumer) for b in buffers) +
+            self.missed_frames[consumer].value
+            for consumer in CONSUMERS
+        }
+
+    def update_dropped_frames(self):
+        """ Frames lost by the consumer that lost the most of them, see :meth:`dropped_by_consumer`. A frame lost by
+        both the saver and the localization is counted once.
+        """
+        self.dropped_frames = max(self.dropped_by_consumer().values())
+        return self.dropped_frames
+
+    def shared_buffers(self):
+        return self.frame_buffers + self._retired_buffers + self.corrected_buffers + self._retired_corrected
+
+    def consumer_options(self, consumer):
+        """ Options shared by every process that subscribes to the frames: the high-water mark of its socket, from
+        ``streaming.hwm`` in the config, and the counter of missed frames of its kind.
+
+        :param str consumer: One of ``ring_buffer.CONSUMERS``
+        """
+        return {
+            'hwm': self.config.get('streaming', {}).get('hwm', None),
+            'missed_frames': self.missed_frames[consumer],
+        }
+
+    def connect_once(self, method, topic):
+        """ Connects ``method`` to ``topic`` unless it is already connected. The subscribers keep running after the
+        process that publishes on the topic stops, restarting it must not add a second subscriber that would call
+        ``method`` twice for every message.
+        """
+        if any(c['method'] == method.__name__ and c['topic'] == topic for c in self.connections):
+            return
+        self.connect(method, topic)
+
+    def frame_info(self, cam: int):
+        """ Conditions in which the frames of a camera are being acquired, broadcast with every frame and stored by
+        the savers. Only cached values are used, so that the acquisition does not wait for the devices.
+        """
+        camera = self.cameras[cam]
+        info = {
+            'exposure': info_value(camera.config['exposure'], 'ms'),
+            'gain': info_value(camera.config['gain']),
+            'roi': camera.config['ROI'],
+            'binning': (camera.config['binning_x'], camera.config['binning_y']),
+        }
+        if self.electronics is not None:
+            info.update({
+                'laser_power': info_value(self.electronics.scattering_laser),
+                'temperature_sample': info_value(self.electronics.temp_sample),
+                'temperature_electronics': info_value(self.electronics.temp_electronics),
+            })
+        return info
+
+    def frames_topic(self, cam: int = 1):
+        return f'{self.cameras[cam].id}_free_run'
+
+    def corrected_topic(self, cam: int = 1):
+        """ Topic of the frames without background. It does not start with :meth:`frames_topic`, otherwise the
+        subscribers to the raw frames would get them too.
+        """
+        return f'{self.cameras[cam].id}_corrected'
+
+    def tracking_topic(self, cam: int = 1):
+        """ Topic of the frames that are located: the ones without background while the correction is enabled. """
+        return self.corrected_topic(cam) if self.do_background_correction else self.frames_topic(cam)
+
+    def get_background_correction(self, cam: int):
+        """ Returns the background correction of a camera, created with the method selected and with the
+        ``window`` and ``statistic`` of ``tracking.background`` in the config.
+        """
+        if self.background_corrections[cam] is None:
+            background = self.config['tracking'].get('background', {})
+            self.background_corrections[cam] = BackgroundCorrection(self.background_method,
+                                                                    background.get('window', 10),
+                                                                    background.get('statistic', 'mean'))
+        return self.background_corrections[cam]
+
+    def set_background_correction(self, method):
+        """ Selects how the background is subtracted from the frames that are located and displayed. The raw
+        frames are still the ones that are saved. If the tracking is running, it is restarted on the right frames.
+
+        :param int method: One of the ``BACKGROUND_MODES``: ``NO_CORRECTION``, ``SNAP`` or ``ROLLING``
+        """
+        if method not in BACKGROUND_MODES:
+            raise ValueError('Unknown background correction {}'.format(method))
+        self.background_method = method
+        self.background_corrections = [None, None]  # Created again with the new method on the next frame
+        self.do_background_correction = method != NO_CORRECTION
+        if not self.do_background_correction:
+            self.corrected_image = [None, None]
+        self.logger.info('Background correction: {}'.format(BACKGROUND_MODES[method]))
+        if self.tracking and self.localize_topic != self.tracking_topic():
+            mode = self.tracking_mode
+            self.stop_localization()
+            self.start_tracking(mode)
+
+    def snap_background(self, cam: int = 1):
+        """ Takes the next frame as the background subtracted with ``SNAP``. """
+        self.get_background_correction(cam).snap()
+
+    def display_image(self, cam: int = 1):
+        """ Last frame to display: without background while the correction is enabled. """
+        if self.do_background_correction and self.corrected_image[cam] is not None:
+            return self.corrected_image[cam]
+        return self.temp_image[cam]
+
+    def publish_corrected(self, publisher, cam: int, frame, timestamp, info):
+        """ Subtracts the background from a frame and broadcasts it on :meth:`corrected_topic`. With shared memory,
+        the result is written directly into the slot of the buffer of corrected frames, and the localization and the
+        display read it from there.
+        """
+        correction = self.get_background_correction(cam)
+        topic = self.corrected_topic(cam)
+        buffer = self.get_frame_buffer(cam, frame, corrected=True)
+        if buffer is None:
+            self.corrected_image[cam] = correction.apply(frame)
+            publisher.publish(topic, self.corrected_image[cam], self.frame_ids[cam], timestamp, info)
+            return
+        seq, slot = buffer.reserve()
+        correction.apply(frame, out=slot)
+        buffer.commit(seq, timestamp)
+        publisher.publish_shared(topic, buffer, seq, self.frame_ids[cam], timestamp, info)
+        self.corrected_image[cam] = slot.copy()  # The slot is overwritten once the buffer wraps around
+
+    @make_async_thread
+    def broadcast_frames(self, cam: int):
+        """ Reads the camera while the free run is active and broadcasts every frame, together with its
+        consecutive number and the time of acquisition, to the savers and the localization. While the background
+        correction is enabled, every frame is also broadcast without background, see :meth:`publish_corrected`.
+        """
+        publisher = self.start_frame_publisher()
+        camera = self.cameras[cam]
+        topic = self.frames_topic(cam)
+        self.free_run_running[cam] = True
+        while not self._stop_free_run[cam].is_set() and not general_stop_event.is_set():
+            frames = camera.read_camera()
+            if not len(frames):
+                time.sleep(0.001)
+                continue
+            info = self.frame_info(cam)
+            if 'temperature_sample' in info:  # NaN until the first reading, the sizing then uses its default
+                self.sample_temperature.value = info['temperature_sample']
+            for frame in frames:
+                self.frame_ids[cam] += 1
+                now = time.time()
+                buffer = self.get_frame_buffer(cam, frame)
+                if buffer is None:
+                    publisher.publish(topic, frame, self.frame_ids[cam], now, info)
+                else:
+                    seq = buffer.write(frame, now)
+                    publisher.publish_shared(topic, buffer, seq, self.frame_ids[cam], now, info)
+                # The frame of the camera, not its slot in the buffer, which is overwritten once the buffer wraps
+                # around while the display or save_data may still use it
+                self.temp_image[cam] = frame
+                if self.do_background_correction:
+                    self.publish_corrected(publisher, cam, frame, now, info)
+            self.update_dropped_frames()
+        self.free_run_running[cam] = False
+        self.logger.debug(f'Stopped broadcasting frames of camera {cam}')
 
     def camera_high_sensitivity(self):
         """ Configures the camera looking at the fiber end to work in a pre-defined high-sensitivity mode. See the config
@@ -279,16 +530,20 @@ class NPTracking(Experiment):
 
     def stop_free_run(self, cam: int):
         self.logger.info(f'Setting the stop_event of camera {cam}')
+        self._stop_free_run[cam].set()
         self.cameras[cam].stop_free_run()
 
     def save_stream(self):
         """ Saves the queue to a file continuously. This is an async function, that can be triggered before starting
         the stream. It relies on the multiprocess library. It uses a queue in order to get the data to be saved.
         In normal operation, it should be used together with ``add_to_stream_queue``.
+
+        :raises ValueError: if the options in ``saving`` can not be used together
         """
         if self.save_stream_running:
             self.logger.warning('Tried to start a new instance of save stream')
             raise StreamSavingRunning('You tried to start a new process for stream saving')
+        options = self.checked_writer_options()
 
         self.logger.info('Starting to save the stream')
         file_name = self.config['saving']['filename_video'] + '.hdf5'
@@ -298,63 +553,374 @@ class NPTracking(Experiment):
             self.logger.debug('Created directory {}'.format(file_dir))
         file_path = os.path.join(file_dir, file_name)
         max_memory = self.config['saving']['max_memory']
+        port = self.start_frame_publisher().port
 
         self.stream_saving_process = Process(target=worker_listener,
-                                             args=(file_path, json.dumps(self.config), 'free_run'),
-                                             kwargs={'max_memory': max_memory})
+                                             args=(file_path, json.dumps(self.config), self.frames_topic()),
+                                             kwargs={'port': port, 'max_memory': max_memory,
+                                                     **self.consumer_options('saver'),
+                                                     **self.preflight_saving(options)})
         self.stream_saving_process.start()
+        self.save_stream_running = True
         self.logger.debug('Started the stream saving process')
 
+    def writer_options(self):
+        """ Options of the :func:`~dispertech.models.experiment.nanoparticle_tracking.saver.timelapse_writer` taken
+        from the ``saving`` section of the config.
+        """
+        saving = self.config['saving']
+        return {
+            'layout': saving.get('layout', FRAME_MAJOR),
+            'chunk_frames': saving.get('chunk_frames', 1),
+            'blocks': saving.get('write_blocks', 2),
+            'compression': saving.get('compression', 'gzip'),
+            'compression_level': saving.get('compression_level', 1),
+            'compression_threads': saving.get('compression_threads', None),
+            'packed_12bit': saving.get('packed_12bit', False),
+            'segment_size': saving.get('segment_size', None),
+            'segment_duration': saving.get('segment_duration', None),
+            'swmr': saving.get('swmr', False),
+            'flush_interval': saving.get('flush_interval', None),
+            'frame_rate': self.cameras[1].fps or None,
+        }
+
+    def checked_writer_options(self):
+        """ The :meth:`writer_options`, checked before a saver is started with them. An invalid combination would
+        only make the saver process fail after the recording seemed to start.
+
+        :raises ValueError: if the options can not be used together
+        """
+        options = self.writer_options()
+        try:
+            check_writer_options(**options)
+        except ValueError as e:
+            self.logger.error('Can not record with the options in saving: {}'.format(e))
+            raise
+        return options
+
+    def preflight_saving(self, options):
+        """ Checks, before a recording starts, that the disk and the processor keep up with the microscope camera.
+        See :mod:`~dispertech.models.experiment.nanoparticle_tracking.preflight`. The write speed of every folder is
+        measured only once.
+
+        If the configured codec can not keep up, a warning is logged and, with ``saving.auto_codec``, the codec is
+        replaced by one that can.
+
+        Parameters
+        ----------
+        options : dict
+            The output of :meth:`writer_options`
+
+        Returns
+        -------
+        dict
+            The options to use for the recording
+        """
+        saving = self.config['saving']
+        if not saving.get('preflight', True):
+            return options
+        frame = self.temp_image[1]
+        frame_rate = self.cameras[1].fps
+        if frame is None or not frame_rate:
+            self.logger.info('The microscope camera is not acquiring, skipping the saving preflight')
+            return options
+        directory = saving['directory']
+        if directory not in self.disk_speeds:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self.disk_speeds[directory] = measure_write_speed(directory, saving.get('preflight_size', 128))
+        disk_speed = self.disk_speeds[directory]
+
+        if saving.get('mode', 'hdf5') == 'raw':
+            required = frame.nbytes * frame_rate / 1024 / 1024
+            if required > disk_speed:
+                self.logger.warning(f'The camera produces {required:.1f}MB/s but {directory} only writes '
+                                    f'{disk_speed:.1f}MB/s, frames will be dropped')
+            return options
+
+        codec, report = check_saving(frame, frame_rate, disk_speed, options['compression'],
+                                     options['compression_level'], options['compression_threads'])
+        if codec == options['compression']:
+            return options
+        if codec is None:
+            self.logger.warning(f'No compression keeps up with the camera at {frame_rate:.1f}fps on {directory}, '
+                                f'frames will be dropped')
+            return options
+        if saving.get('auto_codec', False):
+            self.logger.warning(f'{options["compression"]} can not keep up with the camera, saving with {codec}')
+            options = {**options, 'compression': codec}
+        else:
+            self.logger.warning(f'{options["compression"]} can not keep up with the camera, {codec} would')
+        return options
+
     def stop_save_stream(self):
         """ Stops saving the stream.
         """
         if self.save_stream_running:
             self.logger.info('Stopping the saving stream process')
             self.saver_queue.put('Exit')
-            self.pusher.publish('free_run', 'stop')
+            self.frame_publisher.stop(self.frames_topic(), 'saver')
+            self.save_stream_running = False
             return
         self.logger.info('The saving stream is not running. Nothing will be done.')
 
-    def start_tracking(self):
+    def start_tracking(self, mode=LATEST_FRAME):
         """ Starts the tracking of the particles
+
+        :param str mode: ``LATEST_FRAME`` to locate only the newest frame available, enough for the live view, or
+            ``EVERY_FRAME`` to locate all the frames, needed to record the tracks. See
+            :class:`~dispertech.models.experiment.nanoparticle_tracking.localization.LocalizationProcess`
+        :raises ValueError: if ``mode`` is not one of them
         """
+        if mode not in MODES:
+            raise ValueError('Mode must be one of {}, not {}'.format(MODES, mode))
         if self.tracking:
             self.logger.warning("Tracking already running")
             self.stop_tracking()
             return
         self.tracking = True
-        id = self.cameras[1].id
-        self.logger.debug('Calculating positions with trackpy')
-        self.localize = Subscriber(calculate_locations_image, f"{id}_free_run", "locations", [], {'diameter': 11})
+        self.tracking_mode = mode
+        self.located_frames.value = 0
+        self.skipped_frames.value = 0
+        self.logger.debug('Calculating positions with {}'.format(
+            self.config['tracking']['locate'].get('locator', 'trackpy')))
+        port = self.start_frame_publisher().port
+        self.localize_topic = self.tracking_topic()
+        self.localize = LocalizationProcess(self.localize_topic, 'locations', port,
+                                            self.locate_options(),
+                                            workers=self.config['tracking'].get('workers', 1), mode=mode,
+                                            processed=self.located_frames, skipped=self.skipped_frames,
+                                            **self.consumer_options('localization'))
         self.localize.start()
-        self.connect(self.update_locations, 'locations')
+        self.connect_once(self.update_locations, 'locations')
+
+    def locate_options(self):
+        """ Arguments of the localization, with the region of the image in which particles are located. See
+        :func:`~dispertech.models.experiment.nanoparticle_tracking.localization.locate_records`.
+        """
+        options = dict(self.config['tracking']['locate'])
+        region = self.config['tracking'].get('region') or {}
+        for key in ('rows', 'mask', 'margin'):
+            if region.get(key) is not None:
+                options[key] = region[key]
+        return options
+
+    def set_tracking_rows(self, rows):
+        """ Restricts the localization to a band of rows of the image, e.g. the fiber core. A running localization
+        uses it from the next frame on.
+
+        :param rows: ``(first, last)`` rows of the band, ``last`` not included. ``'auto'`` to detect the band on every
+            frame, or ``None`` to use the whole image
+        """
+        if rows is not None and rows != 'auto':
+            rows = [int(rows[0]), int(rows[1])]
+        self.config['tracking'].setdefault('region', {})['rows'] = rows
+        self.logger.info('Localization restricted to the rows {}'.format(rows))
+        self.update_tracking_parameters()
+
+    def update_tracking_parameters(self):
+        """ Sends the parameters in ``tracking.locate``, ``tracking.region``, ``tracking.link`` and
+        ``tracking.filter`` of the config to the running localization and linking, that apply them from the next
+        frame on, without being restarted.
+        """
+        if self.frame_publisher is None:
+            return
+        if self.tracking:
+            self.frame_publisher.control('localization', self.locate_options())
+        if self.link_process_running:
+            tracking = self.config['tracking']
+            self.frame_publisher.control('linking', {
+                'search_range': tracking['link']['search_range'],
+                'memory': tracking['link']['memory'],
+                'min_length': tracking.get('filter', {}).get('min_length', 1),
+            })
 
     def update_locations(self, locations):
-        self.temp_locations = locations
+        """ Keeps the newest locations, as records (see
+        :mod:`~dispertech.models.experiment.nanoparticle_tracking.records`).
+        """
+        if isinstance(locations, str):  # e.g. the end of stream
+            return
+        self.temp_locations = as_records(locations)
+
+    def drift_window(self):
+        """ Frames over which the drift is averaged while linking, ``None`` unless ``tracking.process.compute_drift``
+        is set.
+        """
+        process = self.config['tracking']['process']
+        if not process.get('compute_drift', False):
+            return None
+        return process.get('drift_window', 100)
+
+    def update_drift(self, drift):
+        if isinstance(drift, str):
+            return
+        self.drift = as_records(drift, DRIFT_DTYPE)[0]
+
+    def tracking_stats(self):
+        """ Frames located and frames skipped by the live localization since the tracking started. """
+        return {'located': self.located_frames.value, 'skipped': self.skipped_frames.value}
 
     @make_async_thread
     def stop_tracking(self):
-        id = self.cameras[1].id
-        self.pusher.publish(settings.SUBSCRIBER_EXIT_KEYWORD, f"{id}_free_run")
+        self.stop_localization()
+
+    def stop_localization(self):
+        """ Stops the localization process and waits for it to finish. """
+        self.frame_publisher.stop(self.localize_topic, 'localization')
         while self.localize.is_alive():
             time.sleep(0.02)
-        self.logger.info('Tracking Stopped')
+        self.logger.info('Tracking Stopped, located {located} frames and skipped {skipped}'.format(
+            **self.tracking_stats()))
         self.tracking = False
+        self.tracking_mode = None
         self.temp_locations = None
 
-    def start_saving_location(self):
-        self.saving_location = True
+    def locate_every_frame(self):
+        """ Makes sure the tracking is running and locating every frame, as needed to save or link the locations.
+        If it was locating only the newest frames, it is restarted.
+        """
+        if self.tracking and self.tracking_mode != EVERY_FRAME:
+            self.logger.info('Restarting the tracking to locate every frame')
+            self.stop_localization()
+        if not self.tracking:
+            self.start_tracking(EVERY_FRAME)
+
+    def start_linking(self):
+        """ Links the locations into trajectories while they are calculated. Complete trajectories are published on
+        the ``tracks`` topic, see :mod:`~dispertech.models.experiment.nanoparticle_tracking.linking`. The parameters
+        are taken from ``tracking.link`` and ``tracking.filter.min_length`` in the config. With
+        ``tracking.process.compute_drift``, the drift is subtracted from the trajectories and published on the
+        ``drift`` topic.
+        """
+        if self.link_process_running:
+            self.logger.warning('The linking is already running')
+            return
+        self.locate_every_frame()
+        tracking = self.config['tracking']
+        self._stop_linking.clear()
+        self.link_particles_process = LinkingProcess('locations', 'tracks',
+                                                     search_range=tracking['link']['search_range'],
+                                                     memory=tracking['link']['memory'],
+                                                     min_length=tracking.get('filter', {}).get('min_length', 1),
+                                                     stop_event=self._stop_linking,
+                                                     control_port=self.start_frame_publisher().port,
+                                                     drift_window=self.drift_window())
+        self.link_particles_process.start()
+        self.link_process_running = True
+        if self.drift_window():
+            self.connect_once(self.update_drift, 'drift')
+
+    def stop_linking(self):
+        """ Stops the linking. The trajectories still active are published before the process ends. """
+        if not self.link_process_running:
+            return
+        self._stop_linking.set()
+        self.link_particles_process.join()
+        self.link_process_running = False
+        self.drift = None
+
+    def start_size_distribution(self):
+        """ Calculates the hydrodynamic diameter of the particles from the trajectories as they are completed, and
+        publishes the histogram of diameters on the ``size_distribution`` topic. The linking is started if needed.
+        See :mod:`~dispertech.models.experiment.nanoparticle_tracking.sizing` and ``tracking.process`` in the config.
+        """
+        if self.calculate_histogram_process is not None and self.calculate_histogram_process.is_alive():
+            self.logger.warning('The size distribution is already being calculated')
+            return
+        if not self.link_process_running:
+            self.start_linking()
+        process = self.config['tracking']['process']
+        self._stop_size_distribution.clear()
+        self.calculate_histogram_process = SizeDistributionProcess(
+            'tracks', 'size_distribution',
+            um_pixel=process['um_pixel'],
+            fps=process['fps'],
+            min_length=process.get('min_traj_length', 2),
+            max_lag=process.get('max_lag', 10),
+            bins=process.get('histogram_bins', 50),
+            max_diameter=process.get('max_diameter', 1000),
+            temperature=self.sample_temperature,
+            stop_event=self._stop_size_distribution)
+        self.calculate_histogram_process.start()
+        self.connect_once(self.update_size_distribution, 'size_distribution')
+
+    def update_size_distribution(self, histogram):
+        self.size_distribution = histogram
+
+    def stop_size_distribution(self):
+        if self.calculate_histogram_process is None:
+            return
+        self._stop_size_distribution.set()
+        self.calculate_histogram_process.join()
+        self.calculate_histogram_process = None
+
+    def start_saving_location(self, tracks=True):
+        """ Stores the locations, and the trajectories if ``tracks`` is ``True``, in the ``filename_tracks`` file of
+        the saving directory. See :mod:`~dispertech.models.experiment.nanoparticle_tracking.location_saver`.
+
+        The linking is started if needed, and the localization is switched to locate every frame. Both go back to
+        how they were when the saving stops, see :meth:`stop_saving_location`.
+        """
+        if self.saving_location:
+            self.logger.warning('The locations are already being saved')
+            return
         file_name = self.config['saving']['filename_tracks'] + '.hdf5'
         file_dir = self.config['saving']['directory']
         if not os.path.exists(file_dir):
             os.makedirs(file_dir)
             self.logger.debug('Created directory {}'.format(file_dir))
         file_path = os.path.join(file_dir, file_name)
-        self.location.start_saving(file_path, json.dumps(self.config))
+        self._stop_saving_location.clear()
+        self.location_saver = LocationSaver(file_path, json.dumps(self.config), 'locations',
+                                            'tracks' if tracks else None,
+                                            flush_interval=self.config['saving'].get('flush_interval', 5),
+                                            stop_event=self._stop_saving_location,
+                                            drift_topic='drift' if tracks and self.drift_window() else None)
+        self.location_saver.start()  # Before the localization, to not miss the first frames
+        self.saving_location = True
+        self._location_saving_started = {
+            'linking': tracks and not self.link_process_running,
+            'tracking_mode': self.tracking_mode,  # None if the tracking was not running
+        }
+        if tracks:
+            self.start_linking()
+        else:
+            self.locate_every_frame()
 
     def stop_saving_location(self):
+        """ Stops saving the locations. The linking, if it was started by :meth:`start_saving_location`, is stopped
+        so that the trajectories still active are stored too. It is kept while the size distribution uses it.
+        The localization goes back to the mode it had, or stops if it was not running.
+
+        The saver stores what arrives until the end of stream of each of its topics. The linking sends it when it
+        stops, after its last trajectories. For the topics that keep being published it is sent from here.
+        """
+        if not self.saving_location:
+            return
+        started = self._location_saving_started
+        self._stop_saving_location.set()
+        topics = {self.location_saver.topic, self.location_saver.tracks_topic, self.location_saver.drift_topic}
+        topics.discard(None)
+        if started['linking'] and self.link_process_running and self.calculate_histogram_process is None:
+            linking = self.link_particles_process
+            self.stop_linking()
+            topics.discard(linking.publish_topic)
+            if linking.drift_window:
+                topics.discard(linking.drift_topic)
+        pusher = Pusher()
+        for topic in topics:
+            pusher.publish(END_OF_STREAM, topic)
+        close_pusher(pusher)
+        self.location_saver.join()
+        self.location_saver = None
         self.saving_location = False
-        self.location.stop_saving()
+        self._location_saving_started = None
+        if self.link_process_running or not self.tracking or self.tracking_mode == started['tracking_mode']:
+            return
+        self.stop_localization()
+        if started['tracking_mode'] is not None:
+            self.start_tracking(started['tracking_mode'])
 
     def empty_saver_queue(self):
         """ Empties the queue where the data from the movie is being stored.
@@ -400,24 +966,66 @@ class NPTracking(Experiment):
         self.pusher.publish('waterfall_data', wf)
 
     def start_saving(self):
-        if self.saver and self.saver.is_alive():
+        """ Starts saving the frames of the microscope camera. With ``saving.mode: raw`` the frames are appended to a
+        raw stream, that can be compacted into HDF5 after the measurement, instead of being compressed on the fly.
+
+        The options are checked right away, the preflight and the start of the saver run on a thread, see
+        :meth:`start_saver`, therefore this method returns immediately, e.g. to the GUI.
+
+        :raises ValueError: if the options in ``saving`` can not be used together
+        """
+        if self.saver_starting or (self.saver and self.saver.is_alive()):
             self.logger.warning('Traing to start the saver again')
             return
+        if self.config['saving'].get('mode', 'hdf5') == 'raw':
+            options = self.writer_options()
+        else:
+            options = self.checked_writer_options()
+        self._cancel_saving.clear()
+        self.saver_starting = True
+        self.start_saver(options)
+
+    @make_async_thread
+    def start_saver(self, options):
+        """ Runs the preflight of the saving and starts the saver. The preflight measures the disk the first time a
+        directory is used, and the codecs, which takes a few seconds. If :meth:`stop_saving` is called in the
+        meantime, the saver is not started.
+
+        :param dict options: The output of :meth:`checked_writer_options`
+        """
+        try:
+            options = self.preflight_saving(options)
+            if self._cancel_saving.is_set():
+                self.logger.info('The saving was stopped before the saver started')
+                return
+            self.saver = self.create_saver(options)
+            self.saver.start()
+        finally:
+            self.saver_starting = False
+
+    def create_saver(self, options):
+        """ The saver of the frames of the microscope camera, for ``saving.mode``. """
         file_path = os.path.join(self.config['saving']['directory'], self.config['saving']['filename_video'])
         meta = json.dumps(self.config)
-        topic = f'{self.cameras[1].id}_free_run'
+        topic = self.frames_topic()
         max_memory = self.config['saving']['max_memory']
-        self.saver = VideoSaver(file_path, meta, topic, max_memory)
-        self.saver.start()
+        port = self.start_frame_publisher().port
+        if self.config['saving'].get('mode', 'hdf5') == 'raw':
+            preallocate = self.config['saving'].get('raw_preallocate', 2000)
+            return RawVideoSaver(file_path, meta, topic, port=port, preallocate=preallocate,
+                                 **self.consumer_options('saver'))
+        return VideoSaver(file_path, meta, topic, max_memory, port=port, **self.consumer_options('saver'), **options)
 
     def stop_saving(self):
-        self.pusher.publish(settings.SUBSCRIBER_EXIT_KEYWORD, f'{self.cameras[1].id}_free_run')
+        self._cancel_saving.set()
+        if self.frame_publisher is not None:
+            self.frame_publisher.stop(self.frames_topic(), 'saver')
 
     def servo_off(self):
         """ Move the servo to block the beam. To avoid problems, first put the laser to 0 power.
         This can generate problems later on, since we can lose track of the power (for ex. on the GUI).
         """
-        self.electronics.laser_power(0)
+        self.electronics.scattering_laser = 0
         self.servo.move_servo(0)
 
     def servo_on(self):
@@ -442,10 +1050,27 @@ class NPTracking(Experiment):
             self.stop_saving()
         except Exception as e:
             self.logger.error(e)
+        try:
+            self.stop_size_distribution()
+        except Exception as e:
+            self.logger.error(e)
+        try:
+            self.stop_linking()
+        except Exception as e:
+            self.logger.error(e)
+        try:
+            self.stop_saving_location()
+        except Exception as e:
+            self.logger.error(e)
         try:
             self.electronics.finalize()
         except Exception as e:
             self.logger.error(e)
+        if self.frame_publisher is not None:
+            self.frame_publisher.close()
+        for buffer in self.shared_buffers():
+            if buffer is not None:
+                buffer.close()
         super().finalize()
 
     def __str__(self):
@@ -0,0 +1,74 @@
+"""
+    12-bit Packing
+    ==============
+    The cameras run in ``Mono12``, but frames arrive as ``uint16`` arrays, so a quarter of every byte written to disk
+    is padding. Packing stores two pixels in three bytes::
+
+        byte 0: bits 0-7 of pixel a
+        byte 1: bits 8-11 of pixel a, bits 0-3 of pixel b
+        byte 2: bits 4-11 of pixel b
+
+    Packed datasets are ``uint8``, with one row of ``ceil(pixels / 2) * 3`` bytes per frame, and carry the attributes
+    ``encoding`` and ``frame_shape`` needed to unpack them. Packing and unpacking are vectorized over all the frames
+    given at once.
+"""
+import numpy as np
+
+PACKED_12BIT = 'mono12_packed'
+
+
+def packed_length(pixels):
+    """ Number of bytes needed to store ``pixels`` 12-bit values. """
+    return (pixels + 1) // 2 * 3
+
+
+def pack_12bit(frames):
+    """ Packs 12-bit values stored as ``uint16``. Values above 4095 lose their upper bits.
+
+    :param np.ndarray frames: A single frame, or frames stacked on the first axis
+    :return: ``uint8`` array of shape ``(packed_length,)`` for a frame, or ``(N, packed_length)`` for a stack
+    """
+    single = frames.ndim == 2
+    frames = frames.reshape(1 if single else frames.shape[0], -1)
+    if frames.shape[1] % 2:
+        frames = np.pad(frames, ((0, 0), (0, 1)))
+    a = frames[:, 0::2].astype(np.uint16)
+    b = frames[:, 1::2].astype(np.uint16)
+    packed = np.empty((frames.shape[0], frames.shape[1] // 2, 3), dtype=np.uint8)
+    packed[..., 0] = a & 0xFF
+    packed[..., 1] = ((a >> 8) & 0x0F) | ((b & 0x0F) << 4)
+    packed[..., 2] = (b >> 4) & 0xFF
+    packed = packed.reshape(frames.shape[0], -1)
+    return packed[0] if single else packed
+
+
+def unpack_12bit(packed, frame_shape):
+    """ Inverse of :func:`pack_12bit`.
+
+    :param np.ndarray packed: A single packed frame, or packed frames stacked on the first axis
+    :param tuple frame_shape: Shape of the original frames
+    :return: ``uint16`` array with the frame, or the frames stacked on the first axis
+    """
+    single = packed.ndim == 1
+    packed = packed.reshape(1 if single else packed.shape[0], -1, 3).astype(np.uint16)
+    frames = np.empty((packed.shape[0], packed.shape[1] * 2), dtype=np.uint16)
+    frames[:, 0::2] = packed[..., 0] | ((packed[..., 1] & 0x0F) << 8)
+    frames[:, 1::2] = (packed[..., 1] >> 4) | (packed[..., 2] << 4)
+    pixels = int(np.prod(frame_shape))
+    frames = frames[:, :pixels].reshape(-1, *frame_shape)
+    return frames[0] if single else frames
+
+
+def write_packed(group, name, frame):
+    """ Stores a single frame packed in a new dataset of ``group``. """
+    dset = group.create_dataset(name, data=pack_12bit(frame))
+    dset.attrs['encoding'] = PACKED_12BIT
+    dset.attrs['frame_shape'] = frame.shape
+    return dset
+
+
+def is_packed(dset):
+    encoding = dset.attrs.get('encoding', '')
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode('ascii')
+    return encoding == PACKED_12BIT
@@ -0,0 +1,73 @@
+"""
+    Saving Preflight
+    ================
+    Before a recording starts, :func:`check_saving` compares the data rate of the camera with what the machine can
+    sustain: the write speed of the destination folder, measured with :func:`measure_write_speed`, and the speed and
+    ratio of the compression codecs on the last frame acquired, measured with
+    :func:`~dispertech.models.experiment.nanoparticle_tracking.compression.throughput_report`.
+
+    A codec can keep up if it compresses faster than the camera produces data and if the compressed data can be
+    written faster than it is produced, both with some ``margin``. If the configured codec can not keep up, the
+    check returns the codec with the best compression ratio among those that can.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.compression import throughput_report
+from experimentor.lib.log import get_logger
+
+
+def measure_write_speed(directory, megabytes=128, block_megabytes=8):
+    """ Measures the sustained write speed of a folder by writing a temporary file and waiting until it is on disk.
+
+    :param str directory: Folder in which the recordings will be stored
+    :param int megabytes: Size of the temporary file. It has to be large enough not to fit in the cache of the disk
+    :param int block_megabytes: Size of every write
+    :return: The speed in MB/s
+    """
+    block = np.random.randint(0, 256, block_megabytes * 1024 * 1024, dtype=np.uint8).tobytes()
+    blocks = max(int(megabytes / block_megabytes), 1)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.preflight')
+    try:
+        t0 = time.perf_counter()
+        for _ in range(blocks):
+            os.write(fd, block)
+        os.fsync(fd)
+        elapsed = time.perf_counter() - t0
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return blocks * block_megabytes / elapsed
+
+
+def check_saving(frame, frame_rate, disk_speed, compression='gzip', compression_level=1, compression_threads=None,
+                 margin=1.2, frames=20):
+    """ Checks whether the frames can be compressed and written as fast as they are acquired.
+
+    :param np.ndarray frame: A frame representative of the recording
+    :param float frame_rate: Frames per second of the camera
+    :param float disk_speed: Write speed of the destination in MB/s, see :func:`measure_write_speed`
+    :param str compression: The codec configured for saving
+    :param float margin: Factor by which the machine has to be faster than the camera
+    :param int frames: Number of copies of ``frame`` used to measure the codecs
+    :return: ``(codec, report)``. ``codec`` is ``compression`` if it keeps up, the best codec that keeps up
+        otherwise, or ``None`` if none does. ``report`` is the output of ``throughput_report`` with the data rate
+        written to disk by every codec in ``disk_rate``
+    """
+    logger = get_logger(name=__name__)
+    required = frame.nbytes * frame_rate / 1024 / 1024
+    report = throughput_report(np.stack([frame] * frames), level=compression_level, threads=compression_threads)
+    feasible = []
+    for row in report:
+        row['disk_rate'] = required / row['ratio']
+        if row['throughput'] >= required * margin and row['disk_rate'] * margin <= disk_speed:
+            feasible.append(row)
+    logger.info('Camera produces {:.1f}MB/s, the disk writes {:.1f}MB/s'.format(required, disk_speed))
+    if any(row['codec'] == compression for row in feasible):
+        return compression, report
+    if not feasible:
+        return None, report
+    return max(feasible, key=lambda row: row['ratio'])['codec'], report
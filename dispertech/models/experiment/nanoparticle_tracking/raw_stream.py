@@ -0,0 +1,180 @@
+"""
+    Raw Streams
+    ===========
+    For bursts at the full rate of the camera, frames can be appended to a preallocated, memory-mapped binary file
+    instead of an HDF5 file. Nothing is compressed and h5py is not involved, writing a frame is a copy into the page
+    cache. Every recording is made of three files:
+
+        * ``<name>.raw``: the bytes of the frames, one after the other
+        * ``<name>.idx``: one record per frame with its offset in the raw file, its shape and the information of the
+          frame (id, timestamp, exposure, etc.)
+        * ``<name>.json``: the data type, the metadata of the session and the number of frames
+
+    Raw recordings are meant to be temporary. They are converted to the normal HDF5 layout, with compression and the
+    metadata that :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.VideoSaver` stores, with::
+
+        python -m dispertech.models.experiment.nanoparticle_tracking.recordings compact movie.raw
+"""
+import json
+import os
+from datetime import datetime
+from multiprocessing import Process
+
+import numpy as np
+import zmq
+
+from dispertech.models.experiment.nanoparticle_tracking.frame_info import FRAME_INFO_DTYPE, info_record
+from dispertech.models.experiment.nanoparticle_tracking.transport import GapDetector, frame_valid, recv_frame, \
+    stop_requested, subscribe
+from experimentor.lib.log import get_logger
+
+INDEX_DTYPE = np.dtype(FRAME_INFO_DTYPE.descr + [
+    ('offset', np.int64),
+    ('height', np.int32),
+    ('width', np.int32),
+])
+
+
+def raw_paths(file_path):
+    """ Paths of the data, index and header files of a raw recording. ``file_path`` can have any extension. """
+    base = os.path.splitext(file_path)[0]
+    return base + '.raw', base + '.idx', base + '.json'
+
+
+class RawStreamWriter:
+    """ Appends frames to a memory-mapped file that grows in steps of ``preallocate`` megabytes.
+
+    :param str file_path: Base path of the recording, see :func:`raw_paths`
+    :param str meta: Metadata of the session, kept as a string like in the HDF5 files
+    :param int preallocate: Size (in MB) reserved on disk every time the data file is full
+    """
+    def __init__(self, file_path, meta='', preallocate=2000):
+        self.logger = get_logger(name=__name__)
+        self.data_path, self.index_path, self.header_path = raw_paths(file_path)
+        self.meta = meta
+        self.step = int(preallocate * 1024 * 1024)
+        self.capacity = 0
+        self.offset = 0
+        self.frames = 0
+        self.dtype = None
+        self.data = None
+        self._data_file = open(self.data_path, 'w+b')
+        self._index_file = open(self.index_path, 'wb')
+        self.started = str(datetime.now())
+        self._grow(self.step)
+
+    def _grow(self, size):
+        self.data = None  # Releases the previous map before resizing the file
+        self.capacity += max(size, self.step)
+        self._data_file.truncate(self.capacity)
+        self.data = np.memmap(self._data_file, dtype=np.uint8, mode='r+', shape=(self.capacity,))
+        self.logger.debug('Reserved {}MB for the raw stream'.format(self.capacity / 1024 / 1024))
+
+    def append(self, frame, header=None, valid=None):
+        """ Appends a frame.
+
+        :param dict header: Header with which the frame was received, its information is stored in the index
+        :param valid: Called once the frame has been copied to the file, the frame is discarded (and later
+            overwritten) if it returns ``False``, see
+            :meth:`~dispertech.models.experiment.nanoparticle_tracking.saver.TimelapseWriter.append`
+        :return: Whether the frame was kept
+        """
+        if self.dtype is None:
+            self.dtype = frame.dtype
+        if frame.dtype != self.dtype:
+            raise ValueError('All the frames of a raw stream must be {}, got {}'.format(self.dtype, frame.dtype))
+        if self.offset + frame.nbytes > self.capacity:
+            self._grow(frame.nbytes)
+        self.data[self.offset:self.offset + frame.nbytes] = np.ascontiguousarray(frame).view(np.uint8).ravel()
+        if valid is not None and not valid():
+            return False
+        record = np.zeros((), dtype=INDEX_DTYPE)
+        info = info_record(header or {})
+        for name in FRAME_INFO_DTYPE.names:
+            record[name] = info[name]
+        record['offset'] = self.offset
+        record['height'], record['width'] = frame.shape
+        self._index_file.write(record.tobytes())
+        self.offset += frame.nbytes
+        self.frames += 1
+        return True
+
+    def close(self):
+        """ Flushes the data, trims the unused space at the end of the data file and writes the header. """
+        self.data.flush()
+        self.data = None
+        self._data_file.truncate(self.offset)
+        self._data_file.close()
+        self._index_file.close()
+        header = {
+            'dtype': str(self.dtype) if self.dtype is not None else None,
+            'frames': self.frames,
+            'started': self.started,
+            'metadata': self.meta,
+        }
+        with open(self.header_path, 'w') as f:
+            json.dump(header, f)
+        self.logger.info('Stored {} frames in {}'.format(self.frames, self.data_path))
+
+
+class RawVideoSaver(Process):
+    """ Same as :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.VideoSaver`, but appending the frames
+    to a raw stream.
+
+    :param int port: Port, or full address, on which the frames are published
+    :param int preallocate: Size (in MB) reserved on disk at once
+    :param int hwm: High-water mark of the subscriber socket
+    :param missed_frames: ``multiprocessing.Value`` to which the frames that never arrived are added
+    """
+    def __init__(self, file_path, meta, topic, port=None, preallocate=2000, hwm=None, missed_frames=None):
+        super().__init__()
+        self.logger = get_logger(name=__name__)
+        self.file_path = file_path
+        self.meta = meta
+        self.topic = topic
+        self.port = port
+        self.preallocate = preallocate
+        self.hwm = hwm
+        self.missed_frames = missed_frames
+
+    def run(self):
+        context = zmq.Context()
+        socket = subscribe(context, self.topic, self.port, self.hwm)
+        gaps = GapDetector(self.missed_frames, 'saver')
+        writer = RawStreamWriter(self.file_path, self.meta, self.preallocate)
+        while True:
+            topic, header, data = recv_frame(socket, consumer='saver')
+            gaps.update(topic, header)
+            if data is None:
+                if not stop_requested(header, 'saver'):
+                    continue
+                self.logger.info('Got the signal to stop the saving')
+                break
+            if not writer.append(data, header, valid=lambda: frame_valid(header, 'saver')):
+                self.logger.warning('Frame {} was overwritten before it was saved'.format(header['frame_id']))
+        writer.close()
+        socket.close()
+
+
+def read_raw_header(file_path):
+    with open(raw_paths(file_path)[2], 'r') as f:
+        return json.load(f)
+
+
+def read_raw_index(file_path):
+    """ Returns the index of a raw recording as a structured array, see :data:`INDEX_DTYPE`. """
+    return np.fromfile(raw_paths(file_path)[1], dtype=INDEX_DTYPE)
+
+
+def iter_raw_frames(file_path):
+    """ Yields ``(record, frame)`` for every frame of a raw recording, ``frame`` being a view on the mapped file. """
+    header = read_raw_header(file_path)
+    index = read_raw_index(file_path)
+    if not len(index):
+        return
+    dtype = np.dtype(header['dtype'])
+    data = np.memmap(raw_paths(file_path)[0], dtype=np.uint8, mode='r')
+    for record in index:
+        shape = (int(record['height']), int(record['width']))
+        nbytes = shape[0] * shape[1] * dtype.itemsize
+        yield record, data[record['offset']:record['offset'] + nbytes].view(dtype).reshape(shape)
@@ -0,0 +1,333 @@
+"""
+    Recordings
+    ==========
+    Utilities to read back and maintain the HDF5 files produced by the savers in
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.saver`. Every session is stored as a group named after
+    the moment it started, holding a ``metadata`` string and a ``timelapse`` dataset.
+
+    The compression codecs available on this machine can be compared on frames of an existing recording with::
+
+        python -m dispertech.models.experiment.nanoparticle_tracking.recordings codecs movie.hdf5
+
+    Timelapses and snapshots stored packed (see :mod:`~dispertech.models.experiment.nanoparticle_tracking.packing`)
+    are unpacked transparently by :func:`read_frames`, :func:`read_frame` and :func:`read_image`.
+
+    The information stored for every frame (see :mod:`~dispertech.models.experiment.nanoparticle_tracking.frame_info`)
+    is read with :func:`read_frame_info`, and :func:`frames_between` finds the frames recorded in a period of time
+    without reading the timelapse.
+
+    Recordings made with ``swmr`` can be read while they are being written, :func:`follow_frames` yields the frames as
+    they reach the disk.
+
+    If the shape of the frames changed during a session (e.g. a new ROI), every shape has its own timelapse, see
+    :func:`list_timelapses`.
+
+    Raw streams (see :mod:`~dispertech.models.experiment.nanoparticle_tracking.raw_stream`) are compacted into HDF5
+    with::
+
+        python -m dispertech.models.experiment.nanoparticle_tracking.recordings compact movie.raw -o movie.hdf5
+
+    Older recordings stack frames on the last axis, ``(x, y, N)``. They can be rewritten to the frame-major layout,
+    in which ``timelapse[i]`` is the i-th frame, with::
+
+        python -m dispertech.models.experiment.nanoparticle_tracking.recordings convert movie.hdf5
+
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.compression import format_report, get_codec, throughput_report
+from dispertech.models.experiment.nanoparticle_tracking.frame_info import FRAME_INFO_DTYPE, FrameInfoWriter
+from dispertech.models.experiment.nanoparticle_tracking.packing import is_packed, unpack_12bit
+from dispertech.models.experiment.nanoparticle_tracking.raw_stream import iter_raw_frames, raw_paths, read_raw_header
+from dispertech.models.experiment.nanoparticle_tracking.saver import FRAME_MAJOR, LEGACY, ShapeSegmentedWriter
+from dispertech.models.experiment.nanoparticle_tracking.snapshots import SNAPSHOTS_GROUP
+from experimentor.lib.log import get_logger
+
+
+def get_layout(dset):
+    """ Returns the layout of a timelapse dataset. Datasets without a ``layout`` attribute were written before the
+    frame-major layout existed and are therefore legacy.
+    """
+    layout = dset.attrs.get('layout', LEGACY)
+    if isinstance(layout, bytes):
+        layout = layout.decode('ascii')
+    return layout
+
+
+def count_frames(dset):
+    """ Number of frames stored in a timelapse dataset, regardless of its layout. """
+    if get_layout(dset) == FRAME_MAJOR:
+        return dset.shape[0]
+    return dset.shape[-1]
+
+
+def read_frames(dset, start=0, stop=None):
+    """ Reads a range of frames from a timelapse dataset.
+
+    :param dset: The ``timelapse`` dataset
+    :param int start: First frame to read
+    :param int stop: Frame at which to stop (not included). If ``None``, reads until the end
+    :return: Array of shape ``(N, *frame.shape)``, independently of how the data was stored
+    """
+    if is_packed(dset):
+        return unpack_12bit(dset[start:stop], tuple(dset.attrs['frame_shape']))
+    if get_layout(dset) == FRAME_MAJOR:
+        return dset[start:stop]
+    return np.moveaxis(dset[..., start:stop], -1, 0)
+
+
+def read_frame(dset, index):
+    """ Reads a single frame from a timelapse dataset. """
+    if is_packed(dset):
+        return unpack_12bit(dset[index], tuple(dset.attrs['frame_shape']))
+    if get_layout(dset) == FRAME_MAJOR:
+        return dset[index]
+    return dset[..., index]
+
+
+def read_image(dset):
+    """ Reads a snapshot saved in its own group by older versions of :meth:`NPTracking.save_data
+    <dispertech.models.experiment.nanoparticle_tracking.np_tracking.NPTracking.save_data>`, unpacking it if needed.
+    Newer snapshots are read with :func:`~dispertech.models.experiment.nanoparticle_tracking.snapshots.read_snapshots`.
+    """
+    if is_packed(dset):
+        return unpack_12bit(dset[()], tuple(dset.attrs['frame_shape']))
+    return dset[()]
+
+
+def follow_frames(file_path, session=None, start=0, batch=100, poll_interval=0.5, timeout=10):
+    """ Yields the frames of a recording while it is being written, as soon as the saver flushes them. The saver must
+    be using ``swmr``, see :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.TimelapseWriter`.
+
+    With segmented recordings, every segment has to be followed on its own, the main file is only completed once the
+    recording ends.
+
+    :param str file_path: File that is being written
+    :param str session: Group of the session, by default the last one in the file
+    :param int start: First frame to yield
+    :param int batch: Maximum number of frames read at once
+    :param float poll_interval: Seconds between checks for new frames
+    :param float timeout: Seconds without new frames after which the recording is considered finished. It also limits
+        the time waiting for the saver to create the timelapse
+    :return: Generator of ``(index, frame)``
+    """
+    logger = get_logger(name=__name__)
+    f = None
+    waiting_since = time.time()
+    while f is None:
+        try:
+            f = h5py.File(file_path, 'r', libver='latest', swmr=True)
+        except OSError:  # The file does not exist yet, or it is not in SWMR mode
+            pass
+        if f is not None:
+            sessions = sorted(name for name, item in f.items()
+                              if isinstance(item, h5py.Group) and name != SNAPSHOTS_GROUP)
+            name = session or (sessions[-1] if sessions else None)
+            if name not in f or 'timelapse' not in f[name]:
+                f.close()
+                f = None
+        if f is None:
+            if time.time() - waiting_since > timeout:
+                logger.warning('{} has no timelapse that can be followed'.format(file_path))
+                return
+            time.sleep(poll_interval)
+
+    with f:
+        dset = f[name]['timelapse']
+        index = start
+        last_frame = time.time()
+        while True:
+            dset.refresh()
+            available = count_frames(dset)
+            if available > index:
+                stop = min(available, index + batch)
+                for frame in read_frames(dset, index, stop):
+                    yield index, frame
+                    index += 1
+                last_frame = time.time()
+            elif time.time() - last_frame > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+def list_timelapses(group):
+    """ Timelapses of a session, one for every shape the frames had, in the order they were recorded. Their first
+    frame in the session is in ``dset.parent.attrs['first_frame']``. Shapes stored in separate files because the
+    main file was being read in SWMR mode are not included.
+
+    :param group: The group of the session
+    :return: A list of datasets
+    """
+    timelapses = [group['timelapse']] if 'timelapse' in group else []
+    shapes = sorted((int(name.split('_')[-1]), name) for name in group if name.startswith('shape_'))
+    timelapses += [group[name]['timelapse'] for _, name in shapes if 'timelapse' in group[name]]
+    return timelapses
+
+
+def read_frame_info(group, start=0, stop=None):
+    """ Reads the information of a range of frames of a session.
+
+    :param group: The group of the session
+    :return: Structured array with the fields of
+        :data:`~dispertech.models.experiment.nanoparticle_tracking.frame_info.FRAME_INFO_DTYPE`. Fields missing in the
+        file (e.g. in recordings made before they were stored) are ``NaN``, or ``0`` for the frame id
+    """
+    frames = len(group['frame_id']) if 'frame_id' in group else count_frames(group['timelapse'])
+    stop = frames if stop is None else min(stop, frames)
+    info = np.zeros(max(stop - start, 0), dtype=FRAME_INFO_DTYPE)
+    for name in FRAME_INFO_DTYPE.names:
+        if name in group:
+            info[name] = group[name][start:stop]
+        elif name != 'frame_id':
+            info[name] = np.nan
+    return info
+
+
+def frames_between(group, t_start, t_stop):
+    """ Indices ``(start, stop)`` of the frames of a session acquired between two moments, to be used with
+    :func:`read_frames`.
+
+    :param float t_start: Seconds since the epoch
+    :param float t_stop: Seconds since the epoch, not included
+    """
+    timestamps = group['timestamp'][()]
+    return int(np.searchsorted(timestamps, t_start)), int(np.searchsorted(timestamps, t_stop))
+
+
+def _convert_group(group, g_out, codec, chunk_frames, block_frames):
+    """ Writes the contents of a session, or of one of its ``shape_<n>`` groups, to ``g_out``, see
+    :func:`convert_to_frame_major`.
+    """
+    logger = get_logger(name=__name__)
+    for key, item in group.items():
+        if isinstance(item, h5py.Group) and key.startswith('shape_'):
+            _convert_group(item, g_out.create_group(key), codec, chunk_frames, block_frames)
+            continue
+        if key != 'timelapse' or get_layout(item) == FRAME_MAJOR:
+            group.copy(item, g_out, name=key)
+            continue
+        logger.info('Converting {} of {}'.format(item.name, group.file.filename))
+        frame_shape = item.shape[:-1]
+        total = item.shape[-1]
+        dset = g_out.create_dataset('timelapse', (total, *frame_shape), maxshape=(None, *frame_shape),
+                                    chunks=(max(min(chunk_frames, total), 1), *frame_shape),
+                                    dtype=item.dtype, **codec.dataset_options())
+        dset.attrs['layout'] = FRAME_MAJOR
+        dset.attrs['compression'] = codec.name
+        step = block_frames or (item.chunks[-1] if item.chunks else chunk_frames)
+        for start in range(0, total, step):
+            dset[start:start + step] = np.moveaxis(item[..., start:start + step], -1, 0)
+    for key, value in group.attrs.items():
+        g_out.attrs[key] = value
+
+
+def convert_to_frame_major(file_path, output_path=None, chunk_frames=1, block_frames=None, compression='gzip',
+                           compression_level=1):
+    """ Copies a recording to a new file, rewriting the legacy timelapses with the frame-major layout. Timelapses of
+    the shapes that followed a change of ROI (the ``shape_<n>`` groups, see :func:`list_timelapses`) are converted as
+    well. Groups that are already frame-major and any other dataset (e.g. ``metadata``) are copied as they are.
+
+    :param str file_path: File to convert
+    :param str output_path: Where to write the converted file. Defaults to ``<name>_frame_major.hdf5``
+    :param int chunk_frames: Number of frames per chunk in the converted timelapse
+    :param int block_frames: Frames to read at once from the legacy dataset. Defaults to the chunk size along the
+        frame axis, so every legacy chunk is decompressed only once
+    :param str compression: Codec of the converted timelapse, one of
+        :data:`~dispertech.models.experiment.nanoparticle_tracking.compression.CODECS`
+    :param int compression_level: Compression level, its meaning depends on the codec
+    :return: The path to the converted file
+    """
+    logger = get_logger(name=__name__)
+    codec = get_codec(compression, compression_level)
+    if output_path is None:
+        base, ext = os.path.splitext(file_path)
+        output_path = base + '_frame_major' + (ext or '.hdf5')
+
+    with h5py.File(file_path, 'r') as f_in, h5py.File(output_path, 'w') as f_out:
+        for name, group in f_in.items():
+            if not isinstance(group, h5py.Group):
+                f_in.copy(group, f_out, name=name)
+                continue
+            _convert_group(group, f_out.create_group(name), codec, chunk_frames, block_frames)
+    logger.info('Converted {} to {}'.format(file_path, output_path))
+    return output_path
+
+
+def compact_raw(file_path, output_path=None, max_memory=200, remove=False, **writer_options):
+    """ Converts a raw stream into a session of an HDF5 file, as if it had been recorded by
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.VideoSaver`.
+
+    :param str file_path: Path to the raw stream, with or without extension
+    :param str output_path: HDF5 file to which the session is appended. Defaults to ``<name>.hdf5``
+    :param int max_memory: Memory (in MB) used while compressing
+    :param bool remove: Delete the raw files once the conversion finished
+    :param writer_options: Passed to the
+        :class:`~dispertech.models.experiment.nanoparticle_tracking.saver.ShapeSegmentedWriter`, e.g.
+        ``compression``
+    :return: The path to the HDF5 file
+    """
+    logger = get_logger(name=__name__)
+    if output_path is None:
+        output_path = os.path.splitext(file_path)[0] + '.hdf5'
+    header = read_raw_header(file_path)
+
+    with h5py.File(output_path, 'a') as f:
+        g = f.create_group(header['started'])
+        g.create_dataset('metadata', data=header['metadata'].encode('ascii', 'ignore'))
+        writer = ShapeSegmentedWriter(g, max_memory, **writer_options)
+        info = FrameInfoWriter(g)
+        for record, frame in iter_raw_frames(file_path):
+            writer.append(frame)
+            info.append_record(record)
+        writer.close()
+        info.close()
+        f.flush()
+    logger.info('Compacted {} frames of {} into {}'.format(header['frames'], file_path, output_path))
+
+    if remove:
+        for path in raw_paths(file_path):
+            os.remove(path)
+    return output_path
+
+
+def main():
+    parser = ArgumentParser(description='Tools for the recordings made with DisperPy')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='Rewrite legacy recordings with the frame-major layout')
+    convert.add_argument('file', help='Recording to convert')
+    convert.add_argument('-o', dest='output', required=False, help='Path of the converted file')
+    convert.add_argument('--chunk-frames', dest='chunk_frames', type=int, default=1, help='Frames per chunk')
+    convert.add_argument('--compression', dest='compression', default='gzip', help='Compression codec')
+    convert.add_argument('--level', dest='level', type=int, default=1, help='Compression level')
+    codecs = subparsers.add_parser('codecs', help='Compare the speed and ratio of the compression codecs')
+    codecs.add_argument('file', help='Recording from which to take the frames')
+    codecs.add_argument('--frames', dest='frames', type=int, default=100, help='Number of frames to compress')
+    codecs.add_argument('--level', dest='level', type=int, default=1, help='Compression level')
+    codecs.add_argument('--threads', dest='threads', type=int, default=None, help='Compression threads')
+    compact = subparsers.add_parser('compact', help='Convert a raw stream into an HDF5 recording')
+    compact.add_argument('file', help='Raw stream to convert')
+    compact.add_argument('-o', dest='output', required=False, help='HDF5 file to which the recording is appended')
+    compact.add_argument('--compression', dest='compression', default='gzip', help='Compression codec')
+    compact.add_argument('--remove', dest='remove', action='store_true', help='Delete the raw files afterwards')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print(convert_to_frame_major(args.file, args.output, chunk_frames=args.chunk_frames,
+                                     compression=args.compression, compression_level=args.level))
+    elif args.command == 'codecs':
+        with h5py.File(args.file, 'r') as f:
+            dset = next(g['timelapse'] for g in f.values() if isinstance(g, h5py.Group) and 'timelapse' in g)
+            frames = read_frames(dset, 0, args.frames)
+        print(format_report(throughput_report(frames, level=args.level, threads=args.threads)))
+    elif args.command == 'compact':
+        print(compact_raw(args.file, args.output, remove=args.remove, compression=args.compression))
+
+
+if __name__ == '__main__':
+    main()
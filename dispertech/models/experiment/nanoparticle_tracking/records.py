@@ -0,0 +1,86 @@
+"""
+    Location Records
+    ================
+    The localization carries the locations of every frame as a structured NumPy array, one compact record per
+    particle, instead of a DataFrame::
+
+        frame      int32    frame_id of the frame in which the particle was located
+        y, x       float32  position, in pixels
+        mass, size, ecc, signal, raw_mass, ep      float32, as returned by trackpy.locate
+
+    The experimentor ``Pusher`` sends arrays as a raw buffer with a header holding ``str(dtype)``, which can not be
+    parsed back for structured types. Records are therefore published with :func:`to_wire`, as opaque items of the
+    same size, and :func:`as_records` views the received buffer with :data:`LOCATION_DTYPE` again. Neither side
+    pickles or copies the locations.
+
+    Batches of several frames are just concatenated records. A DataFrame, as needed by trackpy to link the
+    locations, is built only on demand with :func:`to_dataframe`. Trajectories are stored with :data:`TRACK_DTYPE`,
+    the same fields and the ``particle`` assigned by the linking, and the drift of the sample with :data:`DRIFT_DTYPE`.
+"""
+import numpy as np
+import pandas as pd
+
+LOCATION_FIELDS = ('y', 'x', 'mass', 'size', 'ecc', 'signal', 'raw_mass', 'ep')
+
+LOCATION_DTYPE = np.dtype([('frame', np.int32)] + [(field, np.float32) for field in LOCATION_FIELDS])
+
+TRACK_DTYPE = np.dtype(LOCATION_DTYPE.descr + [('particle', np.int32)])  # Locations linked into trajectories
+
+DRIFT_DTYPE = np.dtype([('frame', np.int32), ('y', np.float32), ('x', np.float32)])  # Drift of the sample
+
+
+def empty_records(length=0):
+    return np.zeros(length, dtype=LOCATION_DTYPE)
+
+
+def to_records(locations, frame=0):
+    """ Converts the output of a locator into records.
+
+    :param locations: DataFrame with the columns of ``trackpy.locate``, or a 2D array with the columns in the order
+        of :data:`LOCATION_FIELDS`
+    :param int frame: Frame in which the particles were located
+    """
+    records = empty_records(len(locations))
+    records['frame'] = frame
+    if isinstance(locations, pd.DataFrame):
+        for field in LOCATION_FIELDS:
+            if field in locations:
+                records[field] = locations[field].to_numpy()
+    else:
+        for i, field in enumerate(LOCATION_FIELDS):
+            records[field] = locations[:, i]
+    return records
+
+
+def to_track_records(track):
+    """ Converts a trajectory, a DataFrame with the columns of the locations and ``particle``, into records with
+    :data:`TRACK_DTYPE`.
+    """
+    records = np.zeros(len(track), dtype=TRACK_DTYPE)
+    for field in TRACK_DTYPE.names:
+        if field in track:
+            records[field] = track[field].to_numpy()
+    return records
+
+
+def to_wire(records):
+    """ View of ``records`` that the experimentor ``Pusher`` sends as a raw buffer. """
+    return np.ascontiguousarray(records).view(np.dtype((np.void, records.dtype.itemsize)))
+
+
+def as_records(data, dtype=LOCATION_DTYPE):
+    """ View of a received buffer, or of an array returned by :func:`to_wire`, as records of ``dtype``. Records and
+    ``None`` are returned as they are.
+    """
+    if data is None or getattr(data, 'dtype', None) == dtype:
+        return data
+    return np.frombuffer(data, dtype=dtype)
+
+
+def to_dataframe(records, columns=None):
+    """ DataFrame with the records, e.g. to link them with trackpy.
+
+    :param columns: Fields to include, by default all of them
+    """
+    columns = columns or records.dtype.names
+    return pd.DataFrame({column: records[column] for column in columns}, columns=columns)
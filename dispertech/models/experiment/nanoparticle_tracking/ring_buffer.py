@@ -0,0 +1,183 @@
+"""
+    Shared Frame Buffer
+    ===================
+    Ring buffer in shared memory in which the acquisition writes every frame once. Consumers running in other
+    processes (the saver, the localization) attach to it by name and read the frames by sequence number, without
+    copying or serializing them.
+
+    The block of shared memory starts with a small header of 64-bit integers::
+
+        [last sequence written, dropped by the saver, dropped by the localization, sequence of slot 0, ...]
+
+    followed by the timestamps of every slot and the frames themselves. Sequence numbers start at 1. Before
+    overwriting a slot, the writer marks it with ``-1``, therefore a reader can always tell whether the frame it holds
+    is still the one it asked for.
+
+    A consumer that falls more than ``slots`` frames behind the acquisition finds its frames already overwritten. Every
+    kind of consumer in :data:`CONSUMERS` counts those frames in its own field of the header. Only the main process
+    of the consumer increments it, therefore no increment is lost, and a frame lost by both the saver and the
+    localization is not counted twice in :attr:`SharedFrameBuffer.dropped`.
+"""
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.exceptions import FrameOverwritten
+from experimentor.lib.log import get_logger
+
+CONSUMERS = ('saver', 'localization')  # Consumers with their own dropped counter
+_HEADER_FIELDS = 1 + len(CONSUMERS)  # Last sequence written and dropped frames of every consumer
+_attached = {}  # Buffers this process is attached to, by name
+_replaced = []  # Buffers no longer in use, detached as soon as none of their frames is referenced
+
+
+class SharedFrameBuffer:
+    """ Ring buffer of frames stored in shared memory.
+
+    :param tuple frame_shape: Shape of every frame
+    :param dtype: Data type of the frames
+    :param int slots: Number of frames the buffer can hold
+    :param str name: Name of an existing block of shared memory. If ``None``, a new block is created
+    """
+    def __init__(self, frame_shape, dtype, slots=32, name=None):
+        self.logger = get_logger(name=__name__)
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        header_bytes = (_HEADER_FIELDS + slots) * 8
+        timestamps_bytes = slots * 8
+        frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        size = header_bytes + timestamps_bytes + slots * frame_bytes
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.logger.info('Created a shared buffer of {} frames ({:.1f}MB)'.format(slots, size / 1024 / 1024))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        self._header = np.ndarray((_HEADER_FIELDS + slots,), dtype=np.int64, buffer=self.shm.buf)
+        self._timestamps = np.ndarray((slots,), dtype=np.float64, buffer=self.shm.buf, offset=header_bytes)
+        self.frames = np.ndarray((slots, *self.frame_shape), dtype=self.dtype, buffer=self.shm.buf,
+                                 offset=header_bytes + timestamps_bytes)
+        if self.owner:
+            self._header[:] = 0
+
+    @property
+    def description(self):
+        """ Everything another process needs to attach to this buffer, see :func:`attach`. """
+        return {'name': self.name, 'shape': self.frame_shape, 'dtype': str(self.dtype), 'slots': self.slots}
+
+    @property
+    def last_seq(self):
+        return int(self._header[0])
+
+    @property
+    def dropped(self):
+        """ Frames overwritten before the consumer that lost the most of them could read them. """
+        return max(self.dropped_by(consumer) for consumer in CONSUMERS)
+
+    def dropped_by(self, consumer):
+        return int(self._header[1 + CONSUMERS.index(consumer)])
+
+    def add_dropped(self, consumer, frames=1):
+        """ Counts frames that ``consumer`` found overwritten. Each kind of consumer must count from a single
+        process, e.g. not from the workers of the localization.
+        """
+        self._header[1 + CONSUMERS.index(consumer)] += frames
+
+    def fits(self, frame):
+        return frame.shape == self.frame_shape and frame.dtype == self.dtype
+
+    def write(self, frame, timestamp=0.):
+        """ Copies a frame into the next slot. Only the owner of the buffer should write to it.
+
+        :return: The sequence number of the frame
+        """
+        seq, slot = self.reserve()
+        slot[...] = frame
+        self.commit(seq, timestamp)
+        return seq
+
+    def reserve(self):
+        """ Marks the next slot as being written, so that a frame can be computed directly into it instead of being
+        copied, e.g. by the background correction. The frame is only available to the readers after :meth:`commit`.
+
+        :return: ``(seq, slot)``, the sequence number of the frame and a writable view of its slot
+        """
+        seq = self.last_seq + 1
+        self._header[_HEADER_FIELDS + seq % self.slots] = -1
+        return seq, self.frames[seq % self.slots]
+
+    def commit(self, seq, timestamp=0.):
+        """ Publishes the frame written to the slot returned by :meth:`reserve`. """
+        slot = seq % self.slots
+        self._timestamps[slot] = timestamp
+        self._header[_HEADER_FIELDS + slot] = seq
+        self._header[0] = seq
+
+    def is_valid(self, seq):
+        """ Whether the frame ``seq`` is still in the buffer. Readers that keep a view returned by :meth:`read` should
+        check it once they are done, the slot may have been overwritten in the meantime.
+        """
+        return self._header[_HEADER_FIELDS + seq % self.slots] == seq
+
+    def read(self, seq):
+        """ Returns a read-only view of the frame ``seq``.
+
+        :raises FrameOverwritten: if the consumer fell behind and the frame is no longer available. It is up to the
+            consumer to count it, see :meth:`add_dropped`
+        """
+        if seq > self.last_seq:
+            raise ValueError('Frame {} was not written yet, last frame is {}'.format(seq, self.last_seq))
+        if not self.is_valid(seq):
+            raise FrameOverwritten('Frame {} was overwritten, the consumer is too slow'.format(seq))
+        frame = self.frames[seq % self.slots]
+        frame.flags.writeable = False
+        return frame
+
+    @property
+    def in_use(self):
+        """ Whether a view returned by :meth:`read` is still referenced in this process. The memory can not be
+        detached until it is released, numpy does not keep the block mapped for its views.
+        """
+        return self.frames is not None and sys.getrefcount(self.frames) > 2  # The attribute and the argument
+
+    def timestamp(self, seq):
+        return float(self._timestamps[seq % self.slots])
+
+    def close(self):
+        """ Detaches from the buffer, and releases it if this process created it. """
+        self._header = self._timestamps = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        _attached.pop(self.name, None)
+
+
+def attach(description):
+    """ Returns the buffer described by ``description`` (see :attr:`SharedFrameBuffer.description`), attaching to it
+    the first time it is requested by this process.
+
+    A consumer reads the frames of a single buffer at a time. When the acquisition replaces it, e.g. after a change of
+    ROI, the frames arrive with the description of another block and the previous one is detached, otherwise the
+    memory of every retired buffer would stay mapped until the consumer ends.
+    """
+    name = description['name']
+    if name not in _attached:
+        _replaced.extend(_attached.values())
+        _attached.clear()
+        _attached[name] = SharedFrameBuffer(description['shape'], description['dtype'], description['slots'],
+                                            name=name)
+    if _replaced:
+        _detach_replaced()
+    return _attached[name]
+
+
+def _detach_replaced():
+    for buffer in list(_replaced):
+        if buffer.in_use:  # The consumer still holds one of its frames, e.g. the last frame it read
+            continue
+        buffer.close()
+        _replaced.remove(buffer)
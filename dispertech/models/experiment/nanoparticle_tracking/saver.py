@@ -27,90 +27,619 @@
 
     .. sectionauthor:: Aquiles Carattino <aquiles@uetke.com>
 """
+import os
+import re
+import time
 from multiprocessing import Process
+from queue import Queue
+from threading import Thread
 
 import zmq
 import h5py
 import numpy as np
 from datetime import datetime
 
+from dispertech.models.experiment.nanoparticle_tracking.compression import ChunkCompressor, get_codec
+from dispertech.models.experiment.nanoparticle_tracking.frame_info import FrameInfoWriter
+from dispertech.models.experiment.nanoparticle_tracking.packing import PACKED_12BIT, pack_12bit, packed_length
+from dispertech.models.experiment.nanoparticle_tracking.transport import GapDetector, frame_valid, recv_frame, \
+    stop_requested, subscribe
 from experimentor.config import settings
 from experimentor.lib.log import get_logger
 
 
+FRAME_MAJOR = 'frame_major'  # timelapse[i] is the i-th frame, shape (N, *frame.shape)
+LEGACY = 'legacy'  # frames stacked on the last axis, shape (*frame.shape, N)
+LAYOUTS = (FRAME_MAJOR, LEGACY)
+
+
+def check_writer_options(layout=FRAME_MAJOR, packed_12bit=False, **writer_options):
+    """ Checks that the options of a :class:`TimelapseWriter` can be used together, so that a saver process is not
+    started with options that make it fail right away.
+
+    :raises ValueError: with a message meant for the user
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('Layout must be one of {}, not {}'.format(LAYOUTS, layout))
+    if packed_12bit and layout != FRAME_MAJOR:
+        raise ValueError('Packed 12-bit frames can only be stored with the frame-major layout')
+
+
+class TimelapseWriter:
+    """ Accumulates frames in memory and streams them to the ``timelapse`` dataset of an HDF5 group. It holds the
+    logic shared by :class:`VideoSaver`, :func:`worker_listener` and :func:`worker_saver`.
+
+    With the default ``frame_major`` layout frames are stacked on the first axis and chunked every ``chunk_frames``
+    frames, so appending a frame or reading one back only touches its own chunk. The ``legacy`` layout keeps the
+    original ``(x, y, N)`` stacking for programs that still rely on it.
+
+    Frames are copied into one of ``blocks`` memory blocks. When a block is full it is handed to a writer thread that
+    compresses it and writes it to disk, while new frames keep arriving on the next block. Receiving frames only waits
+    if every block is still queued for writing.
+
+    With the frame-major layout, the chunks of every block are compressed on ``compression_threads`` threads and
+    written with ``write_direct_chunk``, see :mod:`~dispertech.models.experiment.nanoparticle_tracking.compression`.
+    The legacy layout leaves the compression to h5py.
+
+    Mono12 frames can be stored with ``packed_12bit``, two pixels in three bytes (see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.packing`). Packing happens on the writer thread, before
+    compressing, and is only available with the frame-major layout. Each row of the dataset is then a packed frame.
+
+    With ``swmr``, the file is switched to single-writer/multiple-reader mode as soon as the timelapse is created, and
+    other programs can read it while it is being written (see
+    :func:`~dispertech.models.experiment.nanoparticle_tracking.recordings.follow_frames`). The dataset is then grown
+    exactly to the frames written, and flushed after every block. ``flush_interval`` hands the block to the writer
+    thread every so many seconds even if it is not full, so that readers do not wait for a whole block.
+
+    If the ``frame_rate`` of the camera is known, blocks hold ``block_seconds`` of frames instead of using all of
+    ``max_memory``, which stays as the upper limit. The dataset is extended by the frames expected in the next
+    ``reserve_seconds``, according to the rate at which frames are actually arriving, instead of by a fixed number of
+    blocks. The frames reserved but not used are trimmed when the writer is closed.
+
+    :param group: HDF5 group in which the ``timelapse`` dataset will be created
+    :param int max_memory: Maximum memory (in MB) to allocate, split between all the blocks
+    :param str layout: Either ``'frame_major'`` or ``'legacy'``
+    :param int chunk_frames: Number of frames per chunk when using the frame-major layout
+    :param int blocks: Number of memory blocks, at least 2
+    :param str compression: Codec used to compress the chunks, one of ``none``, ``gzip``, ``lz4``, ``zstd``, ``blosc``
+    :param int compression_level: Compression level, its meaning depends on the codec
+    :param int compression_threads: Threads compressing chunks, ``None`` to decide based on the number of cores
+    :param bool packed_12bit: Store 12-bit frames packed instead of as ``uint16``
+    :param bool swmr: Make the file readable while it is being written. The file must have been opened with
+        ``libver='latest'``, see :func:`open_recording`
+    :param float flush_interval: Seconds after which the frames in memory are written even if the block is not full,
+        ``None`` to only write full blocks
+    :param float frame_rate: Expected frames per second, ``None`` if unknown
+    :param float block_seconds: Seconds of frames held by every block when the frame rate is known
+    :param float reserve_seconds: Seconds of frames reserved on disk every time the dataset is extended
+    """
+    def __init__(self, group, max_memory=500, layout=FRAME_MAJOR, chunk_frames=1, blocks=2, compression='gzip',
+                 compression_level=1, compression_threads=None, packed_12bit=False, swmr=False, flush_interval=None,
+                 frame_rate=None, block_seconds=5, reserve_seconds=10):
+        check_writer_options(layout, packed_12bit)
+        self.logger = get_logger(name=__name__)
+        self.group = group
+        self.max_memory = max_memory
+        self.layout = layout
+        self.chunk_frames = chunk_frames
+        self.blocks = max(blocks, 2)
+        self.packed_12bit = packed_12bit
+        self.swmr = swmr
+        self.flush_interval = flush_interval
+        self.frame_rate = frame_rate
+        self.block_seconds = block_seconds
+        self.reserve_seconds = reserve_seconds
+        self.codec = get_codec(compression, compression_level)
+        self.compressor = None
+        if layout == FRAME_MAJOR:
+            self.compressor = ChunkCompressor(self.codec, compression_threads)
+        self.dset = None
+        self.block = None
+        self.frame_shape = None
+        self.disk_shape = None  # Shape of each frame in the dataset
+        self.allocate = 0
+        self.i = 0  # Frames in the memory block
+        self.j = 0  # Frames already handed to the writer
+
+        self._free_blocks = Queue()
+        self._full_blocks = Queue()
+        self._writer = None
+        self._error = None
+        self._last_hand_off = time.time()
+        self._first_frame_time = None
+        self._received = 0
+
+    def _block_shape(self, frames):
+        if self.layout == FRAME_MAJOR:
+            return (frames, *self.frame_shape)
+        return (*self.frame_shape, frames)
+
+    def _dataset_shape(self, frames):
+        if self.layout == FRAME_MAJOR:
+            return (frames, *self.disk_shape)
+        return (*self.disk_shape, frames)
+
+    def _create_dataset(self, frame):
+        self.frame_shape = frame.shape
+        self.disk_shape = (packed_length(frame.size),) if self.packed_12bit else frame.shape
+        self.logger.debug('Image size: {}x{}'.format(*self.frame_shape))
+        self.allocate = max(int(self.max_memory / self.blocks / frame.nbytes * 1024 * 1024), 1)
+        if self.frame_rate:
+            self.allocate = min(self.allocate, max(int(np.ceil(self.frame_rate * self.block_seconds)), 1))
+        if self.layout == FRAME_MAJOR:
+            # Blocks hold complete chunks, so that they can be compressed independently
+            self.allocate = max(self.allocate // self.chunk_frames, 1) * self.chunk_frames
+        self.logger.debug('Allocating {:.1f}MB to stream to disk'.format(
+            self.blocks * self.allocate * frame.nbytes / 1024 / 1024))
+        self.logger.debug('Allocate {} blocks of {} frames'.format(self.blocks, self.allocate))
+        self.block = np.empty(self._block_shape(self.allocate), dtype=frame.dtype)
+        for _ in range(self.blocks - 1):
+            self._free_blocks.put(np.empty(self._block_shape(self.allocate), dtype=frame.dtype))
+        if self.layout == FRAME_MAJOR:
+            chunks = (self.chunk_frames, *self.disk_shape)
+            maxshape = (None, *self.disk_shape)
+        else:
+            chunks = True
+            maxshape = (*self.disk_shape, None)
+        dtype = np.uint8 if self.packed_12bit else frame.dtype
+        initial_frames = 0 if self.swmr else self.allocate
+        self.dset = self.group.create_dataset('timelapse', self._dataset_shape(initial_frames), maxshape=maxshape,
+                                              chunks=chunks, dtype=dtype, **self.codec.dataset_options())
+        self.dset.attrs['layout'] = self.layout
+        self.dset.attrs['compression'] = self.codec.name
+        if self.packed_12bit:
+            self.dset.attrs['encoding'] = PACKED_12BIT
+            self.dset.attrs['frame_shape'] = self.frame_shape
+        if self.swmr:
+            self._start_swmr()
+        self._writer = Thread(target=self._write_blocks, name='TimelapseWriter')
+        self._writer.start()
+
+    def _write(self, data, start):
+        if self.layout == FRAME_MAJOR:
+            if self.packed_12bit:
+                data = pack_12bit(data)
+            for i, chunk in enumerate(self.compressor.compress(data, self.chunk_frames)):
+                self.dset.id.write_direct_chunk((start + i * self.chunk_frames, *(0 for _ in self.disk_shape)), chunk)
+        else:
+            self.dset[..., start:start + data.shape[-1]] = data
+
+    def _start_swmr(self):
+        """ Switches the file to SWMR mode. No objects can be created in the file afterwards. """
+        try:
+            self.group.file.swmr_mode = True
+        except (RuntimeError, ValueError):
+            self.swmr = False
+            self.logger.warning('{} can not be read while recording, it was created with an older version of HDF5. '
+                                'Use a new file to follow the recording'.format(self.group.file.filename))
+
+    def measured_rate(self):
+        """ Rate at which frames arrived so far, or the expected ``frame_rate`` until there are enough frames. """
+        if self._received > 1:
+            elapsed = time.time() - self._first_frame_time
+            if elapsed > 0:
+                return (self._received - 1) / elapsed
+        return self.frame_rate
+
+    def _reserve(self, frames):
+        """ Grows the dataset to hold at least ``frames`` frames. Without SWMR, the frames expected in the next
+        ``reserve_seconds`` are reserved as well, so that the dataset is not resized for every block.
+        """
+        current = self.dset.shape[0] if self.layout == FRAME_MAJOR else self.dset.shape[-1]
+        if frames <= current:
+            return
+        if not self.swmr:
+            rate = self.measured_rate()
+            frames += int(np.ceil(rate * self.reserve_seconds)) if rate else self.allocate
+        self.logger.debug('Extending the timelapse to {} frames'.format(frames))
+        self.dset.resize(self._dataset_shape(frames))
+
+    def _write_blocks(self):
+        """ Runs on the writer thread. Writes the blocks in the order they were queued and hands them back to be
+        filled again.
+        """
+        while True:
+            item = self._full_blocks.get()
+            if item is None:
+                break
+            block, frames, start = item
+            if self._error is None:
+                try:
+                    self._reserve(start + frames)
+                    if self.layout == FRAME_MAJOR:
+                        self._write(block[:frames], start)
+                    else:
+                        self._write(block[..., :frames], start)
+                    if self.swmr:
+                        self.dset.flush()
+                except Exception as e:
+                    self.logger.exception('Error writing frames {} to {}'.format(start, start + frames))
+                    self._error = e
+            self._free_blocks.put(block)
+
+    def _check_writer(self):
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self, frames):
+        """ Hands the first ``frames`` frames of the current block to the writer thread, and continues on a free
+        block. Frames beyond those are copied to the new block.
+        """
+        self._check_writer()
+        self._full_blocks.put((self.block, frames, self.j))
+        self.j += frames
+        if self._free_blocks.empty():
+            self.logger.warning('All memory blocks are waiting to be written, the disk is not keeping up')
+        block = self._free_blocks.get()
+        remaining = self.i - frames
+        if remaining and self.layout == FRAME_MAJOR:
+            block[:remaining] = self.block[frames:self.i]
+        elif remaining:
+            block[..., :remaining] = self.block[..., frames:self.i]
+        self.block = block
+        self.i = remaining
+        self._last_hand_off = time.time()
+
+    def append(self, frame, valid=None):
+        """ Adds a frame to the current memory block, handing the block to the writer thread when it is full.
+
+        :param valid: Called once the frame has been copied to the block, the frame is discarded if it returns
+            ``False``. Used for frames read from a shared buffer that may be overwritten while they are copied, see
+            :func:`~dispertech.models.experiment.nanoparticle_tracking.transport.frame_valid`
+        :return: Whether the frame was kept
+        """
+        if self.dset is None:
+            self._create_dataset(frame)
+            self._first_frame_time = time.time()
+        elif self.i == self.allocate:
+            self._hand_off(self.i)
+        if self.layout == FRAME_MAJOR:
+            self.block[self.i] = frame
+        else:
+            self.block[..., self.i] = frame
+        if valid is not None and not valid():
+            return False  # The next frame is copied to the same place
+        self._received += 1
+        self.i += 1
+        if self.flush_interval is not None and time.time() - self._last_hand_off >= self.flush_interval:
+            # Only complete chunks are written, the rest of the frames stay in memory
+            frames = self.i if self.layout == LEGACY else self.i // self.chunk_frames * self.chunk_frames
+            if frames:
+                self._hand_off(frames)
+        return True
+
+    def close(self):
+        """ Writes the frames still in memory, waits for the writer thread and trims the dataset to the number of
+        frames received.
+        """
+        if self.dset is None:
+            self.logger.info('No frames were received, the timelapse was not created')
+            return
+        if self.i > 0:
+            self.logger.info('Saving last bits of data before stopping.')
+            self.logger.debug('Missing values: {}'.format(self.i))
+            self._full_blocks.put((self.block, self.i, self.j))
+            self.j += self.i
+            self.i = 0
+        self._full_blocks.put(None)
+        self._writer.join()
+        if self.compressor is not None:
+            self.compressor.shutdown()
+
+        # This last bit is to avoid having a lot of zeros at the end of the timelapses
+        self.dset.resize(self._dataset_shape(self.j))
+        if self.swmr:
+            self.dset.flush()
+        self._check_writer()
+
+
+def open_recording(file_path, swmr=False):
+    """ Opens the file to which a saver appends its session. Files that are read while being written (``swmr``) need
+    the latest HDF5 file format, which older versions of HDF5 can not read.
+    """
+    return h5py.File(file_path, 'a', libver='latest' if swmr else None)
+
+
+class SegmentedTimelapseWriter:
+    """ Splits a timelapse into segment files that roll over when they reach ``segment_size`` megabytes or
+    ``segment_duration`` seconds, so that long measurements do not end up in a single huge file.
+
+    Segments are stored next to the main file, named after it and after the session, e.g.
+    ``Video_2021-05-04-10-30-12-123456_0000.hdf5``, each one with its own ``timelapse`` dataset. When the recording
+    is closed, a virtual dataset called ``timelapse`` is created in the session group of the main file. It stitches
+    the segments together, so the recording can be read as if it had not been split, as long as the segments are kept
+    in the same folder as the main file.
+
+    With ``swmr`` in the writer options, every segment can be read while it is being written. The virtual dataset only
+    exists once the recording is closed.
+
+    The size of a segment is estimated from the uncompressed frames. The previous segment is closed on a separate
+    thread, while the frames keep arriving to the next one.
+
+    :param group: Session group of the main file, in which the virtual ``timelapse`` is created
+    :param int max_memory: Memory (in MB) of the :class:`TimelapseWriter` of every segment
+    :param float segment_size: Size (in MB) at which a new segment is started, ``None`` for no limit
+    :param float segment_duration: Duration (in s) at which a new segment is started, ``None`` for no limit
+    :param writer_options: Passed to the :class:`TimelapseWriter` of every segment
+    """
+    def __init__(self, group, max_memory=500, segment_size=None, segment_duration=None, **writer_options):
+        self.logger = get_logger(name=__name__)
+        self.group = group
+        self.max_memory = max_memory
+        self.segment_size = segment_size * 1024 * 1024 if segment_size else None
+        self.segment_duration = segment_duration or None
+        self.writer_options = writer_options
+        main_file = os.path.abspath(group.file.filename)
+        self.directory = os.path.dirname(main_file)
+        session = re.sub(r'[^0-9A-Za-z]+', '-', group.name).strip('-')
+        self.prefix = '{}_{}'.format(os.path.splitext(os.path.basename(main_file))[0], session)
+
+        self.segments = []  # Dictionaries with the file name, the shape and the attributes of every timelapse
+        self.file = None
+        self.writer = None
+        self.segment_bytes = 0
+        self.segment_started = 0
+        self._closing = []
+        self._error = None
+
+    def _open_segment(self):
+        name = '{}_{:04d}.hdf5'.format(self.prefix, len(self.segments))
+        self.logger.info('Starting segment {}'.format(name))
+        libver = 'latest' if self.writer_options.get('swmr', False) else None
+        self.file = h5py.File(os.path.join(self.directory, name), 'w', libver=libver)
+        self.file.attrs['session'] = self.group.name
+        self.writer = TimelapseWriter(self.file, self.max_memory, **self.writer_options)
+        self.segments.append({'name': name, 'shape': None})
+        self.segment_bytes = 0
+        self.segment_started = time.time()
+
+    def _segment_full(self):
+        if self.segment_size is not None and self.segment_bytes >= self.segment_size:
+            return True
+        if self.segment_duration is not None and time.time() - self.segment_started >= self.segment_duration:
+            return True
+        return False
+
+    def _close_segment(self):
+        thread = Thread(target=self._finish_segment, args=(self.file, self.writer, self.segments[-1]),
+                        name='SegmentCloser')
+        thread.start()
+        self._closing.append(thread)
+        self.file = self.writer = None
+
+    def _finish_segment(self, file, writer, segment):
+        try:
+            writer.close()
+            if writer.dset is not None:
+                segment['shape'] = writer.dset.shape
+                segment['dtype'] = writer.dset.dtype
+                segment['attrs'] = dict(writer.dset.attrs)
+            file.close()
+        except Exception as e:
+            self.logger.exception('Error closing segment {}'.format(segment['name']))
+            self._error = e
+
+    def append(self, frame, valid=None):
+        """ Adds a frame to the current segment, see :meth:`TimelapseWriter.append`. """
+        if self._error is not None:
+            raise self._error
+        if self.writer is not None and self._segment_full():
+            self._close_segment()
+        if self.writer is None:
+            self._open_segment()
+        if not self.writer.append(frame, valid):
+            return False
+        self.segment_bytes += frame.nbytes
+        return True
+
+    def close(self):
+        """ Closes the last segment and creates the virtual dataset in the session group. """
+        if self.writer is not None:
+            self._close_segment()
+        for thread in self._closing:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        segments = [segment for segment in self.segments if segment['shape'] is not None]
+        if not segments:
+            self.logger.info('No frames were received, the timelapse was not created')
+            return
+        attrs = segments[0]['attrs']
+        frame_major = attrs.get('layout', FRAME_MAJOR) == FRAME_MAJOR
+        frames = [segment['shape'][0 if frame_major else -1] for segment in segments]
+        disk_shape = segments[0]['shape'][1:] if frame_major else segments[0]['shape'][:-1]
+        shape = (sum(frames), *disk_shape) if frame_major else (*disk_shape, sum(frames))
+        layout = h5py.VirtualLayout(shape=shape, dtype=segments[0]['dtype'])
+        start = 0
+        for segment, n in zip(segments, frames):
+            # Relative paths are resolved from the folder of the main file
+            source = h5py.VirtualSource(segment['name'], 'timelapse', shape=segment['shape'])
+            if frame_major:
+                layout[start:start + n] = source
+            else:
+                layout[..., start:start + n] = source
+            start += n
+        dset = self.group.create_virtual_dataset('timelapse', layout, fillvalue=0)
+        for key, value in attrs.items():
+            dset.attrs[key] = value
+        dset.attrs['segments'] = [segment['name'] for segment in segments]
+        self.logger.info('Stored {} frames in {} segments'.format(sum(frames), len(segments)))
+
+
+def timelapse_writer(group, max_memory=500, segment_size=None, segment_duration=None, **writer_options):
+    """ Returns the writer used by the savers: a :class:`SegmentedTimelapseWriter` if a segment size or duration is
+    given, a :class:`TimelapseWriter` otherwise.
+    """
+    if segment_size or segment_duration:
+        return SegmentedTimelapseWriter(group, max_memory, segment_size, segment_duration, **writer_options)
+    return TimelapseWriter(group, max_memory, **writer_options)
+
+
+class ShapeSegmentedWriter:
+    """ Starts a new timelapse every time the shape or the data type of the frames changes, e.g. after setting a new
+    ROI or binning on the camera, so that a recording carries on through a reconfiguration of the camera.
+
+    Frames with the first shape are stored in the ``timelapse`` of the session, as usual. Every following shape is
+    stored in a group ``shape_<n>`` of the session, with its own ``timelapse``. The session and each of those groups
+    hold the attributes ``first_frame``, the index of their first frame in the session (and therefore in the
+    per-frame datasets), ``frame_shape`` and, when the acquisition reports them, ``roi`` and ``binning``.
+
+    No groups can be added to a file while it is being read in SWMR mode, new shapes are then stored in files next
+    to the main file, named after the session and the shape number.
+
+    :param group: Session group
+    :param int max_memory: Memory (in MB) of every writer
+    :param writer_options: Passed to :func:`timelapse_writer`
+    """
+    def __init__(self, group, max_memory=500, **writer_options):
+        self.logger = get_logger(name=__name__)
+        self.group = group
+        self.max_memory = max_memory
+        self.writer_options = writer_options
+        self.writer = None
+        self.file = None  # Separate file of the current shape, only with SWMR
+        self.frame_shape = None
+        self.dtype = None
+        self.shapes = 0
+        self.frames = 0
+        self._closing = []
+        self._error = None
+
+    def _shape_group(self):
+        if self.shapes == 0:
+            return self.group
+        name = 'shape_{}'.format(self.shapes)
+        if not self.group.file.swmr_mode:
+            return self.group.create_group(name)
+        main_file = os.path.abspath(self.group.file.filename)
+        session = re.sub(r'[^0-9A-Za-z]+', '-', self.group.name).strip('-')
+        path = os.path.join(os.path.dirname(main_file), '{}_{}_{}.hdf5'.format(
+            os.path.splitext(os.path.basename(main_file))[0], session, name))
+        self.logger.info('The main file is being read, storing the frames of the new shape in {}'.format(path))
+        self.file = h5py.File(path, 'w', libver='latest')
+        self.file.attrs['session'] = self.group.name
+        return self.file
+
+    def _start_shape(self, frame, header):
+        group = self._shape_group()
+        group.attrs['first_frame'] = self.frames
+        group.attrs['frame_shape'] = frame.shape
+        info = (header or {}).get('info') or {}
+        for key in ('roi', 'binning'):
+            if info.get(key) is not None and None not in np.ravel(info[key]):
+                group.attrs[key] = info[key]
+        self.writer = timelapse_writer(group, self.max_memory, **self.writer_options)
+        self.frame_shape = frame.shape
+        self.dtype = frame.dtype
+        self.shapes += 1
+
+    def _close_writer(self):
+        thread = Thread(target=self._finish_writer, args=(self.writer, self.file), name='ShapeCloser')
+        thread.start()
+        self._closing.append(thread)
+        self.writer = self.file = None
+
+    def _finish_writer(self, writer, file):
+        try:
+            writer.close()
+            if file is not None:
+                file.close()
+        except Exception as e:
+            self.logger.exception('Error closing the timelapse of shape {}'.format(self.frame_shape))
+            self._error = e
+
+    def append(self, frame, header=None, valid=None):
+        """ Adds a frame, starting a new timelapse if its shape is not the one of the previous frame.
+
+        :param dict header: Header with which the frame was received, used for the ROI and binning of new shapes
+        :param valid: See :meth:`TimelapseWriter.append`
+        :return: Whether the frame was kept
+        """
+        if self._error is not None:
+            raise self._error
+        if self.writer is not None and (frame.shape != self.frame_shape or frame.dtype != self.dtype):
+            self.logger.info('Frames changed from {} to {}, starting a new timelapse'.format(
+                self.frame_shape, frame.shape))
+            self._close_writer()
+        if self.writer is None:
+            self._start_shape(frame, header)
+        if not self.writer.append(frame, valid):
+            return False
+        self.frames += 1
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            self._close_writer()
+        for thread in self._closing:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+
 class VideoSaver(Process):
-    def __init__(self, file_path, meta, topic, max_memory=150):
+    """ Process that subscribes to the frames broadcast on ``topic`` and streams them to an HDF5 file. Frames are
+    received as raw buffers, see :mod:`~dispertech.models.experiment.nanoparticle_tracking.transport`. The
+    information in the header of every frame is stored next to the timelapse, see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.frame_info`.
+
+    :param int port: Port on which the frames are published, defaults to the port of the experimentor publisher
+    :param int hwm: High-water mark of the subscriber socket, see
+        :func:`~dispertech.models.experiment.nanoparticle_tracking.transport.subscribe`
+    :param missed_frames: ``multiprocessing.Value`` to which the frames that never arrived are added
+    :param writer_options: Passed to :class:`ShapeSegmentedWriter`, e.g. ``layout`` or ``segment_size``
+    """
+    def __init__(self, file_path, meta, topic, max_memory=150, port=None, hwm=None, missed_frames=None,
+                 **writer_options):
         super().__init__()
         self.logger = get_logger(name=__name__)
-        self.logger.info('Starting worker saver for topic {} on port {}'.format(topic, settings.PUBLISHER_PUBLISH_PORT))
+        self.port = port or settings.PUBLISHER_PUBLISH_PORT
+        self.logger.info('Starting worker saver for topic {} on port {}'.format(topic, self.port))
         self.file_path = file_path
         self.meta = meta
         self.topic = topic
         self.max_memory = max_memory
+        self.hwm = hwm
+        self.missed_frames = missed_frames
+        self.writer_options = writer_options
 
     def run(self):
         context = zmq.Context()
-        socket = context.socket(zmq.SUB)
-        socket.connect("tcp://localhost:{}".format(settings.PUBLISHER_PUBLISH_PORT))
-        topic_filter = self.topic.encode('ascii')
-        socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
-        allocate_memory = self.max_memory  # megabytes of memory to allocate on the hard drive.
+        socket = subscribe(context, self.topic, self.port, self.hwm)
+        gaps = GapDetector(self.missed_frames, 'saver')
 
-        with h5py.File(self.file_path, "a") as f:
+        with open_recording(self.file_path, self.writer_options.get('swmr', False)) as f:
             now = str(datetime.now())
             g = f.create_group(now)
             g.create_dataset('metadata', data=self.meta.encode("ascii", "ignore"))
             f.flush()
-            # Has to be submitted via the socket a string 'stop'
-            i = 0
-            j = 0
-            first = True
-
+            writer = ShapeSegmentedWriter(g, self.max_memory, **self.writer_options)
+            info = FrameInfoWriter(g, flush_interval=self.writer_options.get('flush_interval'))
+            # Has to be submitted via the socket a stop message
             while True:
-                topic = socket.recv_string()
-                data = socket.recv_pyobj()
-                self.logger.debug('Got data of type {} on the saver topic {}.'.format(type(data), topic))
-                if isinstance(data, str):
+                topic, header, data = recv_frame(socket, consumer='saver')
+                gaps.update(topic, header)
+                if data is None:
+                    if not stop_requested(header, 'saver'):
+                        continue
                     self.logger.info('Got the signal to stop the saving')
                     break
-                if first:  # First time it runs, creates the dataset
-                    x = data.shape[0]
-                    y = data.shape[1]
-                    self.logger.debug('Image size: {}x{}'.format(x, y))
-                    allocate = int(allocate_memory / data.nbytes * 1024 * 1024)
-                    self.logger.debug('Allocating {}MB to stream to disk'.format(allocate_memory))
-                    self.logger.debug('Allocate {} frames'.format(allocate))
-                    d = np.zeros((x, y, allocate), dtype=data.dtype)
-                    dset = g.create_dataset('timelapse', (x, y, allocate), maxshape=(x, y, None),
-                                            compression='gzip', compression_opts=1,
-                                            dtype=data.dtype)  # The images are going to be stacked along the z-axis.
-                    d[:, :, i] = data
-                    i += 1
-                    first = False
-                else:
-                    if i == allocate:
-                        self.logger.debug('Allocating more memory')
-                        dset[:, :, j:j + allocate] = d
-                        dset.resize((x, y, j + 2 * allocate))
-                        d = np.zeros((x, y, allocate), dtype=data.dtype)
-                        i = 0
-                        j += allocate
-                    d[:, :, i] = data
-                    i += 1
-
-            if j > 0 or i > 0:
-                self.logger.info('Saving last bits of data before stopping.')
-                self.logger.debug('Missing values: {}'.format(i))
-                dset[:, :, j:j + i] = d[:, :, :i]  # Last save before closing
-
-            # This last bit is to avoid having a lot of zeros at the end of the timelapses
-            dset.resize((x, y, j + i))
+                self.logger.debug('Got frame {} on the saver topic {}.'.format(header['frame_id'], topic))
+                if not writer.append(data, header, valid=lambda: frame_valid(header, 'saver')):
+                    self.logger.warning('Frame {} was overwritten before it was saved'.format(header['frame_id']))
+                    continue
+                info.append(header)
 
+            writer.close()
+            info.close()
             self.logger.info('Flushing file to disk...')
             f.flush()
             self.logger.info('Finished writing to disk')
+        socket.close()
 
-def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
+
+def worker_listener(file_path, meta, topic, port=5555, max_memory=500, hwm=None, missed_frames=None,
+                    **writer_options):
     """ Function that listens on the specified port for new data and then saves it to disk. It is the same as
     :func:`worker_saver` but implementing a ZMQ socket instead of grabbing data from a queue.
 
@@ -118,70 +647,45 @@ def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
     :param str meta: Metadata. It is kept as a string in order to provide flexibility for other programs.
     :param int port: Port on which to listen for publisher data
     :param int max_memory: Maximum memory (in MB) to allocate
+    :param int hwm: High-water mark of the subscriber socket
+    :param missed_frames: ``multiprocessing.Value`` to which the frames that never arrived are added
+    :param writer_options: Passed to :class:`ShapeSegmentedWriter`, e.g. ``layout`` or ``segment_size``
     """
     logger = get_logger(name=__name__)
     logger.info('Starting worker saver for topic {} on port {}'.format(topic, port))
     context = zmq.Context()
-    socket = context.socket(zmq.SUB)
-    socket.connect("tcp://localhost:{}".format(port))
-    topic_filter = topic.encode('ascii')
-    socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
-    allocate_memory = max_memory  # megabytes of memory to allocate on the hard drive.
+    socket = subscribe(context, topic, port, hwm)
+    gaps = GapDetector(missed_frames, 'saver')
 
-    with h5py.File(file_path, "a") as f:
+    with open_recording(file_path, writer_options.get('swmr', False)) as f:
         now = str(datetime.now())
         g = f.create_group(now)
         g.create_dataset('metadata', data=meta.encode("ascii","ignore"))
-        # Has to be submitted via the socket a string 'stop'
-
-        i = 0
-        j = 0
-        first = True
+        writer = ShapeSegmentedWriter(g, max_memory, **writer_options)
+        info = FrameInfoWriter(g, flush_interval=writer_options.get('flush_interval'))
+        # Has to be submitted via the socket a stop message
 
         while True:
-            topic = socket.recv_string()
-            data = socket.recv_pyobj()
-            logger.debug('Got data of type {} on the saver topic {}.'.format(type(data), topic))
-            if isinstance(data, str):
+            topic, header, data = recv_frame(socket, consumer='saver')
+            gaps.update(topic, header)
+            if data is None:
+                if not stop_requested(header, 'saver'):
+                    continue
                 logger.info('Got the signal to stop the saving')
                 break
-            data = data[1]
-            if first:  # First time it runs, creates the dataset
-                x = data.shape[0]
-                y = data.shape[1]
-                logger.debug('Image size: {}x{}'.format(x, y))
-                allocate = int(allocate_memory / data.nbytes * 1024 * 1024)
-                logger.debug('Allocating {}MB to stream to disk'.format(allocate_memory))
-                logger.debug('Allocate {} frames'.format(allocate))
-                d = np.zeros((x, y, allocate), dtype=data.dtype)
-                dset = g.create_dataset('timelapse', (x, y, allocate), maxshape=(x, y, None),
-                                        compression='gzip', compression_opts=1,
-                                        dtype=data.dtype)  # The images are going to be stacked along the z-axis.
-                d[:, :, i] = data
-                i += 1
-                first = False
-            else:
-                if i == allocate:
-                    logger.debug('Allocating more memory')
-                    dset[:, :, j:j + allocate] = d
-                    dset.resize((x, y, j + 2 * allocate))
-                    d = np.zeros((x, y, allocate), dtype=data.dtype)
-                    i = 0
-                    j += allocate
-                d[:, :, i] = data
-                i += 1
-
-        if j > 0 or i > 0:
-            logger.info('Saving last bits of data before stopping.')
-            logger.debug('Missing values: {}'.format(i))
-            dset[:, :, j:j + i] = d[:, :, :i]  # Last save before closing
-
-        # This last bit is to avoid having a lot of zeros at the end of the timelapses
-        dset.resize((x, y, j+i))
-
+            logger.debug('Got frame {} on the saver topic {}.'.format(header['frame_id'], topic))
+            if not writer.append(data, header, valid=lambda: frame_valid(header, 'saver')):
+                logger.warning('Frame {} was overwritten before it was saved'.format(header['frame_id']))
+                continue
+            info.append(header)
+
+        writer.close()
+        info.close()
         logger.info('Flushing file to disk...')
         f.flush()
         logger.info('Finished writing to disk')
+    socket.close()
+
 
 def add_to_save_queue(data, queue_saver):
     """ This method is a buffer between the publisher and the ``save_stream`` method. The idea is that in order
@@ -192,29 +696,30 @@ def add_to_save_queue(data, queue_saver):
     queue_saver.put(img)
 
 
-def worker_saver(file_path, meta, q, max_memory=500):
-    """Function that can be run in a separate thread for continuously save data to disk.
+def worker_saver(file_path, meta, q, max_memory=500, **writer_options):
+    """Function that can be run in a separate thread for continuously save data to disk. Images in the queue do not
+    carry information about their acquisition, frames are numbered in the order they are received and timestamped
+    when they are taken from the queue.
 
     :param str file_path: the path to the file to use.
     :param str meta: Metadata. It is kept as a string in order to provide flexibility for other programs.
     :param Queue q: Queue that will store all the images to be saved to disk.
     :param int max_memory: Maximum memory (in MB) to allocate
+    :param writer_options: Passed to :class:`ShapeSegmentedWriter`, e.g. ``layout`` or ``segment_size``
     """
     logger = get_logger(name=__name__)
     logger.info('Appending data to {}'.format(file_path))
-    allocate_memory = max_memory  # megabytes of memory to allocate on the hard drive.
 
-    with h5py.File(file_path, "a") as f:
+    with open_recording(file_path, writer_options.get('swmr', False)) as f:
         now = str(datetime.now())
         g = f.create_group(now)
         g.create_dataset('metadata', data=meta.encode("ascii","ignore"))
+        writer = ShapeSegmentedWriter(g, max_memory, **writer_options)
+        info = FrameInfoWriter(g, flush_interval=writer_options.get('flush_interval'))
+        frame_id = 0
         keep_saving = True  # Flag that will stop the worker function if running in a separate thread.
         # Has to be submitted via the queue a string 'exit'
 
-        i = 0
-        j = 0
-        first = True
-
         while keep_saving:
             while not q.empty() or q.qsize() > 0:
                 img = q.get()
@@ -222,40 +727,12 @@ def worker_saver(file_path, meta, q, max_memory=500):
                     keep_saving = False
                     logger.info('Got the signal to stop the saving')
                     continue
+                writer.append(img)
+                frame_id += 1
+                info.append({'frame_id': frame_id, 'timestamp': time.time()})
 
-                if first:  # First time it runs, creates the dataset
-                    x = img.shape[0]
-                    y = img.shape[1]
-                    logger.debug('Image size: {}x{}'.format(x, y))
-                    allocate = int(allocate_memory / img.nbytes * 1024 * 1024)
-                    logger.debug('Allocating {}MB to stream to disk'.format(allocate_memory))
-                    logger.debug('Allocate {} frames'.format(allocate))
-                    d = np.zeros((x, y, allocate), dtype=img.dtype)
-                    dset = g.create_dataset('timelapse', (x, y, allocate), maxshape=(x, y, None),
-                                            compression='gzip', compression_opts=1,
-                                            dtype=img.dtype)  # The images are going to be stacked along the z-axis.
-                    d[:, :, i] = img
-                    i += 1
-                    first = False
-                else:
-                    if i == allocate:
-                        logger.debug('Allocating more memory')
-                        dset[:, :, j:j + allocate] = d
-                        dset.resize((x, y, j + 2 * allocate))
-                        d = np.zeros((x, y, allocate), dtype=img.dtype)
-                        i = 0
-                        j += allocate
-                    d[:, :, i] = img
-                    i += 1
-
-        if j > 0 or i > 0:
-            logger.info('Saving last bits of data before stopping.')
-            logger.debug('Missing values: {}'.format(i))
-            dset[:, :, j:j + i] = d[:, :, :i]  # Last save before closing
-
-        # This last bit is to avoid having a lot of zeros at the end of the timelapses
-        dset.resize((x, y, j+i))
-
+        writer.close()
+        info.close()
         logger.info('Flushing file to disk...')
         f.flush()
     logger.info('Finished writing to disk')
@@ -0,0 +1,215 @@
+"""
+    Size Distribution
+    =================
+    Calculates the hydrodynamic diameter of the particles from the trajectories published by the
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.linking.LinkingProcess`, while the measurement runs.
+
+    For every complete trajectory, the mean squared displacement (MSD) is calculated for the first ``max_lag`` lags
+    and a straight line ``MSD = 4 D t + offset`` is fitted to it. The offset absorbs the error of the localization.
+    The diffusion coefficient ``D`` gives the diameter through the Stokes-Einstein relation::
+
+        d = k T / (3 pi eta D)
+
+    with the viscosity ``eta`` of water at the temperature of the sample. Every diameter is added to a
+    :class:`SizeHistogram` that is published on the ``size_distribution`` topic, therefore the distribution can be
+    followed as it converges, without storing the trajectories.
+
+    The drift of the sample would add ``(v t) ** 2`` to the MSD. When ``tracking.process.compute_drift`` is set, the
+    linking subtracts it from the trajectories before they are published, see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.drift`.
+"""
+import math
+import time
+from multiprocessing import Process
+
+import numpy as np
+import zmq
+
+from dispertech.models.experiment.nanoparticle_tracking.records import TRACK_DTYPE, as_records
+from dispertech.models.experiment.nanoparticle_tracking.transport import recv_object, subscribe
+from experimentor.config import settings
+from experimentor.core.pusher import Pusher
+from experimentor.lib.log import get_logger
+
+BOLTZMANN = 1.380649e-23  # J/K
+
+
+def water_viscosity(temperature):
+    """ Viscosity of water (in Pa s) at ``temperature`` (in Celsius), with the Vogel equation. """
+    return 2.414e-5 * 10 ** (247.8 / (temperature + 273.15 - 140))
+
+
+def track_msd(track, max_lag=10):
+    """ Mean squared displacement of a trajectory. Frames in which the particle was not located, allowed by the
+    memory of the linking, are left out of the averages.
+
+    :param track: Records or DataFrame with the ``x``, ``y`` and ``frame`` of every location
+    :param int max_lag: Longest lag, in frames
+    :return: ``(lags, msd, counts)``: the lags in frames, the MSD in pixels squared and the number of displacements
+        averaged for every lag
+    """
+    frames = np.asarray(track['frame'], dtype=np.int64)
+    frames = frames - frames.min()
+    positions = np.full((frames.max() + 1, 2), np.nan)
+    positions[frames] = np.column_stack((track['x'], track['y']))
+    lags = np.arange(1, min(max_lag, len(positions) - 1) + 1)
+    msd = np.zeros(len(lags))
+    counts = np.zeros(len(lags), dtype=np.int64)
+    for i, lag in enumerate(lags):
+        squared = np.sum((positions[lag:] - positions[:-lag]) ** 2, axis=1)
+        valid = ~np.isnan(squared)
+        counts[i] = np.count_nonzero(valid)
+        msd[i] = squared[valid].mean() if counts[i] else np.nan
+    keep = counts > 0
+    return lags[keep], msd[keep], counts[keep]
+
+
+def diffusion_coefficient(lags, msd, counts, um_pixel, fps):
+    """ Fits ``MSD = 4 D t + offset``, weighting every lag by the number of displacements averaged.
+
+    :return: ``D`` in square microns per second, ``NaN`` if it can not be determined
+    """
+    if len(lags) == 0:
+        return float('nan')
+    t = lags / fps
+    msd = msd * um_pixel ** 2
+    if len(lags) == 1:
+        slope = msd[0] / t[0]
+    else:
+        slope = np.polyfit(t, msd, 1, w=np.sqrt(counts))[0]
+    if slope <= 0:
+        return float('nan')
+    return slope / 4
+
+
+def hydrodynamic_diameter(diffusion, temperature):
+    """ Diameter (in nm) of a sphere with a diffusion coefficient ``diffusion`` (in square microns per second) in water
+    at ``temperature`` (in Celsius).
+    """
+    kelvin = temperature + 273.15
+    return BOLTZMANN * kelvin / (3 * math.pi * water_viscosity(temperature) * diffusion * 1e-12) * 1e9
+
+
+class SizeHistogram:
+    """ Histogram of diameters that grows as trajectories are completed.
+
+    :param int bins: Number of bins
+    :param float max_diameter: Upper edge of the last bin, in nm. Larger diameters are only counted in ``outside``
+    """
+    def __init__(self, bins=50, max_diameter=1000):
+        self.edges = np.linspace(0, max_diameter, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.outside = 0
+        self.n = 0
+        self._sum = 0.
+        self._sum_squares = 0.
+
+    def add(self, diameters):
+        diameters = np.atleast_1d(np.asarray(diameters, dtype=np.float64))
+        diameters = diameters[np.isfinite(diameters)]
+        counts, _ = np.histogram(diameters, self.edges)
+        self.counts += counts
+        self.outside += len(diameters) - counts.sum()
+        self.n += len(diameters)
+        self._sum += diameters.sum()
+        self._sum_squares += (diameters ** 2).sum()
+
+    @property
+    def mean(self):
+        return self._sum / self.n if self.n else float('nan')
+
+    @property
+    def std(self):
+        if not self.n:
+            return float('nan')
+        return math.sqrt(max(self._sum_squares / self.n - self.mean ** 2, 0))
+
+    def as_dict(self):
+        """ The histogram as published on the ``size_distribution`` topic. """
+        return {
+            'edges': self.edges,
+            'counts': self.counts.copy(),
+            'outside': self.outside,
+            'particles': self.n,
+            'mean': self.mean,
+            'std': self.std,
+        }
+
+
+class SizeDistributionProcess(Process):
+    """ Process that subscribes to the trajectories published on ``topic``, calculates the diameter of every particle
+    and publishes the histogram of diameters on ``publish_topic``, at most once every ``publish_interval`` seconds.
+
+    :param str topic: Topic on which the trajectories are published
+    :param str publish_topic: Topic on which to publish the histogram, as returned by :meth:`SizeHistogram.as_dict`
+    :param int port: Port of the publisher, defaults to the port of the experimentor publisher
+    :param float um_pixel: Microns per pixel of the microscope
+    :param float fps: Frames per second at which the trajectories were acquired
+    :param int min_length: Shorter trajectories are ignored
+    :param int max_lag: Lags, in frames, used to fit the diffusion coefficient
+    :param int bins: Bins of the histogram
+    :param float max_diameter: Largest diameter in the histogram, in nm
+    :param temperature: ``multiprocessing.Value`` with the temperature of the sample in Celsius, kept up to date by
+        the experiment. While it is ``NaN``, or if it is not given, ``default_temperature`` is used
+    :param float default_temperature: Temperature of the sample in Celsius when it is not measured
+    :param float publish_interval: Seconds between publications of the histogram
+    :param stop_event: ``multiprocessing.Event`` that stops the process, after publishing the histogram one last time
+    """
+    def __init__(self, topic='tracks', publish_topic='size_distribution', port=None, um_pixel=1., fps=30.,
+                 min_length=2, max_lag=10, bins=50, max_diameter=1000, temperature=None, default_temperature=20.,
+                 publish_interval=1, stop_event=None):
+        super().__init__()
+        self.topic = topic
+        self.publish_topic = publish_topic
+        self.port = port or settings.PUBLISHER_PUBLISH_PORT
+        self.um_pixel = um_pixel
+        self.fps = fps
+        self.min_length = min_length
+        self.max_lag = max_lag
+        self.bins = bins
+        self.max_diameter = max_diameter
+        self.temperature = temperature
+        self.default_temperature = default_temperature
+        self.publish_interval = publish_interval
+        self.stop_event = stop_event
+
+    def sample_temperature(self):
+        if self.temperature is None or math.isnan(self.temperature.value):
+            return self.default_temperature
+        return self.temperature.value
+
+    def diameter(self, track):
+        """ Hydrodynamic diameter of the particle that followed ``track``, in nm. ``NaN`` if it can not be
+        determined.
+        """
+        if len(track) < self.min_length:
+            return float('nan')
+        diffusion = diffusion_coefficient(*track_msd(track, self.max_lag), self.um_pixel, self.fps)
+        if math.isnan(diffusion):
+            return diffusion
+        return hydrodynamic_diameter(diffusion, self.sample_temperature())
+
+    def run(self):
+        logger = get_logger(name=__name__)
+        logger.info('Calculating the size distribution of the trajectories published on {}'.format(self.topic))
+        context = zmq.Context()
+        socket = subscribe(context, self.topic, self.port)
+        pusher = Pusher()
+        histogram = SizeHistogram(self.bins, self.max_diameter)
+        published = 0
+        last_publish = time.time()
+        while self.stop_event is None or not self.stop_event.is_set():
+            if socket.poll(100):
+                topic, track = recv_object(socket)
+                if isinstance(track, str):
+                    if track == settings.SUBSCRIBER_EXIT_KEYWORD:
+                        break
+                    continue
+                histogram.add(self.diameter(as_records(track, TRACK_DTYPE)))
+            if histogram.n > published and time.time() - last_publish >= self.publish_interval:
+                pusher.publish(histogram.as_dict(), self.publish_topic)
+                published = histogram.n
+                last_publish = time.time()
+        pusher.publish(histogram.as_dict(), self.publish_topic)
+        logger.info('Size distribution of {} particles, mean diameter {:.1f}nm'.format(histogram.n, histogram.mean))
+        socket.close()
@@ -0,0 +1,172 @@
+"""
+    Snapshots
+    =========
+    Single images saved with
+    :meth:`~dispertech.models.experiment.nanoparticle_tracking.np_tracking.NPTracking.save_data` are appended to a few
+    extendable datasets in the ``snapshots`` group of the photo file, instead of creating a new group for every
+    image::
+
+        snapshots/index            one record per image: timestamp, camera, config, series and position
+        snapshots/configs          every distinct configuration, as a JSON string
+        snapshots/config_hashes    hash of every configuration, to find the ones already stored
+        snapshots/<series>         the images with the same shape and data type, stacked on the first axis
+
+    A configuration is stored only the first time it is used, images refer to it by its position in ``configs``.
+    Several images can be written or read at once with :func:`write_snapshots` and :func:`read_snapshots`.
+
+    Files written before this format hold one group per image, named after the moment it was saved, which can still
+    be read with :func:`~dispertech.models.experiment.nanoparticle_tracking.recordings.read_image`.
+"""
+import hashlib
+import json
+import time
+
+import h5py
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.packing import PACKED_12BIT, is_packed, pack_12bit, \
+    packed_length, unpack_12bit
+
+SNAPSHOTS_GROUP = 'snapshots'
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', np.float64),
+    ('camera', np.int8),
+    ('config', np.int32),  # Position in snapshots/configs
+    ('series', 'S48'),  # Name of the dataset holding the image
+    ('position', np.int64),  # Position of the image in its series
+])
+
+
+def series_name(frame, packed_12bit=False):
+    """ Name of the dataset in which images with the shape and data type of ``frame`` are stored. """
+    name = '{}_{}'.format('x'.join(str(n) for n in frame.shape), frame.dtype)
+    return name + '_packed' if packed_12bit else name
+
+
+def _append(dset, data):
+    start = dset.shape[0]
+    dset.resize((start + len(data), *dset.shape[1:]))
+    dset[start:] = data
+    return start
+
+
+def _get_group(f):
+    if SNAPSHOTS_GROUP in f:
+        return f[SNAPSHOTS_GROUP]
+    g = f.create_group(SNAPSHOTS_GROUP)
+    g.create_dataset('index', (0,), maxshape=(None,), chunks=(256,), dtype=INDEX_DTYPE)
+    g.create_dataset('configs', (0,), maxshape=(None,), chunks=(16,), dtype=h5py.string_dtype())
+    g.create_dataset('config_hashes', (0,), maxshape=(None,), chunks=(16,), dtype='S40')
+    return g
+
+
+def _config_index(g, config):
+    """ Position of ``config`` in the stored configurations, storing it if it is new. """
+    serialized = config if isinstance(config, str) else json.dumps(config, sort_keys=True, default=str)
+    config_hash = hashlib.sha1(serialized.encode('utf-8')).hexdigest().encode('ascii')
+    hashes = g['config_hashes'][()]
+    found = np.flatnonzero(hashes == config_hash)
+    if len(found):
+        return int(found[0])
+    _append(g['config_hashes'], [config_hash])
+    return _append(g['configs'], [serialized])
+
+
+def _get_series(g, frame, packed_12bit):
+    name = series_name(frame, packed_12bit)
+    if name in g:
+        return g[name]
+    if packed_12bit:
+        dset = g.create_dataset(name, (0, packed_length(frame.size)), maxshape=(None, packed_length(frame.size)),
+                                chunks=(1, packed_length(frame.size)), dtype=np.uint8)
+        dset.attrs['encoding'] = PACKED_12BIT
+        dset.attrs['frame_shape'] = frame.shape
+    else:
+        dset = g.create_dataset(name, (0, *frame.shape), maxshape=(None, *frame.shape), chunks=(1, *frame.shape),
+                                dtype=frame.dtype)
+    return dset
+
+
+def write_snapshots(file_path, frames, config, camera=0, timestamps=None, packed_12bit=False):
+    """ Appends images to the snapshots of a file, opening it only once.
+
+    :param str file_path: The photo file
+    :param frames: A list of images, or a single image
+    :param config: The configuration in use, a dictionary or an already serialized string
+    :param int camera: Camera that acquired the images
+    :param timestamps: Moment of acquisition of every image, by default the moment of saving
+    :param bool packed_12bit: Store the images with two pixels in three bytes
+    :return: Position of the first image in the index
+    """
+    if isinstance(frames, np.ndarray) and frames.ndim == 2:
+        frames = [frames]
+    if timestamps is None:
+        timestamps = [time.time()] * len(frames)
+    with h5py.File(file_path, 'a') as f:
+        g = _get_group(f)
+        config_index = _config_index(g, config)
+        records = np.zeros(len(frames), dtype=INDEX_DTYPE)
+        # Consecutive images with the same shape are written at once
+        start = 0
+        while start < len(frames):
+            stop = start + 1
+            while stop < len(frames) and frames[stop].shape == frames[start].shape \
+                    and frames[stop].dtype == frames[start].dtype:
+                stop += 1
+            dset = _get_series(g, frames[start], packed_12bit)
+            data = np.stack(frames[start:stop])
+            position = _append(dset, pack_12bit(data) if packed_12bit else data)
+            records['series'][start:stop] = dset.name.split('/')[-1].encode('ascii')
+            records['position'][start:stop] = np.arange(position, position + stop - start)
+            start = stop
+        records['timestamp'] = timestamps
+        records['camera'] = camera
+        records['config'] = config_index
+        first = _append(g['index'], records)
+        f.flush()
+    return first
+
+
+def read_snapshot_index(file_path):
+    """ Returns the index of the snapshots of a file as a structured array, see :data:`INDEX_DTYPE`. """
+    with h5py.File(file_path, 'r') as f:
+        if SNAPSHOTS_GROUP not in f:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return f[SNAPSHOTS_GROUP]['index'][()]
+
+
+def read_snapshots(file_path, indices=None):
+    """ Reads several snapshots at once. Images of the same series are read with a single selection.
+
+    :param str file_path: The photo file
+    :param indices: Positions in the index, by default every snapshot
+    :return: List of images, in the order of ``indices``
+    """
+    with h5py.File(file_path, 'r') as f:
+        g = f[SNAPSHOTS_GROUP]
+        index = g['index'][()]
+        indices = np.arange(len(index)) if indices is None else np.asarray(indices)
+        records = index[indices]
+        images = [None] * len(records)
+        for series in np.unique(records['series']):
+            dset = g[series.decode('ascii')]
+            which = np.flatnonzero(records['series'] == series)
+            positions = records['position'][which]
+            order = np.argsort(positions)
+            data = dset[np.unique(positions)]
+            if is_packed(dset):
+                data = unpack_12bit(data, tuple(dset.attrs['frame_shape']))
+            rows = np.searchsorted(np.unique(positions), positions[order])
+            for i, row in zip(which[order], rows):
+                images[i] = data[row]
+    return images
+
+
+def read_snapshot_config(file_path, config_index):
+    """ Returns the configuration stored at ``config_index``, as referenced by the ``config`` field of the index. """
+    with h5py.File(file_path, 'r') as f:
+        config = f[SNAPSHOTS_GROUP]['configs'][config_index]
+    if isinstance(config, bytes):
+        config = config.decode('utf-8')
+    return json.loads(config)
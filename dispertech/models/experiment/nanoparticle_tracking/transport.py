@@ -0,0 +1,369 @@
+"""
+    Frame Transport
+    ===============
+    Camera frames are broadcast over ZMQ as multipart messages made of three parts: the topic, a small JSON header and
+    the raw buffer of the image::
+
+        [b'<topic>', b'{"numpy": true, "dtype": "uint16", "shape": [1200, 1920], "frame_id": 12, "timestamp": ...}',
+         <frame buffer>]
+
+    The buffer is sent with ``copy=False`` and rebuilt on the other side with ``np.frombuffer``, therefore frames are
+    never pickled. The header keeps the ``numpy``, ``dtype`` and ``shape`` keys used by the experimentor publisher, so
+    :func:`recv_frame` understands both. Messages made of only a topic and a pickled object, as sent by older
+    publishers, are still accepted.
+
+    When the frames are already in a
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.ring_buffer.SharedFrameBuffer`, only the header is
+    sent. It includes the description of the buffer and the sequence number of the frame, and :func:`recv_frame`
+    returns a view on the shared memory instead of a received buffer. Frames that were overwritten before the consumer
+    got to them are returned as ``None`` with ``"dropped": true`` in the header, and counted as dropped by the
+    ``consumer`` given to :func:`recv_frame`. A consumer that only needs some of the frames, e.g. the newest one,
+    receives the messages with :func:`recv_header` and reads the frames it keeps with :func:`read_frame`, the others
+    are never read from the buffer.
+
+    The header can also carry an ``info`` dictionary with the conditions in which the frame was acquired (exposure,
+    gain, laser power, etc.), that the savers store next to the frames, see
+    :mod:`~dispertech.models.experiment.nanoparticle_tracking.frame_info`.
+
+    Every frame carries a consecutive ``frame_id``. ZMQ silently discards messages when the queue of a slow
+    subscriber reaches its high-water mark, the :class:`GapDetector` of each consumer finds those losses as jumps in
+    the sequence and adds them to a counter shared with the experiment. The high-water marks of both ends can be set
+    with ``hwm``.
+
+    A stop message is a header with ``"stop": true`` and an empty buffer. Since the saver and the localization listen
+    to the same topic, a stop message can carry a ``target`` so that only one kind of consumer stops. Messages without
+    a target stop every subscriber of the topic.
+
+    Control messages carry new parameters for the running consumers, e.g. the arguments of the localization, in a
+    header with ``"control": true``, the ``target`` and the ``params``, see :func:`send_control`. They are sent on
+    :data:`CONTROL_TOPIC` by the same publisher as the frames, therefore a consumer receives them in order with the
+    frames and applies them before the next one, without being restarted.
+
+    The locations, trajectories and drift are published through the experimentor ``Pusher``. A process that stops
+    publishing one of those topics sends :data:`END_OF_STREAM` on it after its last message, so that a subscriber
+    that has to store everything, like the
+    :class:`~dispertech.models.experiment.nanoparticle_tracking.location_saver.LocationSaver`, knows when nothing else
+    will arrive. Processes close their pusher with :func:`close_pusher`, otherwise the last messages can be lost when
+    they exit.
+"""
+import json
+import pickle
+import time
+from threading import Lock
+
+import numpy as np
+import zmq
+
+from dispertech.models.experiment.nanoparticle_tracking.exceptions import FrameOverwritten
+from dispertech.models.experiment.nanoparticle_tracking.ring_buffer import attach
+from experimentor.config import settings
+from experimentor.lib.log import get_logger
+
+CONTROL_TOPIC = 'tracking_control'
+END_OF_STREAM = 'end_of_stream'
+
+
+def frame_header(frame, frame_id=0, timestamp=None, info=None):
+    """ Builds the header that describes how to rebuild ``frame`` from its raw buffer. """
+    header = {
+        'numpy': True,
+        'dtype': str(frame.dtype),
+        'shape': frame.shape,
+        'frame_id': int(frame_id),
+        'timestamp': timestamp if timestamp is not None else time.time(),
+    }
+    if info is not None:
+        header['info'] = info
+    return header
+
+
+def send_frame(socket, topic, frame, frame_id=0, timestamp=None, info=None):
+    """ Sends a frame without serializing it.
+
+    :param socket: A PUB or PUSH socket
+    :param str topic: Topic on which to broadcast
+    :param np.ndarray frame: The image to send
+    :param int frame_id: Consecutive number of the frame
+    :param float timestamp: Moment of acquisition, by default the moment of sending
+    :param dict info: Conditions of the acquisition, see
+        :mod:`~dispertech.models.experiment.nanoparticle_tracking.frame_info`
+    """
+    frame = np.ascontiguousarray(frame)
+    header = frame_header(frame, frame_id, timestamp, info)
+    socket.send_multipart([topic.encode('ascii'), json.dumps(header).encode('ascii'), frame], copy=False)
+
+
+def send_shared_frame(socket, topic, buffer, seq, frame_id=0, timestamp=None, info=None):
+    """ Announces that the frame ``seq`` was written to a shared buffer. Only the header is sent.
+
+    :param buffer: The :class:`~dispertech.models.experiment.nanoparticle_tracking.ring_buffer.SharedFrameBuffer`
+    :param int seq: Sequence number returned by the buffer when writing the frame
+    """
+    header = {
+        'numpy': True,
+        'dtype': str(buffer.dtype),
+        'shape': buffer.frame_shape,
+        'frame_id': int(frame_id),
+        'timestamp': timestamp if timestamp is not None else time.time(),
+        'shared_memory': buffer.description,
+        'seq': seq,
+    }
+    if info is not None:
+        header['info'] = info
+    socket.send_multipart([topic.encode('ascii'), json.dumps(header).encode('ascii'), b''])
+
+
+def send_stop(socket, topic, target=None):
+    """ Sends the signal that tells the subscribers of ``topic`` to stop.
+
+    :param str target: If given, only the consumers of that kind (e.g. ``'saver'``) stop
+    """
+    header = {'numpy': False, 'stop': True, 'target': target}
+    socket.send_multipart([topic.encode('ascii'), json.dumps(header).encode('ascii'), b''])
+
+
+def send_control(socket, target, params, topic=CONTROL_TOPIC):
+    """ Sends new parameters to the consumers of kind ``target`` (e.g. ``'localization'``).
+
+    :param dict params: The new parameters, they have to be serializable to JSON
+    """
+    header = {'numpy': False, 'control': True, 'target': target, 'params': params}
+    socket.send_multipart([topic.encode('ascii'), json.dumps(header).encode('ascii'), b''])
+
+
+def control_requested(header, target):
+    """ Whether a message received with :func:`recv_frame` carries parameters for the consumer of kind ``target``.
+    """
+    return header.get('control', False) and header.get('target') == target
+
+
+def stop_requested(header, target):
+    """ Whether a message received with :func:`recv_frame` asks the consumer of kind ``target`` to stop. """
+    return header.get('stop', False) and header.get('target') in (None, target)
+
+
+def recv_frame(socket, flags=0, consumer=None):
+    """ Receives a frame sent with :func:`send_frame`.
+
+    :param str consumer: Kind of consumer, one of ``ring_buffer.CONSUMERS``, that counts the frames found overwritten
+        in the shared buffer. ``None`` to not count them
+    :return: ``(topic, header, frame)``. ``frame`` is a read-only view on the received buffer, or ``None`` when the
+        message is a stop signal or a control message. ``header['stop']`` or ``header['control']`` is ``True`` in
+        that case.
+    """
+    return read_frame(*recv_header(socket, flags), consumer)
+
+
+def recv_header(socket, flags=0):
+    """ Receives a message sent with :func:`send_frame` without reading its frame from the shared buffer.
+
+    :return: ``(topic, header, payload)``, to be passed to :func:`read_frame` to get the frame
+    """
+    parts = socket.recv_multipart(flags=flags, copy=False)
+    topic = parts[0].bytes.decode('ascii')
+    if len(parts) == 2:  # Topic followed by a pickled object
+        return (topic, *_unpack_object(pickle.loads(parts[1].bytes)))
+
+    header = json.loads(parts[1].bytes)
+    if header.get('stop', False) or header.get('control', False):
+        return topic, header, None
+    if not header.get('numpy', False):
+        return (topic, *_unpack_object(pickle.loads(parts[2].bytes)))
+    return topic, header, parts[2]
+
+
+def read_frame(topic, header, payload, consumer=None):
+    """ Rebuilds the frame of a message received with :func:`recv_header`, reading it from the shared buffer if
+    needed. See :func:`recv_frame` for ``consumer`` and for what is returned.
+    """
+    if header.get('stop', False) or header.get('control', False):
+        return topic, header, None
+    if 'shared_memory' in header:
+        try:
+            frame = attach(header['shared_memory']).read(header['seq'])
+        except FileNotFoundError:  # The buffer was already released
+            header['dropped'] = True
+            return topic, header, None
+        except FrameOverwritten:
+            header['dropped'] = True
+            count_dropped(header, consumer)
+            return topic, header, None
+        return topic, header, frame
+    if not isinstance(payload, zmq.Frame):  # Already unpickled
+        return topic, header, payload
+    frame = np.frombuffer(payload.buffer, dtype=header['dtype']).reshape(header['shape'])
+    return topic, header, frame
+
+
+def recv_object(socket, flags=0):
+    """ Receives a message sent by the experimentor ``Pusher`` through its publisher, e.g. the locations published
+    by the localization. Arrays are rebuilt from their buffer, any other object is unpickled.
+
+    :return: ``(topic, data)``
+    """
+    parts = socket.recv_multipart(flags=flags)
+    topic = parts[0].decode('ascii')
+    header = json.loads(parts[1])
+    if header.get('numpy', False):
+        return topic, np.frombuffer(parts[2], dtype=header['dtype']).reshape(header['shape'])
+    return topic, pickle.loads(parts[2])
+
+
+def close_pusher(pusher, linger=5000):
+    """ Closes an experimentor ``Pusher`` once the messages still queued are sent. Processes started by
+    multiprocessing exit without running the ``atexit`` handler of the pusher, and would lose them.
+
+    :param int linger: Milliseconds to wait for the messages to be sent, e.g. if the publisher is not running
+    """
+    with pusher.lock:
+        pusher.pusher.close(linger=linger)
+    pusher.pusher.context.term()
+
+
+def frame_valid(header, consumer=None):
+    """ Whether a frame received with :func:`recv_frame` still holds the data it had when it was received. Frames
+    read from a shared buffer may be overwritten by the acquisition while a slow consumer is processing them. Those
+    frames are counted as dropped by ``consumer``, if given.
+    """
+    if 'shared_memory' not in header:
+        return True
+    if attach(header['shared_memory']).is_valid(header['seq']):
+        return True
+    count_dropped(header, consumer)
+    return False
+
+
+def count_dropped(header, consumer):
+    """ Counts the frame of ``header`` as overwritten before ``consumer`` could use it. Nothing is counted for
+    frames that were not in a shared buffer, or if ``consumer`` is ``None``.
+    """
+    if consumer is None or 'shared_memory' not in header:
+        return
+    try:
+        attach(header['shared_memory']).add_dropped(consumer)
+    except FileNotFoundError:  # The buffer was already released
+        pass
+
+
+def _unpack_object(data):
+    """ Translates the objects sent by publishers that pickle their data into a header and a frame. Strings are
+    always a signal to stop, and tuples are ``(metadata, image)``.
+    """
+    if isinstance(data, str):
+        return {'stop': True}, None
+    header = {}
+    if isinstance(data, tuple):
+        if isinstance(data[0], dict):
+            header.update(data[0])
+        data = data[1]
+    header.update(frame_header(data, header.get('frame_id', 0), header.get('timestamp')))
+    return header, data
+
+
+class GapDetector:
+    """ Counts the frames that never reached a consumer by looking for jumps in their ``frame_id``. Frames that
+    arrived but were overwritten in the shared buffer before being read are not counted here, the buffer already
+    keeps track of them.
+
+    The frames missed on a topic are the ids between the first and the highest one received that did not arrive,
+    therefore a frame that arrives after a later one is first counted as missed and then discounted. A frame with an
+    id not above the first one of its topic means that the numbering started again.
+
+    :param missed_frames: Optional ``multiprocessing.Value`` to which the missed frames are added, so that the process
+        that started the consumer can report them. Every kind of consumer should have its own
+    :param str name: Name of the consumer, used in the log
+    """
+    def __init__(self, missed_frames=None, name='consumer'):
+        self.logger = get_logger(name=__name__)
+        self.missed_frames = missed_frames
+        self.name = name
+        self.topics = {}  # First and highest frame id, frames received and frames missed on every topic
+        self.missed = 0
+
+    def update(self, topic, header):
+        """ Checks the header of a message received with :func:`recv_frame`.
+
+        :return: The change in the number of missed frames: the frames missed right before this one, or ``-1`` if this
+            frame had already been counted as missed
+        """
+        if header.get('stop', False) or 'frame_id' not in header:
+            return 0
+        frame_id = header['frame_id']
+        state = self.topics.get(topic)
+        if state is None or frame_id <= state['first']:  # First frame, or the numbering started again
+            self.topics[topic] = {'first': frame_id, 'last': frame_id, 'received': 1, 'missed': 0}
+            return 0
+        state['received'] += 1
+        state['last'] = max(state['last'], frame_id)
+        missed = state['last'] - state['first'] + 1 - state['received']
+        change = missed - state['missed']
+        state['missed'] = missed
+        if not change:
+            return 0
+        self.missed += change
+        if self.missed_frames is not None:
+            with self.missed_frames.get_lock():
+                self.missed_frames.value += change
+        if change > 0:
+            self.logger.warning('The {} missed {} frames before frame {}'.format(self.name, change, frame_id))
+        else:
+            self.logger.info('Frame {} reached the {} late'.format(frame_id, self.name))
+        return change
+
+
+def subscribe(context, topic, port=None, hwm=None):
+    """ Creates a SUB socket connected to the frame stream and filtered by ``topic``.
+
+    :param port: Port on localhost, or a full address such as the ``url`` of an experimentor signal. Defaults to the
+        port of the experimentor publisher
+    :param int hwm: Messages queued before ZMQ starts discarding them, ``None`` to keep the default of ZMQ
+    """
+    socket = context.socket(zmq.SUB)
+    if hwm is not None:
+        socket.setsockopt(zmq.RCVHWM, hwm)
+    if isinstance(port, str):
+        socket.connect(port)
+    else:
+        socket.connect("tcp://localhost:{}".format(port or settings.PUBLISHER_PUBLISH_PORT))
+    socket.setsockopt(zmq.SUBSCRIBE, topic.encode('ascii'))
+    return socket
+
+
+class FramePublisher:
+    """ Owns the PUB socket on which the frames of the free runs are broadcast. The same publisher can be shared
+    between the acquisition threads and the methods that stop the consumers, sending is protected by a lock.
+
+    :param int port: Port to which the publisher binds
+    :param int hwm: Messages queued for every subscriber before ZMQ starts discarding them, ``None`` to keep the
+        default of ZMQ
+    """
+    def __init__(self, port, hwm=None):
+        self.logger = get_logger(name=__name__)
+        self.port = port
+        self.lock = Lock()
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+        if hwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.bind("tcp://*:{}".format(port))
+        self.logger.info('Frame publisher bound to port {}'.format(port))
+
+    def publish(self, topic, frame, frame_id=0, timestamp=None, info=None):
+        with self.lock:
+            send_frame(self.socket, topic, frame, frame_id, timestamp, info)
+
+    def publish_shared(self, topic, buffer, seq, frame_id=0, timestamp=None, info=None):
+        with self.lock:
+            send_shared_frame(self.socket, topic, buffer, seq, frame_id, timestamp, info)
+
+    def stop(self, topic, target=None):
+        with self.lock:
+            send_stop(self.socket, topic, target)
+
+    def control(self, target, params):
+        with self.lock:
+            send_control(self.socket, target, params)
+
+    def close(self):
+        with self.lock:
+            self.socket.close(linger=0)
@@ -118,7 +118,7 @@ class FocusingWindow(QMainWindow):
 
     def change_power(self):
         power = int(self.power_slider.value())
-        self.experiment.electronics.laser_power(power)
+        self.experiment.electronics.scattering_laser = power
 
     def toggle_fiber_led(self):
         self.fiber_led = 0 if self.fiber_led else 1
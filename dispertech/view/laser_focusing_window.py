@@ -93,7 +93,7 @@ class LaserFocusingWindow(QMainWindow):
             self.toggle_servo()
 
         self.lcd_laser_power.display(power)
-        self.experiment.electronics.laser_power(power)
+        self.experiment.electronics.scattering_laser = power
 
     def set_camera_low(self):
         self.button_camera_low.setStyleSheet("background-color: green")
@@ -5,8 +5,10 @@ import numpy as np
 import dispertech.view.GUI.resources
 from PyQt5 import uic
 from PyQt5.QtCore import QTimer
-from PyQt5.QtWidgets import QMainWindow, QVBoxLayout, QMessageBox
+from PyQt5.QtWidgets import QActionGroup, QMainWindow, QVBoxLayout, QMessageBox
 
+from dispertech.models.experiment.nanoparticle_tracking import BACKGROUND_MODES
+from dispertech.models.experiment.nanoparticle_tracking.records import to_dataframe
 from dispertech.view import VIEW_BASE_DIR
 from dispertech.view.focusing_window import FocusingWindow
 from dispertech.view.tracking_config_window import TrackingConfig
@@ -47,8 +49,22 @@ class MainWindow(QMainWindow):
 
         self.actionAlign_Tool.triggered.connect(self.focus_window.show)
         self.action_set_roi.triggered.connect(self.set_roi)
-        self.action_start_tracking.triggered.connect(self.experiment.start_tracking)
+        self.action_start_tracking.triggered.connect(lambda: self.experiment.start_tracking())  # Not the checked flag
         self.action_tracking_config.triggered.connect(self.config_window.show)
+        # Connected after TrackingConfig.get_config, which updates the config before the parameters are sent
+        self.config_window.button_apply.clicked.connect(self.experiment.update_tracking_parameters)
+        self.action_set_tracking_band.triggered.connect(self.set_tracking_band)
+        self.action_detect_tracking_band.triggered.connect(lambda: self.experiment.set_tracking_rows('auto'))
+        self.action_clear_tracking_band.triggered.connect(lambda: self.experiment.set_tracking_rows(None))
+
+        self.menu_Config.addSeparator()
+        self.background_actions = QActionGroup(self)
+        for method, label in BACKGROUND_MODES.items():
+            action = self.menu_Config.addAction(label)
+            action.setCheckable(True)
+            action.setChecked(method == self.experiment.background_method)
+            action.triggered.connect(lambda checked, m=method: self.experiment.set_background_correction(m))
+            self.background_actions.addAction(action)
         self.action_start_recording.triggered.connect(self.toggle_recording)
 
         self.camera_widget.setup_roi_lines([
@@ -62,11 +78,12 @@ class MainWindow(QMainWindow):
         self.button_camera_apply.clicked.connect(self.update_camera_settings)
 
         self.is_recording = False
+        self.dropped_frames = 0
 
     def change_power(self):
         power = int(self.power_slider.value())
         self.lcd_laser_power.display(power)
-        self.experiment.electronics.laser_power(power)
+        self.experiment.electronics.scattering_laser = power
 
     def toggle_fiber_led(self):
         self.fiber_led = 0 if self.fiber_led else 1
@@ -85,16 +102,23 @@ class MainWindow(QMainWindow):
             self.button_light.setStyleSheet("background-color: red")
 
     def update_image(self):
-        image = self.experiment.cameras[1].temp_image
+        image = self.experiment.display_image(1)
         if not image is None:
             self.camera_widget.update_image(image)
         if not self.experiment.temp_locations is None:
-            self.camera_widget.draw_target_pointer(self.experiment.temp_locations)
+            self.camera_widget.draw_target_pointer(to_dataframe(self.experiment.temp_locations, ['y', 'x']))
 
     def update_temperatures(self):
-        self.sample_temperature.display(self.experiment.electronics.temp_sample)
-        self.electronics_temperature.display(self.experiment.electronics.temp_electronics)
+        if self.experiment.electronics.temp_sample is not None:
+            self.sample_temperature.display(self.experiment.electronics.temp_sample)
+        if self.experiment.electronics.temp_electronics is not None:
+            self.electronics_temperature.display(self.experiment.electronics.temp_electronics)
         self.lcd_fps.display(self.experiment.cameras[1].fps)
+        dropped_frames = self.experiment.update_dropped_frames()
+        self.lcd_dropped_frames.display(dropped_frames)
+        if dropped_frames > self.dropped_frames:
+            self.statusbar.showMessage(f'{dropped_frames - self.dropped_frames} frames were dropped')
+        self.dropped_frames = dropped_frames
 
     def set_roi(self):
         X, Y = self.camera_widget.get_roi_values()
@@ -108,9 +132,22 @@ class MainWindow(QMainWindow):
         self.camera_widget.set_roi_lines(new_values[0], new_values[1])
         self.experiment.cameras[1].start_free_run()
 
+    def set_tracking_band(self):
+        """ Restricts the localization to the rows between the horizontal ROI lines, e.g. around the fiber core. """
+        _, (y, height) = self.camera_widget.get_roi_values()
+        first = y - self.camera_widget.corner_roi[1]  # Rows of the image, which starts at the corner of the ROI
+        self.experiment.set_tracking_rows((first, first + height))
+        self.statusbar.showMessage(f'Locating particles between rows {first} and {first + height}')
+
     def toggle_recording(self):
         if not self.is_recording:
-            self.experiment.start_saving()
+            try:
+                self.experiment.start_saving()
+            except ValueError as e:
+                message = QMessageBox()
+                message.setText(f"Can not start recording: {e}")
+                message.exec()
+                return
             self.is_recording = True
         else:
             self.experiment.stop_saving()
@@ -134,7 +171,7 @@ class MainWindow(QMainWindow):
             self.experiment.start_tracking()
 
     def start_free_run(self):
-        self.experiment.cameras[1].start_free_run()
+        self.experiment.start_free_run(1)
 
     def stop_free_run(self):
-        self.experiment.cameras[1].stop_free_run()
+        self.experiment.stop_free_run(1)
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('trackpy')
+
+from dispertech.models.experiment.nanoparticle_tracking import linking
+from dispertech.models.experiment.nanoparticle_tracking.linking import LinkingProcess, TrackAccumulator
+from dispertech.models.experiment.nanoparticle_tracking.records import DRIFT_DTYPE, TRACK_DTYPE, as_records, \
+    empty_records
+from dispertech.models.experiment.nanoparticle_tracking.transport import END_OF_STREAM
+
+
+class RecordingPusher:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, data, topic):
+        self.published.append((topic, data))
+
+
+class FakeSocket:
+    def close(self):
+        pass
+
+
+def frame_records(frame, positions):
+    records = empty_records(len(positions))
+    records['frame'] = frame
+    if len(positions):
+        records['y'], records['x'] = np.asarray(positions, dtype=np.float32).T
+    return records
+
+
+def linked(frame, particles):
+    records = np.zeros(len(particles), dtype=TRACK_DTYPE)
+    records['frame'] = frame
+    records['particle'] = particles
+    return records
+
+
+def test_accumulator_counts_frames_without_particles():
+    tracks = TrackAccumulator(memory=2)
+    assert tracks.add(linked(1, [0, 1]), 1) == []
+    assert tracks.add(linked(2, [0]), 2) == []
+    assert tracks.add(linked(3, []), 3) == []
+    completed = tracks.add(linked(4, []), 4)  # Particle 1 was not seen in the last 3 frames
+    assert [list(track['particle']) for track in completed] == [[1]]
+    assert completed[0].dtype == TRACK_DTYPE
+    completed = tracks.add(linked(5, []), 5)
+    assert [list(track['particle']) for track in completed] == [[0, 0]]
+    assert tracks.last_seen == {}
+
+
+def test_accumulator_gaps_in_frame_numbers():
+    tracks = TrackAccumulator(memory=2, min_length=2)
+    tracks.add(linked(10, [0, 1]), 10)
+    tracks.add(linked(11, [0]), 11)
+    completed = tracks.add(linked(14, [2]), 14)  # Frames 12 and 13 never arrived
+    assert [list(track['frame']) for track in completed] == [[10, 11]]
+    assert tracks.discarded == 1  # Particle 1 was located only once
+    completed = tracks.flush()
+    assert tracks.discarded == 2 and completed == []
+    assert tracks.completed == 1
+
+
+def run_linking(monkeypatch, batches, **options):
+    pusher = RecordingPusher()
+    monkeypatch.setattr(linking, 'Pusher', lambda: pusher)
+    monkeypatch.setattr(linking, 'subscribe', lambda *args, **kwargs: FakeSocket())
+    monkeypatch.setattr(linking, 'close_pusher', lambda pusher: None)
+    process = LinkingProcess(search_range=3, **options)
+    process.locations = lambda socket, control=None: iter(batches)
+    process.run()
+    topics = {}
+    for topic, data in pusher.published:
+        topics.setdefault(topic, []).append(data)
+    for messages in topics.values():  # Nothing is published after the end of stream
+        assert [isinstance(data, str) for data in messages] == [False] * (len(messages) - 1) + [True]
+        assert messages.pop() == END_OF_STREAM
+    assert 'drift' in topics or not options.get('drift_window')
+    tracks = [as_records(data, TRACK_DTYPE) for data in topics.get('tracks', [])]
+    drift = [as_records(data, DRIFT_DTYPE) for data in topics.get('drift', [])]
+    return sorted(tracks, key=lambda track: track['frame'][0]), drift
+
+
+def test_empty_frames_count_in_the_memory(monkeypatch):
+    positions = [(10, 10), (50, 50)]
+    batches = [frame_records(1, positions), frame_records(2, positions), frame_records(3, []),
+               frame_records(4, positions)]
+    tracks, _ = run_linking(monkeypatch, batches, memory=1)
+    assert [list(track['frame']) for track in tracks] == [[1, 2, 4], [1, 2, 4]]
+    tracks, _ = run_linking(monkeypatch, batches, memory=0)
+    assert sorted(len(track) for track in tracks) == [1, 1, 2, 2]
+
+
+def test_missing_frames_count_in_the_memory(monkeypatch):
+    positions = [(10, 10)]
+    batches = [frame_records(1, positions), frame_records(2, positions), frame_records(5, positions)]
+    tracks, _ = run_linking(monkeypatch, batches, memory=1)
+    assert [list(track['frame']) for track in tracks] == [[1, 2], [5]]
+    tracks, _ = run_linking(monkeypatch, batches, memory=2)
+    assert [list(track['frame']) for track in tracks] == [[1, 2, 5]]
+
+
+def test_tracks_are_published_as_records(monkeypatch):
+    batches = [frame_records(frame, [(10 + frame, 10), (40, 40 - frame)]) for frame in range(1, 6)]
+    tracks, _ = run_linking(monkeypatch, batches, memory=1, min_length=3)
+    assert len(tracks) == 2
+    for track in tracks:
+        assert len(set(track['particle'])) == 1
+        np.testing.assert_array_equal(track['frame'], np.arange(1, 6))
+
+
+def test_drift_is_published_for_every_frame(monkeypatch):
+    positions = np.array([(10., 10.), (30., 40.), (60., 20.)])
+    batches = []
+    for frame in range(1, 11):
+        if frame not in (4, 7, 8):
+            batches.append(frame_records(frame, positions + (0.5 * frame, 0)))
+        elif frame == 4:
+            batches.append(frame_records(frame, []))
+    tracks, drift = run_linking(monkeypatch, batches, memory=3, drift_window=5)
+    assert [int(record['frame'][0]) for record in drift] == list(range(1, 11))
+    np.testing.assert_allclose(drift[-1]['y'], 0.5 * 9, atol=1e-5)
+    np.testing.assert_allclose(drift[-1]['x'], 0, atol=1e-5)
+    assert len(tracks) == 3
+    for track in tracks:
+        np.testing.assert_allclose(track['y'] - track['y'][0], 0, atol=1e-4)
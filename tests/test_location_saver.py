@@ -0,0 +1,111 @@
+import threading
+import time
+
+import h5py
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking import location_saver
+from dispertech.models.experiment.nanoparticle_tracking.location_saver import LocationSaver, RecordWriter, \
+    read_locations
+from dispertech.models.experiment.nanoparticle_tracking.records import LOCATION_DTYPE, TRACK_DTYPE, empty_records
+from dispertech.models.experiment.nanoparticle_tracking.transport import END_OF_STREAM
+from experimentor.config import settings
+
+
+class FakeSocket:
+    """ Hands out ``(topic, data)`` messages in order. Callables are run when they reach the front of the queue,
+    between two messages.
+    """
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def setsockopt(self, *args):
+        pass
+
+    def poll(self, timeout=0):
+        while self.messages and callable(self.messages[0]):
+            self.messages.pop(0)()
+        if not self.messages:
+            time.sleep(timeout / 1000)
+        return bool(self.messages)
+
+    def recv(self):
+        return self.messages.pop(0)
+
+    def close(self):
+        pass
+
+
+def locations(frame, count=2):
+    records = empty_records(count)
+    records['frame'] = frame
+    return records
+
+
+def track(particle, frames):
+    records = np.zeros(len(frames), dtype=TRACK_DTYPE)
+    records['frame'] = frames
+    records['particle'] = particle
+    return records
+
+
+def run_saver(monkeypatch, tmp_path, messages, **options):
+    socket = FakeSocket(messages)
+    monkeypatch.setattr(location_saver, 'subscribe', lambda *args, **kwargs: socket)
+    monkeypatch.setattr(location_saver, 'recv_object', lambda socket: socket.recv())
+    file_path = str(tmp_path / 'locations.hdf5')
+    saver = LocationSaver(file_path, '{}', 'locations', 'tracks', batch=3, **options)
+    saver.run()
+    return file_path
+
+
+def test_record_writer_batches_and_flushes(tmp_path):
+    with h5py.File(tmp_path / 'records.hdf5', 'w') as f:
+        writer = RecordWriter(f, 'locations', LOCATION_DTYPE, batch=4, flush_interval=None)
+        writer.append(locations(1, 3))
+        writer.append(empty_records(0))
+        assert f['locations'].shape == (0,)
+        writer.append(locations(2, 2))
+        assert f['locations'].shape == (5,)
+        writer.append(locations(3, 1))
+        writer.flush_if_due()
+        assert f['locations'].shape == (5,)
+        writer.flush_interval = 0
+        writer.flush_if_due()
+        assert f['locations'].shape == (6,)
+        writer.append(locations(4, 2))
+        writer.close()
+        np.testing.assert_array_equal(f['locations']['frame'], [1, 1, 1, 2, 2, 3, 4, 4])
+
+
+def test_saver_stores_what_was_sent_before_the_end_of_stream(monkeypatch, tmp_path):
+    stop = threading.Event()
+    messages = [('locations', locations(1)), ('tracks', track(0, [1, 2])),
+                ('tracks', END_OF_STREAM),  # A linking that stopped while saving, the topic is not over
+                ('tracks', track(1, [2, 3, 4])),
+                stop.set,
+                ('locations', locations(2)), ('tracks', track(2, [3])),  # Still on their way when stopping
+                ('locations', END_OF_STREAM), ('locations', locations(3)),
+                ('tracks', track(3, [4, 5])), ('tracks', END_OF_STREAM)]
+    file_path = run_saver(monkeypatch, tmp_path, messages, stop_event=stop)
+    np.testing.assert_array_equal(read_locations(file_path)['frame'], [1, 1, 2, 2])
+    tracks = read_locations(file_path, name='tracks')
+    np.testing.assert_array_equal(tracks['particle'], [0, 0, 1, 1, 1, 2, 3, 3])
+    np.testing.assert_array_equal(tracks['frame'], [1, 2, 2, 3, 4, 3, 4, 5])
+
+
+def test_saver_stops_if_the_end_of_stream_never_arrives(monkeypatch, tmp_path):
+    stop = threading.Event()
+    messages = [('locations', locations(1)), stop.set, ('tracks', track(0, [1])), ('locations', END_OF_STREAM)]
+    start = time.time()
+    file_path = run_saver(monkeypatch, tmp_path, messages, stop_event=stop, stop_timeout=0.3)
+    assert 0.3 <= time.time() - start < 5
+    assert len(read_locations(file_path)) == 2
+    assert len(read_locations(file_path, name='tracks')) == 1
+
+
+def test_saver_stops_with_the_exit_keyword(monkeypatch, tmp_path):
+    messages = [('locations', locations(1)), ('locations', settings.SUBSCRIBER_EXIT_KEYWORD),
+                ('locations', locations(2))]
+    file_path = run_saver(monkeypatch, tmp_path, messages)
+    assert len(read_locations(file_path)) == 2
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+trackpy = pytest.importorskip('trackpy')
+
+from dispertech.models.experiment.nanoparticle_tracking.numba_locate import compare_locators, locate, \
+    synthetic_image
+
+
+def test_numba_matches_trackpy():
+    image, positions = synthetic_image(particles=50, seed=3)
+    expected = trackpy.locate(image, 7, minmass=300)[['y', 'x', 'mass']].to_numpy()
+    found = locate(image, 7, minmass=300)[['y', 'x', 'mass']].to_numpy()
+    assert len(found) == len(expected) == len(positions)
+
+    distances = np.hypot(found[:, None, 0] - expected[None, :, 0], found[:, None, 1] - expected[None, :, 1])
+    closest = distances.argmin(axis=1)
+    assert len(set(closest)) == len(expected)
+    assert distances.min(axis=1).max() < 0.2
+    assert np.median(np.abs(found[:, 2] / expected[closest, 2] - 1)) < 0.05
+
+
+def test_compare_locators_default_minmass():
+    report = compare_locators(frames=2, repeat=1, particles=50)
+    for row in report.values():
+        assert row['found'] > 0.95
+        assert row['false_positives'] == 0
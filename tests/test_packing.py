@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from dispertech.models.experiment.nanoparticle_tracking.packing import pack_12bit, packed_length, unpack_12bit
+
+
+@pytest.mark.parametrize('shape', [(4, 6), (5, 7), (1, 1), (3, 1)])
+def test_round_trip(shape):
+    frame = np.random.default_rng(1).integers(0, 4096, size=shape, dtype=np.uint16)
+    packed = pack_12bit(frame)
+    assert packed.dtype == np.uint8
+    assert packed.shape == (packed_length(frame.size),)
+    np.testing.assert_array_equal(unpack_12bit(packed, shape), frame)
+
+
+def test_round_trip_stack_with_odd_pixels():
+    frames = np.random.default_rng(2).integers(0, 4096, size=(3, 5, 3), dtype=np.uint16)
+    packed = pack_12bit(frames)
+    assert packed.shape == (3, packed_length(15))
+    np.testing.assert_array_equal(unpack_12bit(packed, (5, 3)), frames)
+
+
+def test_extreme_values():
+    frame = np.array([[0, 4095, 4095], [0, 1, 2048]], dtype=np.uint16)
+    np.testing.assert_array_equal(unpack_12bit(pack_12bit(frame), frame.shape), frame)
+
+
+def test_upper_bits_are_lost():
+    frame = np.array([[4096 + 5, 65535]], dtype=np.uint16)
+    np.testing.assert_array_equal(unpack_12bit(pack_12bit(frame), frame.shape), frame & 0x0FFF)
@@ -0,0 +1,67 @@
+import os
+
+import h5py
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.raw_stream import RawStreamWriter, iter_raw_frames, \
+    raw_paths, read_raw_header
+from dispertech.models.experiment.nanoparticle_tracking.recordings import compact_raw, list_timelapses, \
+    read_frame_info, read_frames
+
+
+def random_frames(count, shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 4096, size=(count, *shape), dtype=np.uint16)
+
+
+def write_raw(file_path, frames, preallocate=0.001):
+    writer = RawStreamWriter(file_path, meta='{"exposure": 1}', preallocate=preallocate)
+    for i, frame in enumerate(frames):
+        writer.append(frame, {'frame_id': i + 1, 'timestamp': 100. + i, 'info': {'exposure': 2.5}})
+    writer.close()
+
+
+def test_raw_round_trip(tmp_path):
+    frames = random_frames(11, (9, 7))
+    file_path = str(tmp_path / 'movie.raw')
+    write_raw(file_path, frames)  # Smaller than a frame, the file grows on every append
+    header = read_raw_header(file_path)
+    assert header['frames'] == len(frames)
+    assert header['dtype'] == 'uint16'
+    read = list(iter_raw_frames(file_path))
+    assert len(read) == len(frames)
+    for i, (record, frame) in enumerate(read):
+        np.testing.assert_array_equal(frame, frames[i])
+        assert record['frame_id'] == i + 1
+        assert record['exposure'] == 2.5
+
+
+def test_discarded_frames_are_overwritten(tmp_path):
+    frames = random_frames(3, (4, 4))
+    file_path = str(tmp_path / 'movie.raw')
+    writer = RawStreamWriter(file_path)
+    assert writer.append(frames[0])
+    assert not writer.append(frames[1], valid=lambda: False)
+    assert writer.append(frames[2])
+    writer.close()
+    read = [frame for _, frame in iter_raw_frames(file_path)]
+    np.testing.assert_array_equal(read, frames[[0, 2]])
+
+
+def test_compact_raw(tmp_path):
+    frames = [*random_frames(5, (8, 6)), *random_frames(4, (5, 3), seed=1)]  # The ROI changed
+    file_path = str(tmp_path / 'movie.raw')
+    write_raw(file_path, frames)
+    started = read_raw_header(file_path)['started']
+    output = compact_raw(file_path, remove=True, max_memory=1, compression='none')
+    with h5py.File(output, 'r') as f:
+        session = f[started]
+        timelapses = list_timelapses(session)
+        assert len(timelapses) == 2
+        np.testing.assert_array_equal(read_frames(timelapses[0]), frames[:5])
+        np.testing.assert_array_equal(read_frames(timelapses[1]), frames[5:])
+        assert timelapses[1].parent.attrs['first_frame'] == 5
+        info = read_frame_info(session)
+        np.testing.assert_array_equal(info['frame_id'], np.arange(1, 10))
+        np.testing.assert_array_equal(info['timestamp'], 100. + np.arange(9))
+        assert session['metadata'][()] == b'{"exposure": 1}'
+    assert not any(os.path.exists(path) for path in raw_paths(file_path))
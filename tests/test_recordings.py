@@ -0,0 +1,85 @@
+import h5py
+import numpy as np
+import pytest
+
+from dispertech.models.experiment.nanoparticle_tracking.recordings import convert_to_frame_major, count_frames, \
+    get_layout, list_timelapses, read_frame, read_frames
+from dispertech.models.experiment.nanoparticle_tracking.saver import FRAME_MAJOR, LEGACY, ShapeSegmentedWriter, \
+    TimelapseWriter
+
+
+def random_frames(count, shape=(12, 10), seed=0):
+    return np.random.default_rng(seed).integers(0, 4096, size=(count, *shape), dtype=np.uint16)
+
+
+def write_session(file_path, frames, **writer_options):
+    with h5py.File(file_path, 'w') as f:
+        g = f.create_group('session')
+        g.create_dataset('metadata', data=b'{}')
+        writer = TimelapseWriter(g, max_memory=0.01, **writer_options)
+        for frame in frames:
+            writer.append(frame)
+        writer.close()
+
+
+@pytest.mark.parametrize('layout', [FRAME_MAJOR, LEGACY])
+def test_timelapse_round_trip(tmp_path, layout):
+    frames = random_frames(37)
+    file_path = tmp_path / 'movie.hdf5'
+    write_session(file_path, frames, layout=layout, chunk_frames=4)
+    with h5py.File(file_path, 'r') as f:
+        dset = f['session/timelapse']
+        assert get_layout(dset) == layout
+        assert count_frames(dset) == len(frames)
+        np.testing.assert_array_equal(read_frames(dset), frames)
+        np.testing.assert_array_equal(read_frame(dset, 5), frames[5])
+
+
+def test_packed_round_trip(tmp_path):
+    frames = random_frames(9, shape=(7, 5))
+    file_path = tmp_path / 'movie.hdf5'
+    write_session(file_path, frames, packed_12bit=True)
+    with h5py.File(file_path, 'r') as f:
+        np.testing.assert_array_equal(read_frames(f['session/timelapse']), frames)
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_convert_to_frame_major(tmp_path, compression):
+    frames = random_frames(23)
+    file_path = tmp_path / 'movie.hdf5'
+    write_session(file_path, frames, layout=LEGACY)
+    output = convert_to_frame_major(str(file_path), chunk_frames=5, block_frames=4, compression=compression)
+    with h5py.File(output, 'r') as f:
+        dset = f['session/timelapse']
+        assert get_layout(dset) == FRAME_MAJOR
+        assert dset.shape == frames.shape
+        assert dset.attrs['compression'] == compression
+        assert dset.compression == (None if compression == 'none' else compression)
+        np.testing.assert_array_equal(read_frames(dset), frames)
+        assert f['session/metadata'][()] == b'{}'
+
+
+def test_convert_every_shape(tmp_path):
+    shapes = [random_frames(6), random_frames(4, shape=(5, 7), seed=1), random_frames(3, seed=2)]
+    file_path = tmp_path / 'movie.hdf5'
+    with h5py.File(file_path, 'w') as f:
+        writer = ShapeSegmentedWriter(f.create_group('session'), max_memory=0.01, layout=LEGACY)
+        for frames in shapes:
+            for frame in frames:
+                writer.append(frame)
+        writer.close()
+    output = convert_to_frame_major(str(file_path))
+    with h5py.File(output, 'r') as f:
+        timelapses = list_timelapses(f['session'])
+        assert len(timelapses) == len(shapes)
+        for dset, frames in zip(timelapses, shapes):
+            assert get_layout(dset) == FRAME_MAJOR
+            np.testing.assert_array_equal(read_frames(dset), frames)
+        assert [dset.parent.attrs['first_frame'] for dset in timelapses] == [0, 6, 10]
+
+
+def test_convert_rejects_unknown_codec(tmp_path):
+    file_path = tmp_path / 'movie.hdf5'
+    write_session(file_path, random_frames(3), layout=LEGACY)
+    with pytest.raises(ValueError):
+        convert_to_frame_major(str(file_path), compression='rar')
@@ -0,0 +1,81 @@
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from dispertech.models.experiment.nanoparticle_tracking import ring_buffer
+from dispertech.models.experiment.nanoparticle_tracking.exceptions import FrameOverwritten
+from dispertech.models.experiment.nanoparticle_tracking.ring_buffer import SharedFrameBuffer
+from dispertech.models.experiment.nanoparticle_tracking.saver import ShapeSegmentedWriter
+from dispertech.models.experiment.nanoparticle_tracking.transport import frame_valid, read_frame
+
+
+@pytest.fixture
+def buffer():
+    buffer = SharedFrameBuffer((4, 6), np.uint16, slots=4)
+    yield buffer
+    for attached in list(ring_buffer._attached.values()):
+        attached.close()
+    buffer.close()
+
+
+def header(buffer, seq):
+    """ The header a consumer receives for the frame ``seq``, see transport.send_shared_frame. """
+    return json.loads(json.dumps({'numpy': True, 'dtype': str(buffer.dtype), 'shape': buffer.frame_shape,
+                                  'frame_id': seq, 'shared_memory': buffer.description, 'seq': seq}))
+
+
+def frame(value):
+    return np.full((4, 6), value, dtype=np.uint16)
+
+
+def test_read_detects_overwritten_frames(buffer):
+    seqs = [buffer.write(frame(i)) for i in range(6)]
+    assert seqs == [1, 2, 3, 4, 5, 6]
+    assert buffer.last_seq == 6
+    with pytest.raises(FrameOverwritten):
+        buffer.read(2)
+    np.testing.assert_array_equal(buffer.read(3), frame(2))
+    assert not buffer.is_valid(1)
+    assert all(buffer.is_valid(seq) for seq in (3, 4, 5, 6))
+    with pytest.raises(ValueError):
+        buffer.read(7)
+
+
+def test_reserved_slot_is_not_valid(buffer):
+    seq, slot = buffer.reserve()
+    assert not buffer.is_valid(seq)
+    slot[...] = frame(7)
+    buffer.commit(seq)
+    np.testing.assert_array_equal(buffer.read(seq), frame(7))
+
+
+def test_dropped_is_counted_per_consumer(buffer):
+    for i in range(6):
+        buffer.write(frame(i))
+    topic, received, data = read_frame('frames', header(buffer, 1), None, 'saver')
+    assert data is None and received['dropped']
+    assert not frame_valid(header(buffer, 2), 'localization')
+    assert not frame_valid(header(buffer, 1), 'localization')
+    assert frame_valid(header(buffer, 5), 'saver')
+    assert buffer.dropped_by('saver') == 1
+    assert buffer.dropped_by('localization') == 2
+    assert buffer.dropped == 2  # The same frame lost by both consumers is not counted twice
+
+
+def test_frame_overwritten_while_saved_is_discarded(buffer, tmp_path):
+    buffer.write(frame(1))
+    received = header(buffer, 1)
+    topic, received, data = read_frame('frames', received, None, 'saver')
+    with h5py.File(tmp_path / 'movie.hdf5', 'w') as f:
+        writer = ShapeSegmentedWriter(f.create_group('session'), max_memory=1)
+        assert writer.append(data, received, valid=lambda: frame_valid(received, 'saver'))
+        for i in range(4):  # The acquisition laps the saver
+            buffer.write(frame(10 + i))
+        assert not writer.append(data, received, valid=lambda: frame_valid(received, 'saver'))
+        writer.append(frame(20))
+        del data
+        writer.close()
+        np.testing.assert_array_equal(f['session/timelapse'][()], [frame(1), frame(20)])
+    assert buffer.dropped_by('saver') == 1
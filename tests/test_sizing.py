@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from dispertech.models.experiment.nanoparticle_tracking.drift import DriftEstimator
+from dispertech.models.experiment.nanoparticle_tracking.records import TRACK_DTYPE
+from dispertech.models.experiment.nanoparticle_tracking.sizing import SizeDistributionProcess, \
+    diffusion_coefficient, hydrodynamic_diameter, track_msd, water_viscosity
+
+
+def brownian_track(diffusion, um_pixel, fps, frames, seed=0):
+    """ Trajectory of a particle with a diffusion coefficient ``diffusion``, in square microns per second. """
+    step = np.sqrt(2 * diffusion / fps) / um_pixel  # Standard deviation per axis, in pixels
+    positions = np.cumsum(np.random.default_rng(seed).normal(0, step, (frames, 2)), axis=0)
+    track = np.zeros(frames, dtype=TRACK_DTYPE)
+    track['frame'] = np.arange(frames)
+    track['y'], track['x'] = positions.T
+    return track
+
+
+def test_water_viscosity():
+    assert water_viscosity(20) == pytest.approx(1.002e-3, rel=5e-3)
+    assert water_viscosity(25) == pytest.approx(0.890e-3, rel=5e-3)
+
+
+def test_stokes_einstein():
+    # A sphere of 100nm in water at 20C diffuses 4.29 square microns per second
+    assert hydrodynamic_diameter(4.29, 20) == pytest.approx(100, rel=5e-3)
+    assert hydrodynamic_diameter(2 * 4.29, 20) == pytest.approx(50, rel=5e-3)
+
+
+def test_diffusion_from_exact_msd():
+    lags = np.arange(1, 11)
+    um_pixel, fps, diffusion = 0.2, 25., 3.
+    msd = (4 * diffusion * lags / fps + 0.01) / um_pixel ** 2  # The offset is the error of the localization
+    counts = np.arange(100, 90, -1)
+    assert diffusion_coefficient(lags, msd, counts, um_pixel, fps) == pytest.approx(diffusion)
+    assert np.isnan(diffusion_coefficient(lags, -msd, counts, um_pixel, fps))
+    assert np.isnan(diffusion_coefficient(lags[:0], msd[:0], counts[:0], um_pixel, fps))
+
+
+def test_diffusion_of_a_brownian_track():
+    track = brownian_track(4., um_pixel=0.1, fps=30., frames=20000)
+    diffusion = diffusion_coefficient(*track_msd(track, max_lag=5), 0.1, 30.)
+    assert diffusion == pytest.approx(4., rel=0.05)
+
+
+def test_msd_with_missing_locations():
+    track = brownian_track(4., um_pixel=0.1, fps=30., frames=10)
+    track = track[[0, 1, 2, 4, 5, 9]]  # Frames left out by the memory of the linking
+    lags, msd, counts = track_msd(track, max_lag=4)
+    np.testing.assert_array_equal(lags, [1, 2, 3, 4])
+    np.testing.assert_array_equal(counts, [3, 2, 2, 3])  # e.g. lag 1: 0-1, 1-2 and 4-5, lag 4: 0-4, 1-5 and 5-9
+    positions = dict(zip(track['frame'], np.column_stack((track['x'], track['y'])).astype(np.float64)))
+    expected = np.mean([np.sum((positions[b] - positions[a]) ** 2) for a, b in ((0, 1), (1, 2), (4, 5))])
+    assert msd[0] == pytest.approx(expected)
+
+
+def test_diameter_of_a_track():
+    process = SizeDistributionProcess(um_pixel=0.1, fps=30., max_lag=5)
+    diameter = process.diameter(brownian_track(4.29, um_pixel=0.1, fps=30., frames=20000, seed=1))
+    assert diameter == pytest.approx(100, rel=0.05)
+    assert np.isnan(process.diameter(brownian_track(4.29, 0.1, 30., frames=1)))
+
+
+def test_drift_estimator_follows_a_constant_drift():
+    velocity = np.array([0.3, -0.2])
+    rng = np.random.default_rng(2)
+    start = rng.uniform(0, 500, (50, 2))
+    brownian = np.zeros_like(start)
+    drift = DriftEstimator(window=20)
+    for frame in range(200):
+        brownian += rng.normal(0, 0.5, start.shape)
+        estimate = drift.add(frame, np.arange(50), start + brownian + velocity * frame)
+    np.testing.assert_allclose(drift.velocity, velocity, atol=0.03)
+    np.testing.assert_allclose(estimate, velocity * 199, atol=0.03 * 199)
+
+
+def test_drift_estimator_across_empty_and_missing_frames():
+    velocity = np.array([0.5, 0.])
+    positions = np.array([[10., 10.], [50., 50.]])
+    drift = DriftEstimator(window=5)
+    for frame in (0, 1, 2, 4, 7, 8):
+        drift.add(frame, [0, 1], positions + velocity * frame)
+        if frame == 2:
+            drift.add(3, [], np.zeros((0, 2)))  # A frame without particles
+    np.testing.assert_allclose(drift.velocity, velocity)
+    np.testing.assert_allclose(drift.drift, velocity * 8)
+    assert len(drift.steps) == 5
@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking.snapshots import read_snapshot_config, \
+    read_snapshot_index, read_snapshots, series_name, write_snapshots
+
+
+def image(shape, value, dtype=np.uint16):
+    return np.full(shape, value, dtype=dtype)
+
+
+def test_mixed_series(tmp_path):
+    file_path = tmp_path / 'photos.hdf5'
+    frames = [image((4, 6), 1), image((4, 6), 2), image((3, 3), 3), image((4, 6), 4), image((4, 6), 5, np.uint8)]
+    assert write_snapshots(file_path, frames, {'exposure': 1}, camera=1, timestamps=[10, 11, 12, 13, 14]) == 0
+    assert write_snapshots(file_path, image((3, 3), 6), {'exposure': 1}) == len(frames)
+
+    index = read_snapshot_index(file_path)
+    assert len(index) == 6
+    assert [series.decode() for series in index['series']] == \
+        [series_name(frame) for frame in frames] + [series_name(image((3, 3), 6))]
+    assert list(index['position']) == [0, 1, 0, 2, 0, 1]
+    assert list(index['camera']) == [1, 1, 1, 1, 1, 0]
+    np.testing.assert_array_equal(index['timestamp'][:5], [10, 11, 12, 13, 14])
+
+    images = read_snapshots(file_path)
+    for read, written in zip(images, frames + [image((3, 3), 6)]):
+        assert read.dtype == written.dtype
+        np.testing.assert_array_equal(read, written)
+    selected = read_snapshots(file_path, [5, 3, 0, 2])
+    assert [int(frame[0, 0]) for frame in selected] == [6, 4, 1, 3]
+
+
+def test_configs_are_stored_once(tmp_path):
+    file_path = tmp_path / 'photos.hdf5'
+    write_snapshots(file_path, image((2, 2), 1), {'exposure': 1, 'gain': 0})
+    write_snapshots(file_path, image((2, 2), 2), {'gain': 0, 'exposure': 1})
+    write_snapshots(file_path, image((2, 2), 3), {'exposure': 2, 'gain': 0})
+    write_snapshots(file_path, image((2, 2), 4), {'exposure': 1, 'gain': 0})
+    index = read_snapshot_index(file_path)
+    assert list(index['config']) == [0, 0, 1, 0]
+    assert read_snapshot_config(file_path, 0) == {'exposure': 1, 'gain': 0}
+    assert read_snapshot_config(file_path, 1) == {'exposure': 2, 'gain': 0}
+
+
+def test_packed_snapshots(tmp_path):
+    file_path = tmp_path / 'photos.hdf5'
+    frames = [np.random.default_rng(i).integers(0, 4096, size=(5, 3), dtype=np.uint16) for i in range(3)]
+    write_snapshots(file_path, frames, '{}', packed_12bit=True)
+    for read, written in zip(read_snapshots(file_path, [2, 0, 1]), [frames[2], frames[0], frames[1]]):
+        np.testing.assert_array_equal(read, written)
+
+
+def test_file_without_snapshots(tmp_path):
+    file_path = tmp_path / 'photos.hdf5'
+    with h5py.File(file_path, 'w') as f:
+        f.create_group('2021-05-04 10:30:12')  # An image saved before the snapshots existed
+    assert len(read_snapshot_index(file_path)) == 0
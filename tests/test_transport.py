@@ -0,0 +1,54 @@
+from multiprocessing import Value
+
+import numpy as np
+
+from dispertech.models.experiment.nanoparticle_tracking import ring_buffer
+from dispertech.models.experiment.nanoparticle_tracking.ring_buffer import SharedFrameBuffer
+from dispertech.models.experiment.nanoparticle_tracking.transport import GapDetector, count_dropped
+
+
+def feed(gaps, frame_ids, topic='frames'):
+    return [gaps.update(topic, {'frame_id': frame_id}) for frame_id in frame_ids]
+
+
+def test_gaps_count_missing_frames():
+    missed_frames = Value('q', 0)
+    gaps = GapDetector(missed_frames, 'saver')
+    assert feed(gaps, [1, 2, 5, 6, 10]) == [0, 0, 2, 0, 3]
+    assert gaps.missed == missed_frames.value == 5
+
+
+def test_gaps_discount_reordered_frames():
+    missed_frames = Value('q', 0)
+    gaps = GapDetector(missed_frames, 'localization')
+    assert feed(gaps, [1, 2, 4, 3, 5, 8, 6]) == [0, 0, 1, -1, 0, 2, -1]
+    assert gaps.missed == missed_frames.value == 1  # Only frame 7 never arrived
+
+
+def test_gaps_per_topic_and_restart():
+    gaps = GapDetector()
+    feed(gaps, [1, 3], 'camera_0')
+    feed(gaps, [1, 2, 4], 'camera_1')
+    assert gaps.missed == 2
+    assert feed(gaps, [1, 2], 'camera_1') == [0, 0]  # The numbering started again
+    assert gaps.update('camera_1', {'stop': True}) == 0
+    assert gaps.update('camera_1', {'control': True}) == 0
+    assert gaps.missed == 2
+
+
+def test_count_dropped():
+    buffer = SharedFrameBuffer((2, 2), np.uint8, slots=2)
+    try:
+        header = {'frame_id': 1, 'shared_memory': buffer.description, 'seq': 1}
+        count_dropped(header, 'saver')
+        count_dropped(header, 'saver')
+        count_dropped(header, 'localization')
+        count_dropped(header, None)
+        count_dropped({'frame_id': 1}, 'saver')  # Not in a shared buffer
+        assert buffer.dropped_by('saver') == 2
+        assert buffer.dropped_by('localization') == 1
+    finally:
+        for attached in list(ring_buffer._attached.values()):
+            attached.close()
+        buffer.close()
+    count_dropped(header, 'saver')  # The buffer was released